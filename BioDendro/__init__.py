@@ -13,7 +13,12 @@ from BioDendro.preprocess import MGF
 from BioDendro.preprocess import SampleRecord
 from BioDendro.preprocess import split_msms_title
 from BioDendro.preprocess import remove_redundancy
+from BioDendro.preprocess import remove_redundancy_stream
 from BioDendro.cluster import Tree
+from BioDendro.parallel import n_workers
+from BioDendro.output import check_format
+from BioDendro.output import check_sparse_format
+from BioDendro.output import write_table
 
 
 def pipeline(
@@ -23,7 +28,7 @@ def pipeline(
     cutoff=0.6,
     bin_threshold=8e-4,
     clustering_method="jaccard",
-    processed="processed.xlsx",
+    processed=None,
     results_dir=None,
     out_html="simple_dendrogram.html",
     width=900,
@@ -34,6 +39,17 @@ def pipeline(
     eps=0.6,
     mz_tol=0.002,
     retention_tol=5,
+    streaming=False,
+    n_jobs=1,
+    cache=True,
+    cache_dir=None,
+    low_memory=False,
+    temp_dir=None,
+    engine="exact",
+    linkage_method="complete",
+    file_format="xlsx",
+    wide_table=None,
+    sparse_matrix=None,
     **kwargs
 ):
     """ Runs the BioDendro pipeline.
@@ -115,6 +131,82 @@ def pipeline(
                        None (`results_dir\\simple_dendrogram.html`)
                        can be user defined
 
+    streaming          match the MGF spectra against the components as they
+                         are read, rather than loading the whole MGF first.
+                         Uses less memory for very large MGF files.
+                       False
+                       True or False
+
+    n_jobs             number of processes to use when parsing the MGF file,
+                         computing distances between components and writing
+                         cluster summaries, and threads to use when matching
+                         components to spectra.
+                         -1 uses all available cpus. MGF parsing and matching
+                         don't use it when streaming.
+                       1
+                       -1 or any positive integer
+
+    cache              save the parsed MGF to a binary cache file, and reuse it
+                         in later runs with the same MGF file, scaling,
+                         filtering and eps. The cache is replaced if the MGF
+                         file changes. Not used when streaming.
+                       True
+                       True or False
+
+    cache_dir          directory to write MGF cache files to.
+                       None (next to the MGF file)
+                       can be user defined
+
+    low_memory         keep the distances between components in a temporary
+                         float32 file on disk while clustering. Use this
+                         for very large numbers of components.
+                       False
+                       True or False
+
+    temp_dir           directory to write the temporary distance file to
+                         when low_memory is True.
+                       None (the system temporary directory)
+                       can be user defined
+
+    engine             how to cluster components. "exact" compares all pairs
+                         of components. "minhash" only compares likely
+                         neighbours, found with MinHash signatures, which
+                         scales to far more components. Its clusters at the
+                         cutoff usually match the exact ones.
+                       "exact"
+                       "exact" or "minhash"
+
+    linkage_method     how to compute distances between clusters of
+                         components when building the tree. "single" is
+                         fast and doesn't store the distance matrix.
+                       "complete"
+                       "complete", "average", "single" or "weighted"
+
+    file_format        format to write the processed, per-cluster and
+                         cluster membership tables in. Excel is limited to
+                         16384 bins. "parquet" and "feather" are fastest,
+                         but need pyarrow to be installed.
+                       "xlsx"
+                       "xlsx", "csv", "parquet" or "feather"
+
+    wide_table         write a table of every component vs every bin. This
+                         is mostly empty for large datasets. Otherwise a
+                         long-form "memberships" table is written, with the
+                         cluster and m/z of each bin present in each
+                         component.
+                       None (only for "xlsx")
+                       None, True or False
+
+    sparse_matrix      also write the components vs bins matrix as a sparse
+                         matrix, with tables naming its rows and columns.
+                       None (don't write it)
+                       None, "mtx" (Matrix Market) or "npz" (scipy)
+
+    processed          file in results_dir to write the processed component
+                         table to.
+                       None (`processed.<file_format>`)
+                       can be user defined
+
     quiet              suppress pipeline messages
                        False
                        True or False
@@ -125,6 +217,15 @@ def pipeline(
     else:
         printer = lambda *s: print(*s)
 
+    # Fail early rather than after clustering.
+    check_format(file_format)
+    if sparse_matrix is not None:
+        check_sparse_format(sparse_matrix)
+    n_workers(n_jobs)
+
+    if processed is None:
+        processed = "processed.{}".format(file_format)
+
     if results_dir is None:
         dt = datetime.now()
         results_dir = "results_{}".format(dt.strftime("%Y%m%d%H%M%S"))
@@ -147,6 +248,17 @@ def pipeline(
         "- eps = {eps}\n"
         "- mz_tolerance = {mz_tol}\n"
         "- retention_tolerance = {retention_tol}\n"
+        "- streaming = {streaming}\n"
+        "- jobs = {n_jobs}\n"
+        "- cache = {cache}\n"
+        "- cache directory = {cache_dir}\n"
+        "- low memory = {low_memory}\n"
+        "- temporary directory = {temp_dir}\n"
+        "- engine = {engine}\n"
+        "- linkage method = {linkage_method}\n"
+        "- file format = {file_format}\n"
+        "- wide table = {wide_table}\n"
+        "- sparse matrix = {sparse_matrix}\n"
         "\n"
     ).format(
         name=__name__,
@@ -167,6 +279,17 @@ def pipeline(
         eps=eps,
         mz_tol=mz_tol,
         retention_tol=retention_tol,
+        streaming=streaming,
+        n_jobs=n_jobs,
+        cache=cache,
+        cache_dir=cache_dir,
+        low_memory=low_memory,
+        temp_dir=temp_dir,
+        engine=engine,
+        linkage_method=linkage_method,
+        file_format=file_format,
+        wide_table=wide_table,
+        sparse_matrix=sparse_matrix,
     ))
 
     params = [
@@ -185,42 +308,113 @@ def pipeline(
         ("scaling", scaling),
         ("filtering", filtering),
         ("eps", eps),
+        ("streaming", streaming),
+        ("jobs", n_jobs),
+        ("cache", cache),
+        ("cache directory", cache_dir),
+        ("low memory", low_memory),
+        ("temporary directory", temp_dir),
+        ("engine", engine),
+        ("linkage method", linkage_method),
+        ("file format", file_format),
+        ("wide table", wide_table),
+        ("sparse matrix", sparse_matrix),
     ]
 
-    # Open the trigger data <file>.msg
-    with open(mgf_path, 'r') as handle:
-        mgf = MGF.parse(handle, scaling=scaling, filtering=filtering, eps=eps)
-
-    # Customised MGF title handler.
-    # TODO: This title filter will fail for some mgf title fields.
-    for rec in mgf.records:
-        rec.title = split_msms_title(rec.title)
-
     # Open the sample list <file>.csv
     with open(components_path, 'r') as handle:
         components = SampleRecord.parse(handle)
 
-    # Now remove redundancy and print best trigger ion list
-    printer("Processing inputs")
-    table = remove_redundancy(
-        components,
-        mgf,
-        neutral=neutral,
-        mz_tol=mz_tol,
-        retention_tol=retention_tol
-    )
+    if streaming:
+        # Match the trigger data against the components as it is read.
+        printer("Processing inputs")
+        with open(mgf_path, 'r') as handle:
+            records = MGF.iter_records(
+                handle,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps
+            )
+            table = remove_redundancy_stream(
+                components,
+                _retitle(records),
+                neutral=neutral,
+                mz_tol=mz_tol,
+                retention_tol=retention_tol
+            )
+
+    else:
+        # Open the trigger data <file>.msg
+        if cache:
+            mgf = MGF.parse_cached(
+                mgf_path,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps,
+                n_jobs=n_jobs,
+                cache_dir=cache_dir
+            )
+        else:
+            mgf = MGF.parse(
+                mgf_path,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps,
+                n_jobs=n_jobs
+            )
+
+        # Customised MGF title handler.
+        # TODO: This title filter will fail for some mgf title fields.
+        mgf.titles[:] = [split_msms_title(title) for title in mgf.titles]
+
+        # Now remove redundancy and print best trigger ion list
+        printer("Processing inputs")
+        table = remove_redundancy(
+            components,
+            mgf,
+            neutral=neutral,
+            mz_tol=mz_tol,
+            retention_tol=retention_tol,
+            n_jobs=n_jobs
+        )
 
     printer("Binning and clustering\nThis may take some time...")
-    tree = Tree(bin_threshold, clustering_method, cutoff)
+    tree = Tree(
+        bin_threshold,
+        clustering_method,
+        cutoff,
+        n_jobs=n_jobs,
+        low_memory=low_memory,
+        temp_dir=temp_dir,
+        engine=engine,
+        linkage_method=linkage_method
+    )
     tree.fit(table)
 
     printer("Writing per-cluster summaries")
     os.makedirs(results_dir, exist_ok=True)
-    tree.write_summaries(path=results_dir)
 
-    # Write out an excel file too
-    table.drop(columns="mz").drop_duplicates().to_excel(
-        pjoin(results_dir, processed), index=False)
+    # Report roughly every 10% of clusters written.
+    def progress(done, total):
+        if done == total or done % max(total // 10, 1) == 0:
+            printer("- written {} of {} clusters".format(done, total))
+        return
+
+    tree.write_summaries(
+        path=results_dir,
+        progress=progress,
+        file_format=file_format,
+        wide_table=wide_table,
+        sparse_matrix=sparse_matrix
+    )
+
+    # Write out the processed table too
+    write_table(
+        table.drop(columns="mz").drop_duplicates(),
+        pjoin(results_dir, processed),
+        file_format,
+        index=False
+    )
 
     with open(pjoin(results_dir, "params.txt"), "w") as handle:
         params_file = "\n".join(["{}\t{}".format(k, v) for k, v in params])
@@ -238,6 +432,16 @@ def pipeline(
     return tree
 
 
+def _retitle(records):
+    """ Apply the customised MGF title handler to a stream of records. """
+
+    for record in records:
+        record.title = split_msms_title(record.title)
+        yield record
+
+    return
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=(
@@ -292,8 +496,10 @@ def main():
 
     parser.add_argument(
         "-p", "--processed",
-        default="processed.xlsx",
-        help="Path to write preprocessed output to."
+        default=None,
+        help=("Path to write preprocessed output to. "
+              "By default will write to `--results-dir` as "
+              "`processed.<format>`.")
     )
 
     parser.add_argument(
@@ -371,6 +577,113 @@ def main():
         default=5
     )
 
+    parser.add_argument(
+        "--streaming",
+        help=("Match MSMS spectra to the components list as the MGF is "
+              "read, rather than loading the whole MGF into memory first."),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="n_jobs",
+        help=("Number of processes or threads to use when parsing the MGF "
+              "file, matching components to spectra, computing "
+              "distances between components and writing cluster "
+              "summaries. "
+              "-1 uses all available cpus (Default 1)."),
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        help=("Don't read or write the binary cache of the parsed MGF file. "
+              "By default the cache is reused when the MGF file and the "
+              "scaling, filtering and eps options are unchanged."),
+        action="store_false",
+        default=True
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=None,
+        help=("Directory to write MGF cache files to. "
+              "By default they are written next to the MGF file.")
+    )
+
+    parser.add_argument(
+        "--low-memory",
+        dest="low_memory",
+        help=("Keep the distances between components in a temporary float32 "
+              "file on disk while clustering. Use this for very large "
+              "numbers of components."),
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--temp-dir",
+        dest="temp_dir",
+        default=None,
+        help=("Directory to write the temporary distance file to when "
+              "using --low-memory. Should be on a fast local disk. "
+              "By default the system temporary directory is used.")
+    )
+
+    parser.add_argument(
+        "--engine",
+        help=("How to cluster components. 'exact' compares all pairs of "
+              "components. 'minhash' only compares likely neighbours, "
+              "which scales to far more components, and usually gives the "
+              "same clusters at the cutoff (Default exact)."),
+        default="exact",
+        choices=["exact", "minhash"],
+    )
+
+    parser.add_argument(
+        "--linkage-method",
+        dest="linkage_method",
+        help=("How to compute distances between clusters of components "
+              "when building the tree. 'single' is fast and doesn't store "
+              "the distance matrix (Default complete)."),
+        default="complete",
+        choices=["complete", "average", "single", "weighted"],
+    )
+
+    parser.add_argument(
+        "--format",
+        dest="file_format",
+        help=("The file format to write tables in. Excel files are slow to "
+              "write and are limited to 16384 bins. 'parquet' and 'feather' "
+              "need pyarrow to be installed (Default xlsx)."),
+        default="xlsx",
+        choices=["xlsx", "csv", "parquet", "feather"],
+    )
+
+    parser.add_argument(
+        "--long-table",
+        dest="wide_table",
+        help=("Write the clusters and bins of each component as a long-form "
+              "memberships table, instead of a table of every component vs "
+              "every bin. This is the default for formats other than xlsx."),
+        action="store_const",
+        const=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--sparse-matrix",
+        dest="sparse_matrix",
+        help=("Also write the components vs bins matrix as a sparse "
+              "matrix, in Matrix Market (mtx) or scipy (npz) format."),
+        default=None,
+        choices=["mtx", "npz"],
+    )
+
     parser.add_argument(
         "-q", "--quiet",
         help="Suppress status notifications written to stdout.",
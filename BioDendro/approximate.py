@@ -0,0 +1,303 @@
+"""
+Module approximate contains a scalable, approximate alternative to clustering
+samples from their full distance matrix.
+
+MinHash signatures of each sample's bins are grouped with locality sensitive
+hashing (LSH) to find pairs of samples that are likely to be similar. Exact
+distances are computed for these candidate pairs only, and the samples are
+clustered from this sparse graph of distances. Pairs that aren't candidates
+are treated as being as far apart as possible.
+
+The number of signature rows per LSH band is chosen so that pairs closer than
+the clustering cutoff are found with high probability. So clusters formed
+below the cutoff usually match the exact results, while the tree above the
+cutoff is less reliable.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from BioDendro.distance import paired_distances
+from BioDendro.distance import _check_metric
+from BioDendro.linkage import sparse_linkage
+
+# A Mersenne prime for universal hashing. Products of two numbers below it
+# fit in an int64.
+_PRIME = 2 ** 31 - 1
+
+# Roughly how many hash values to compute at a time.
+_HASH_ELEMENTS = 2 ** 24
+
+
+def minhash(matrix, n_hashes=128, seed=0):
+    """ Compute MinHash signatures of the rows of a presence-absence matrix.
+
+    The probability that two rows have the same value for a hash function is
+    the Jaccard similarity of their sets of columns.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix. Non-zero elements are treated as
+        present.
+    n_hashes -- The number of hash functions, i.e. the signature length.
+    seed -- Seeds the random hash functions.
+
+    Returns:
+    A (rows x n_hashes) uint32 array. Empty rows have the maximum value for
+    every hash.
+    """
+
+    matrix = csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    if not matrix.has_sorted_indices:
+        matrix = matrix.sorted_indices()
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, n_hashes, dtype=np.int64)
+    b = rng.integers(0, _PRIME, n_hashes, dtype=np.int64)
+
+    signatures = np.full(
+        (matrix.shape[0], n_hashes),
+        np.iinfo(np.uint32).max,
+        dtype=np.uint32
+    )
+
+    nonempty = np.diff(matrix.indptr) > 0
+    if not nonempty.any():
+        return signatures
+
+    starts = matrix.indptr[:-1][nonempty]
+    columns = matrix.indices.astype(np.int64)[:, np.newaxis]
+
+    chunk_size = max(1, _HASH_ELEMENTS // max(len(columns), 1))
+    for start in range(0, n_hashes, chunk_size):
+        stop = min(start + chunk_size, n_hashes)
+        hashes = (columns * a[start:stop] + b[start:stop]) % _PRIME
+        signatures[nonempty, start:stop] = np.minimum.reduceat(
+            hashes,
+            starts,
+            axis=0
+        )
+
+    return signatures
+
+
+def similarity_threshold(cutoff, metric="jaccard"):
+    """ The Jaccard similarity of sets that are cutoff apart.
+
+    Bray-Curtis distances of sets are one minus the Dice similarity, which
+    is a monotonic function of the Jaccard similarity.
+    """
+
+    _check_metric(metric)
+
+    if metric == "jaccard":
+        return 1 - cutoff
+
+    dice = 1 - cutoff
+    return dice / (2 - dice)
+
+
+def rows_per_band(n_hashes, similarity, recall=0.99):
+    """ Choose the LSH band size to find similar pairs with high probability.
+
+    Pairs with Jaccard similarity s share at least one band of r rows with
+    probability 1 - (1 - s^r)^b, where b = n_hashes // r. Larger bands give
+    fewer false candidates, so this finds the largest r with the required
+    recall at the given similarity.
+
+    Keyword arguments:
+    n_hashes -- The signature length.
+    similarity -- The smallest Jaccard similarity that pairs should be found
+        at.
+    recall -- The required probability of finding pairs at the similarity.
+
+    Returns:
+    int
+    """
+
+    similarity = min(max(similarity, 0.0), 1.0)
+    for rows in range(n_hashes, 0, -1):
+        bands = n_hashes // rows
+        if 1 - (1 - similarity ** rows) ** bands >= recall:
+            return rows
+
+    return 1
+
+
+def candidate_pairs(signatures, rows, max_bucket=100):
+    """ Find pairs of samples that share a band of their MinHash signatures.
+
+    Keyword arguments:
+    signatures -- An array of MinHash signatures, as from minhash.
+    rows -- The number of signature rows per band.
+    max_bucket -- Samples are paired with at most this many others in each
+        band, which limits the cost of very large buckets. Within larger
+        buckets, samples are paired with their nearest neighbours in sample
+        order.
+
+    Returns:
+    Two int64 arrays i and j, of the unique candidate pairs with i < j.
+    """
+
+    n, n_hashes = signatures.shape
+    pairs = []
+
+    # Random odd multipliers to combine a band into a single 64 bit key.
+    # Rare collisions only add candidates, which are checked exactly later.
+    rng = np.random.default_rng(0)
+    multipliers = rng.integers(1, 2 ** 62, rows, dtype=np.uint64) | 1
+
+    for start in range(0, n_hashes - rows + 1, rows):
+        band = signatures[:, start:start + rows].astype(np.uint64)
+        keys = np.zeros(n, dtype=np.uint64)
+        for column, multiplier in enumerate(multipliers):
+            keys = keys * np.uint64(31) + band[:, column] * multiplier
+
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        # Pair each sample with the samples up to lag places after it in the
+        # same bucket. Stop when no buckets are that large.
+        for lag in range(1, max_bucket + 1):
+            same = sorted_keys[:-lag] == sorted_keys[lag:]
+            if not same.any():
+                break
+
+            pairs.append(np.stack([
+                order[:-lag][same],
+                order[lag:][same],
+            ]))
+
+    if len(pairs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    pairs = np.concatenate(pairs, axis=1).astype(np.int64)
+    i = pairs.min(axis=0)
+    j = pairs.max(axis=0)
+
+    codes = np.unique(i * n + j)
+    return codes // n, codes % n
+
+
+def approximate_linkage(
+    matrix,
+    metric="jaccard",
+    cutoff=0.6,
+    method="complete",
+    n_hashes=128,
+    recall=0.99,
+    max_bucket=100,
+    seed=0,
+    counts=None,
+):
+    """ Approximately cluster the rows of a presence-absence matrix.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix. Non-zero elements are treated as
+        present.
+    metric -- The distance metric to use, either "jaccard" or "braycurtis".
+    cutoff -- The distance that clusters will be cut at. Pairs closer than
+        this are found with probability recall.
+    method -- The linkage method. See BioDendro.linkage.sparse_linkage.
+    n_hashes -- The MinHash signature length. Longer signatures find similar
+        pairs more reliably, but take longer to compute.
+    recall -- The probability of finding pairs at the cutoff.
+    max_bucket -- See candidate_pairs.
+    seed -- Seeds the random hash functions.
+    counts -- The number of samples each row stands for.
+        See BioDendro.linkage.nn_chain.
+
+    Returns:
+    A linkage matrix in the same format as scipy.cluster.hierarchy.linkage.
+    Samples that are never paired are joined at a distance of 1.
+    """
+
+    _check_metric(metric)
+
+    signatures = minhash(matrix, n_hashes=n_hashes, seed=seed)
+    rows = rows_per_band(
+        n_hashes,
+        similarity_threshold(cutoff, metric),
+        recall=recall
+    )
+
+    i, j = candidate_pairs(signatures, rows, max_bucket=max_bucket)
+    distances = paired_distances(matrix, i, j, metric=metric)
+
+    return sparse_linkage(
+        matrix.shape[0],
+        i,
+        j,
+        distances,
+        method=method,
+        max_distance=1.0,
+        counts=counts
+    )
+
+
+def _pair_counts(labels_a, labels_b):
+    """ Count pairs of samples clustered together in a, b and both. """
+
+    _, codes_a = np.unique(labels_a, return_inverse=True)
+    _, codes_b = np.unique(labels_b, return_inverse=True)
+    codes_a = codes_a.ravel()
+    codes_b = codes_b.ravel()
+
+    def pairs(counts):
+        counts = counts.astype(np.float64)
+        return np.sum(counts * (counts - 1) / 2)
+
+    joint = codes_a * (codes_b.max() + 1) + codes_b
+    both = pairs(np.bincount(joint))
+    in_a = pairs(np.bincount(codes_a))
+    in_b = pairs(np.bincount(codes_b))
+    return both, in_a, in_b
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    """ The adjusted Rand index between two flat clusterings.
+
+    1 means identical clusterings, and values near 0 are what is expected
+    from random labels.
+    """
+
+    n = len(labels_a)
+    both, in_a, in_b = _pair_counts(labels_a, labels_b)
+
+    total = n * (n - 1) / 2
+    if total == 0:
+        return 1.0
+
+    expected = in_a * in_b / total
+    maximum = (in_a + in_b) / 2
+
+    if maximum == expected:
+        # Both are all singletons or a single cluster.
+        return 1.0
+
+    return (both - expected) / (maximum - expected)
+
+
+def compare_clusters(approximate, exact):
+    """ Summarise how well approximate clusters agree with exact ones.
+
+    Keyword arguments:
+    approximate -- An array of cluster labels from an approximate method.
+    exact -- An array of cluster labels for the same samples from the exact
+        method.
+
+    Returns:
+    A dictionary with the number of clusters in each, the adjusted Rand
+    index, and the precision and recall of pairs of samples clustered
+    together.
+    """
+
+    both, in_approximate, in_exact = _pair_counts(approximate, exact)
+
+    return {
+        "n_clusters": len(np.unique(approximate)),
+        "n_clusters_exact": len(np.unique(exact)),
+        "adjusted_rand_index": adjusted_rand_index(approximate, exact),
+        "pair_precision": both / in_approximate if in_approximate else 1.0,
+        "pair_recall": both / in_exact if in_exact else 1.0,
+    }
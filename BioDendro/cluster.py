@@ -4,8 +4,16 @@ of mass spec data.
 """
 
 from os.path import join as pjoin
+from collections import OrderedDict
+import tempfile
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
 
 import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse import csr_matrix
 from scipy.cluster.hierarchy import linkage
 from scipy.cluster.hierarchy import fcluster
 
@@ -16,6 +24,28 @@ from matplotlib import pyplot as plt  # noqa
 import plotly  # noqa
 
 from BioDendro.plot import dendrogram  # noqa
+from BioDendro.distance import pdist  # noqa
+from BioDendro.distance import condensed_size  # noqa
+from BioDendro.linkage import nn_chain  # noqa
+from BioDendro.linkage import mst_single_linkage  # noqa
+from BioDendro.linkage import METHODS as LINKAGE_METHODS  # noqa
+from BioDendro.approximate import approximate_linkage  # noqa
+from BioDendro.approximate import compare_clusters  # noqa
+from BioDendro.parallel import n_workers  # noqa
+from BioDendro.output import check_format  # noqa
+from BioDendro.output import check_sparse_format  # noqa
+from BioDendro.output import table_filename  # noqa
+from BioDendro.output import write_table  # noqa
+from BioDendro.output import write_sparse_matrix  # noqa
+
+ENGINES = ("exact", "minhash")
+
+# How many clusters to queue per worker when writing summaries, which limits
+# how many tables are held in memory at once.
+_SUMMARIES_PER_WORKER = 4
+
+# How many cluster_hist figures to keep for reuse.
+_FIGURE_CACHE_SIZE = 16
 
 
 class Tree(object):
@@ -31,6 +61,12 @@ class Tree(object):
         cutoff=0.6,
         sample_col="component",
         mz_col="mz",
+        n_jobs=1,
+        low_memory=False,
+        temp_dir=None,
+        engine="exact",
+        engine_options=None,
+        linkage_method="complete",
     ):
         """ Constructs a tree object to bin and cluster mass spectra.
 
@@ -42,14 +78,65 @@ class Tree(object):
         cutoff -- .
         sample_col -- The column name in the df to use as the samples.
         mz_col -- The column name in the df to use as the mz values.
+        n_jobs -- The number of processes to use when computing distances
+            between samples. -1 uses all available cpus.
+        low_memory -- Store the distances between samples as float32 in a
+            temporary file on disk while clustering, rather than as float64
+            in memory. Use this for very large numbers of samples.
+        temp_dir -- The directory to write the temporary distance file to
+            when low_memory is True. Should be on a fast local disk.
+            If None, uses the system default temporary directory.
+        engine -- How to cluster samples. "exact" computes the distances
+            between all pairs of samples. "minhash" only computes distances
+            between likely neighbours found with MinHash signatures, which
+            scales to much larger numbers of samples. Clusters formed below
+            the cutoff usually match the exact ones, see compare_exact.
+            The tree is tuned for the cutoff, so cut_tree rebuilds it if
+            it is cut at a larger one. low_memory isn't used by the
+            "minhash" engine.
+        engine_options -- A dictionary of extra keyword arguments for the
+            "minhash" engine. See BioDendro.approximate.approximate_linkage.
+            A "cutoff" option tunes the tree for at least that cutoff.
+        linkage_method -- How to compute distances between clusters of
+            samples. One of "complete", "average", "single" or "weighted".
+            With the "exact" engine, "single" linkage is computed from a
+            minimum spanning tree without storing the distance matrix,
+            which makes it a fast first pass for large datasets. When
+            samples share identical profiles, "average" linkage weights
+            them by count with a pure Python implementation, which is
+            slower than scipy.
         """
 
+        if engine not in ENGINES:
+            raise ValueError(
+                "Unsupported engine {}. Must be one of {}."
+                .format(repr(engine), ", ".join(ENGINES))
+            )
+
+        if linkage_method not in LINKAGE_METHODS:
+            raise ValueError(
+                "Unsupported linkage method {}. Must be one of {}."
+                .format(repr(linkage_method), ", ".join(LINKAGE_METHODS))
+            )
+
         self.threshold = threshold
         self.clustering_method = clustering_method
         self.cutoff = cutoff
         self.sample_col = sample_col
         self.mz_col = mz_col
-
+        self.n_jobs = n_jobs
+        self.low_memory = low_memory
+        self.temp_dir = temp_dir
+        self.engine = engine
+        self.engine_options = engine_options
+        self.linkage_method = linkage_method
+
+        self._onehot_df = None
+        self._onehot_cache = {}
+        self._tree_cache = {}
+        self._bin_frequencies = None
+        self._figure_cache = OrderedDict()
+        self._tree_cutoff = None
         return
 
     def fit(self, df):
@@ -59,11 +146,24 @@ class Tree(object):
             df -- A pandas dataframe containing samples and mz values.
 
         Modifies:
-            self.df -- Creates a copy of the input data.
+            self.df -- A reference to the input data. It is not copied, so
+                avoid modifying it while using the tree.
             Other elements modified indirectly.
             """
 
-        self.df = df.copy()
+        # Only the mz values and sample codes are needed from here on.
+        # The mz column is used as is if it is already float, not copied.
+        self.df = df
+        self._mz = df[self.mz_col].to_numpy(dtype=float)
+        self._sample_codes, samples = pd.factorize(
+            df[self.sample_col],
+            sort=True
+        )
+        self._samples = np.asarray(samples, dtype=object)
+
+        self._onehot_cache = {}
+        self._tree_cache = {}
+
         threshold = self.threshold
         clustering_method = self.clustering_method
         cutoff = self.cutoff
@@ -74,30 +174,107 @@ class Tree(object):
         return
 
     @staticmethod
-    def _bin_name(arr):
+    def _format_bin_name(mean, min_, max_):
         return "{:.4f}_{:.4f}_{:.4f}".format(
-            np.around(np.mean(arr), 4),
-            np.around(np.min(arr), 4),
-            np.around(np.max(arr), 4)
+            np.around(mean, 4),
+            np.around(min_, 4),
+            np.around(max_, 4)
         )
 
+    @classmethod
+    def _bin_name(cls, arr):
+        return cls._format_bin_name(np.mean(arr), np.min(arr), np.max(arr))
+
     @staticmethod
     def _bin_starts(arr, threshold):
         """ Find starts of bins in a sorted array.
         Not intended for public use.
 
         Keyword arguments:
-            arr -- A pandas Series object, in sorted order.
+            arr -- A pandas Series object or array, in sorted order.
             threshold -- See __init__.
 
         returns:
         np.array
         """
 
-        diffs = arr.diff()
-        diffs[0] = threshold + 1
-        bin_starts = np.where(diffs >= threshold)[0]
-        return bin_starts
+        arr = np.asarray(arr, dtype=float)
+        if len(arr) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # The first element always starts a bin.
+        bin_starts = np.flatnonzero(np.diff(arr) >= threshold) + 1
+        return np.concatenate([[0], bin_starts])
+
+    @staticmethod
+    def _bin_ids(n, starts):
+        """ Assign an integer bin id to each of n sorted elements.
+
+        Keyword arguments:
+        n -- The number of elements that were binned.
+        starts -- A list/array of bin start indices. e.g. from _bin_starts.
+
+        Returns:
+        np.array of ints from 0 to len(starts) - 1, in ascending order.
+        """
+
+        mask = np.zeros(n, dtype=bool)
+        mask[np.asarray(starts, dtype=np.int64)] = True
+        return np.cumsum(mask) - 1
+
+    @staticmethod
+    def _bin_stats(column, starts):
+        """ Compute the mean, min and max mz value of each bin.
+
+        Keyword arguments:
+        column -- A list/array/series of mz values, in sorted order.
+        starts -- A list/array of bin start indices. e.g. from _bin_starts.
+
+        Returns:
+        pd.DataFrame with columns mz_mean, mz_min and mz_max, indexed by
+        bin id.
+        """
+
+        column = np.asarray(column, dtype=float)
+        starts = np.asarray(starts, dtype=np.int64)
+        counts = np.diff(np.append(starts, len(column)))
+
+        # np.add.reduceat sums in a different order to np.mean, which
+        # changes the rounding of a few bin names. Bins with the same number
+        # of members are stacked into rows and averaged with np.mean instead,
+        # which gives exactly the same values as averaging each bin alone.
+        means = np.empty(len(starts), dtype=float)
+        order = np.argsort(counts, kind="stable")
+        sizes, size_starts = np.unique(counts[order], return_index=True)
+        for size, group in zip(sizes, np.split(order, size_starts[1:])):
+            members = starts[group][:, np.newaxis] + np.arange(size)
+            means[group] = np.mean(column[members], axis=1)
+
+        return pd.DataFrame(
+            {
+                "mz_mean": means,
+                "mz_min": np.minimum.reduceat(column, starts),
+                "mz_max": np.maximum.reduceat(column, starts),
+            },
+            index=pd.RangeIndex(len(starts), name="bin")
+        )
+
+    @classmethod
+    def _format_bin_names(cls, stats):
+        """ Format "mean_min_max" names for the rows of a _bin_stats table.
+        """
+
+        return np.array(
+            [
+                cls._format_bin_name(mean, min_, max_)
+                for mean, min_, max_
+                in stats[["mz_mean", "mz_min", "mz_max"]].itertuples(
+                    index=False,
+                    name=None
+                )
+            ],
+            dtype=object
+        )
 
     @classmethod
     def _bin_names(cls, column, starts):
@@ -117,55 +294,86 @@ class Tree(object):
         bin.
         """
 
-        # Create an empty array to store python strings
-        # These will be the bin names
-        bins = np.zeros(len(column), dtype=object)
+        names = cls._format_bin_names(cls._bin_stats(column, starts))
+        return names[cls._bin_ids(len(column), starts)]
 
-        # We'll keep track of the name lengths so we can convert to
-        # C-strings later
-        # longest_name_len = 0
+    def bin_labels(self, bins=None):
+        """ Get the "mean_min_max" names of bins.
 
-        i = 0
-        # Starting at 1 because we need i - 1. Which will always be 0.
-        for i in range(1, len(starts)):
-            # Get the slice as an object to avoid rewriting it.
-            bin_range = slice(starts[i - 1], starts[i])
+        Keyword arguments:
+        bins -- A list/array of integer bin ids, as in self.onehot_columns.
+            If None, names all bins.
 
-            # Get the mz values within this bin.
-            arr = column[bin_range]
+        Returns:
+        np.array of strings.
+        """
 
-            # Compute a bin name based on its members' mz values.
-            bin_name = cls._bin_name(arr)
+        stats = self.bin_stats
+        if bins is not None:
+            stats = stats.iloc[np.asarray(bins, dtype=np.int64)]
 
-            # Update bin name lengths
-            # if len(bin_name) > longest_name_len:
-            #     longest_bin_len = len(bin_name)
+        return self._format_bin_names(stats)
 
-            # assign name to elements in this empty bin.
-            bins[bin_range] = bin_name
+    @staticmethod
+    def _sparse_onehot(samples, bins):
+        """ Construct a sparse one-hot encoded matrix of samples vs bins.
 
-        # Repeat procedure from above for last cluster.
-        # Remembering that the starts mark, the start of the cluster, so we
-        # need to go all the way to column end.
-        bin_range = slice(starts[i], None)
-        arr = column[bin_range]
+        Keyword arguments:
+        samples -- A list/array/series of sample names.
+        bins -- A list/array of ion bins for each element in samples.
+        Must be the same length as samples, but may contain duplicates.
 
-        bin_name = cls._bin_name(arr)
-        # if len(bin_name) > longest_name_len:
-        #    longest_bin_len = len(bin_name)
-        bins[bin_range] = bin_name
+        Returns:
+        matrix -- A boolean scipy CSR matrix with a row per unique sample
+            and a column per unique bin, in sorted order.
+        index -- An array of the sample names for each row.
+        columns -- An array of the bin names for each column.
+        """
+
+        row_codes, index = pd.factorize(pd.Series(samples), sort=True)
+        column_codes, columns = pd.factorize(pd.Series(bins), sort=True)
 
-        # Return the bin names. And convert the array type to a C-string with
-        # the maximum number of characters required.
-        # return bins.astype("|S{}".format(longest_bin_len))
+        matrix = Tree._onehot_matrix(
+            row_codes,
+            column_codes,
+            (len(index), len(columns))
+        )
 
-        # Uncomment above line if C string performance is necessary.
-        # But you would need to decode the strings from binary to get them to
-        # print normally.
-        return bins
+        index = np.asarray(index, dtype=object)
+        columns = np.asarray(columns, dtype=object)
+        return matrix, index, columns
 
     @staticmethod
-    def _pivot(df, bins, index_col):
+    def _onehot_matrix(row_codes, column_codes, shape):
+        """ Construct a boolean CSR matrix with True at each (row, column).
+
+        Keyword arguments:
+        row_codes -- An array of row numbers.
+        column_codes -- An array of column numbers, the same length as
+            row_codes. Pairs may be repeated.
+        shape -- The shape of the matrix.
+
+        Returns:
+        A boolean scipy CSR matrix.
+        """
+
+        # Duplicate entries are summed, so count in ints before converting.
+        matrix = coo_matrix(
+            (np.ones(len(row_codes), dtype=np.int32),
+             (row_codes, column_codes)),
+            shape=shape
+        ).tocsr()
+
+        # Share the index arrays rather than copying them with astype.
+        return csr_matrix(
+            (np.ones(len(matrix.data), dtype=bool),
+             matrix.indices,
+             matrix.indptr),
+            shape=shape
+        )
+
+    @classmethod
+    def _pivot(cls, df, bins, index_col):
         """ Construct a one-hot encoded dataframe of samples vs bins.
 
         Given any dataframe with samples, construct a wide form dataframe
@@ -179,10 +387,36 @@ class Tree(object):
         index_col -- The column to use from df.
         """
 
-        df["present"] = True
-        df["bins"] = bins
-        return df.pivot_table(index=index_col, columns="bins",
-                              values="present", fill_value=False)
+        matrix, index, columns = cls._sparse_onehot(df[index_col], bins)
+        return cls._onehot_frame(matrix, index, columns, index_col)
+
+    @staticmethod
+    def _onehot_frame(matrix, index, columns, index_name):
+        """ Convert a sparse one-hot matrix to a dense boolean dataframe. """
+        return pd.DataFrame(
+            matrix.toarray(),
+            index=pd.Index(index, name=index_name),
+            columns=pd.Index(columns, name="bins"),
+        )
+
+    @property
+    def onehot_df(self):
+        """ A dense dataframe of the one-hot encoded samples vs bins.
+
+        Built from the sparse matrix `onehot` the first time it is used.
+        For large datasets this can be very large, so prefer `onehot`,
+        `onehot_index` and `onehot_columns`.
+        """
+
+        if self._onehot_df is None:
+            self._onehot_df = self._onehot_frame(
+                self.onehot,
+                self.onehot_index,
+                self.bin_labels(self.onehot_columns),
+                self.sample_col
+            )
+
+        return self._onehot_df
 
     def _bin(self, threshold=None):
         """ Get names of the bins and assign to mz rows.
@@ -191,47 +425,373 @@ class Tree(object):
         threshold -- See __init__. If none, inherits threshold from object.
 
         Uses:
-        self.df
-        self.mz_col
-        self.sample_col
+        self._mz -- The sorted mz values, set by fit.
+        self._sample_codes -- The row in self.onehot of each mz value.
+        self._samples -- The names of the rows in self.onehot.
 
         Modifies:
-        self.onehot_df -- A one-hot encoded dataframe of samples vs bins.
+        self.onehot -- A sparse one-hot encoded matrix of samples vs bins.
+        self.onehot_index -- The sample names of the rows in self.onehot.
+        self.onehot_columns -- The integer bin ids of the columns in
+            self.onehot.
+        self.bin_stats -- A dataframe of the mean, min and max mz of each bin,
+            indexed by bin id.
         """
 
         if threshold is None:
             threshold = self.threshold
 
-        df = self.df.copy()
-        colname = self.mz_col
+        (self.onehot,
+         self.onehot_index,
+         self.onehot_columns,
+         self.bin_stats) = self._binned(threshold)
 
-        bin_starts = self._bin_starts(df[colname], threshold)
-        bins = self._bin_names(df[colname], bin_starts)
-        self.onehot_df = self._pivot(df, bins, self.sample_col)
+        self._binned_threshold = threshold
+        self._onehot_df = None
         return
 
-    def _hclust(self, clustering_method=None):
+    def _binned(self, threshold):
+        """ Bin the mz values and one-hot encode the samples.
+
+        Results are memoised by threshold until the next call to fit.
+
+        Keyword arguments:
+        threshold -- See __init__.
+
+        Returns:
+        A tuple of the one-hot matrix, its index and columns, and the bin
+        statistics. See _bin.
+        """
+
+        if threshold in self._onehot_cache:
+            return self._onehot_cache[threshold]
+
+        bin_starts = self._bin_starts(self._mz, threshold)
+        bins = self._bin_ids(len(self._mz), bin_starts)
+        bin_stats = self._bin_stats(self._mz, bin_starts)
+
+        # Bin ids are already codes, every bin has at least one member.
+        onehot = self._onehot_matrix(
+            self._sample_codes,
+            bins,
+            (len(self._samples), len(bin_starts))
+        )
+
+        binned = (
+            onehot,
+            self._samples,
+            np.arange(len(bin_starts), dtype=np.int64),
+            bin_stats
+        )
+        self._onehot_cache[threshold] = binned
+        return binned
+
+    def _hclust(self, clustering_method=None, cutoff=None):
         """ Hierarchically cluster the one hot encoded dataframe.
 
+        Samples with identical bins are collapsed into a single profile
+        before clustering, and the tree is expanded to all samples after.
+        Identical samples are always merged first, at a distance of 0.
+
         Keyword arguments:
             clustering_method -- The distance metric used to construct linkage
             with. May be either "jaccard" or "braycurtis". If none inherits
             from object.
+            cutoff -- The largest cutoff the tree will be cut at. Only used
+            to tune the "minhash" engine. If none inherits from object.
 
         Uses:
-            self.onehot_df
+            self.onehot
+            self.n_jobs
+            self.low_memory
+            self.temp_dir
 
         Modifies:
             self.tree -- A scipy linkage array.
+            self.profiles -- The index of the unique profile of each sample.
+            self._tree_cutoff -- The cutoff the tree was tuned for, or None
+            if the tree is exact.
             """
 
         if clustering_method is None:
             clustering_method = self.clustering_method
 
-        self.tree = linkage(self.onehot_df, method="complete",
-                            metric=clustering_method)
+        if cutoff is None:
+            cutoff = self.cutoff
+
+        self.tree, self.profiles = self._linked(
+            self._binned_threshold,
+            clustering_method,
+            cutoff=cutoff
+        )
+        self._tree_cutoff = self._engine_cutoff(self.engine, cutoff)
         return
 
+    def _engine_cutoff(self, engine, cutoff):
+        """ The cutoff to tune an approximate engine for.
+
+        Trees from the "minhash" engine are reliable at and below the cutoff
+        they were built for. A "cutoff" in engine_options can raise it.
+
+        Returns:
+        A float, or None for the "exact" engine.
+        """
+
+        if engine == "exact":
+            return None
+
+        options = self.engine_options or {}
+        return max(cutoff, options.get("cutoff", cutoff))
+
+    def _linked(self, threshold, clustering_method, engine=None,
+                linkage_method=None, cutoff=None):
+        """ Get the linkage of samples binned with a threshold.
+
+        Results are memoised by threshold, methods, engine and the cutoff
+        that approximate engines are tuned for, until the next call to fit.
+
+        Keyword arguments:
+        threshold -- See __init__.
+        clustering_method -- See __init__.
+        engine -- See __init__. If None, inherits from object.
+        linkage_method -- See __init__. If None, inherits from object.
+        cutoff -- The largest cutoff the tree will be cut at. Only used by
+            the "minhash" engine. If None, inherits from object.
+
+        Returns:
+        A tuple of a scipy linkage array and the profile of each sample.
+        See _hclust.
+        """
+
+        if engine is None:
+            engine = self.engine
+
+        if linkage_method is None:
+            linkage_method = self.linkage_method
+
+        if cutoff is None:
+            cutoff = self.cutoff
+
+        engine_cutoff = self._engine_cutoff(engine, cutoff)
+
+        key = (threshold, clustering_method, linkage_method, engine,
+               engine_cutoff)
+        if key not in self._tree_cache:
+            onehot = self._binned(threshold)[0]
+            self._tree_cache[key] = self._linkage(
+                onehot,
+                clustering_method,
+                engine,
+                linkage_method,
+                engine_cutoff
+            )
+
+        return self._tree_cache[key]
+
+    def _linkage(self, onehot, clustering_method, engine, linkage_method,
+                 engine_cutoff=None):
+        """ Cluster the rows of a one-hot matrix. See _hclust.
+
+        engine_cutoff is the cutoff to tune the "minhash" engine for,
+        see _engine_cutoff.
+
+        Returns:
+        A tuple of a scipy linkage array and the profile of each sample.
+        """
+
+        profiles, representatives = self._unique_rows(onehot)
+        matrix = onehot[representatives]
+
+        # Average linkage needs to know how many samples share each profile.
+        counts = np.bincount(profiles)
+
+        if len(representatives) < 2:
+            # Nothing to cluster, all samples are identical.
+            tree = np.zeros((0, 4), dtype=np.float64)
+        elif engine == "minhash":
+            options = dict(self.engine_options or {})
+            options["cutoff"] = engine_cutoff
+            tree = approximate_linkage(
+                matrix,
+                metric=clustering_method,
+                method=linkage_method,
+                counts=counts,
+                **options
+            )
+        elif linkage_method == "single":
+            tree = mst_single_linkage(matrix, metric=clustering_method)
+        elif self.low_memory:
+            tree = self._hclust_on_disk(
+                matrix,
+                clustering_method,
+                linkage_method,
+                counts
+            )
+        else:
+            distances = pdist(
+                matrix,
+                metric=clustering_method,
+                n_jobs=self.n_jobs
+            )
+
+            if linkage_method == "average" and counts.max() > 1:
+                # scipy can't weight the profiles by their counts. It is
+                # faster though, so it is still used when all are unique.
+                tree = nn_chain(distances, method="average", counts=counts)
+            else:
+                tree = linkage(distances, method=linkage_method)
+
+        return self._expand_linkage(tree, profiles), profiles
+
+    def _hclust_on_disk(self, matrix, clustering_method,
+                        linkage_method="complete", counts=None):
+        """ Cluster using float32 distances in a temporary memory mapped file.
+
+        The linkage works in place on the file, so the distances are never
+        held in memory as a whole. Results are the same as in memory except
+        where distances only differ beyond float32 precision.
+
+        Keyword arguments:
+        matrix -- A sparse one-hot matrix of the profiles to cluster.
+        clustering_method -- See _hclust.
+        linkage_method -- See __init__.
+        counts -- The number of samples with each profile.
+
+        Returns:
+        A scipy linkage array.
+        """
+
+        size = condensed_size(matrix.shape[0])
+        if size == 0:
+            raise ValueError(
+                "At least two samples are needed to cluster."
+            )
+
+        with tempfile.TemporaryDirectory(dir=self.temp_dir) as tmpdir:
+            distances = np.memmap(
+                pjoin(tmpdir, "distances.float32"),
+                dtype=np.float32,
+                mode="w+",
+                shape=(size, )
+            )
+
+            pdist(
+                matrix,
+                metric=clustering_method,
+                out=distances,
+                n_jobs=self.n_jobs
+            )
+            tree = nn_chain(
+                distances,
+                method=linkage_method,
+                counts=counts
+            )
+
+            # Close the file before the directory is removed.
+            del distances
+
+        return tree
+
+    @staticmethod
+    def _unique_rows(matrix):
+        """ Find the unique rows of a sparse presence-absence matrix.
+
+        Keyword arguments:
+        matrix -- A scipy sparse matrix.
+
+        Returns:
+        codes -- An array with the unique row number of each row.
+        representatives -- The index of the first occurrence of each unique
+            row, in ascending order.
+        """
+
+        matrix = matrix.tocsr()
+        if not matrix.has_sorted_indices:
+            matrix = matrix.sorted_indices()
+
+        indices = matrix.indices
+        indptr = matrix.indptr
+        keys = pd.Series(
+            [
+                indices[start:stop].tobytes()
+                for start, stop
+                in zip(indptr[:-1], indptr[1:])
+            ],
+            dtype=object
+        )
+
+        # Codes are numbered in order of first appearance.
+        codes, _ = pd.factorize(keys)
+        _, representatives = np.unique(codes, return_index=True)
+        return codes, representatives
+
+    @staticmethod
+    def _expand_linkage(tree, codes):
+        """ Expand a linkage of unique profiles to a linkage of all samples.
+
+        Samples sharing a profile are merged first at a distance of 0, in
+        order of their index. The profile merges then follow, in order.
+
+        Keyword arguments:
+        tree -- A scipy linkage array of the unique profiles.
+        codes -- The profile number of each sample, as from _unique_rows.
+
+        Returns:
+        A scipy linkage array with a leaf for each sample.
+        """
+
+        n = len(codes)
+        n_profiles = tree.shape[0] + 1
+        expanded = np.zeros((max(n - 1, 0), 4), dtype=np.float64)
+
+        # The cluster containing all samples with each profile so far.
+        cluster_ids = np.zeros(n_profiles, dtype=np.int64)
+        sizes = np.ones(2 * n - 1, dtype=np.float64)
+
+        order = np.argsort(codes, kind="stable")
+        group_starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+        groups = np.split(order, group_starts[1:])
+
+        step = 0
+        for profile, members in zip(codes[order[group_starts]], groups):
+            current = members[0]
+            for member in members[1:]:
+                new = n + step
+                sizes[new] = sizes[current] + 1
+                expanded[step] = (
+                    min(current, member),
+                    max(current, member),
+                    0.0,
+                    sizes[new]
+                )
+
+                current = new
+                step += 1
+
+            cluster_ids[profile] = current
+
+        # Profile merges refer to earlier merges as n_profiles + i.
+        offset = n + step - n_profiles
+        for left, right, distance, _ in tree:
+            left = int(left)
+            right = int(right)
+            left = cluster_ids[left] if left < n_profiles else left + offset
+            right = (
+                cluster_ids[right] if right < n_profiles else right + offset
+            )
+
+            new = n + step
+            sizes[new] = sizes[left] + sizes[right]
+            expanded[step] = (
+                min(left, right),
+                max(left, right),
+                distance,
+                sizes[new]
+            )
+            step += 1
+
+        return expanded
+
     def cut_tree(self, cutoff=None):
         """ Selects clusters from the clustered tree based on distance.
 
@@ -239,13 +799,20 @@ class Tree(object):
         cutoff -- A float, see __init__ for details.
         If None inherits from object.
 
+        If the tree is from the "minhash" engine and was tuned for a smaller
+        cutoff, it is rebuilt for this one first.
+
         Uses:
         self.cutoff
         self.tree
+        self.low_memory
 
         Modified:
+        self.tree, self.profiles -- If the tree is rebuilt.
         self.clusters -- An array corresponding to the clusters.
         Will be the same length as the number of unique samples.
+        self.cluster_map -- A dictionary of sample names to clusters.
+        The cluster index, see _index_clusters.
         """
 
         if cutoff is None:
@@ -253,12 +820,227 @@ class Tree(object):
         else:
             self.cutoff = cutoff
 
-        self.clusters = fcluster(self.tree, cutoff, criterion='distance')
-        self.cluster_map = dict(zip(list(self.onehot_df.index), self.clusters))
+        if self._tree_cutoff is not None and cutoff > self._tree_cutoff:
+            self._hclust(cutoff=cutoff)
+
+        self.clusters = self._fcluster(self.tree, cutoff)
+        self.cluster_map = dict(zip(self.onehot_index.tolist(), self.clusters))
+        self._index_clusters()
         return
 
+    def _index_clusters(self):
+        """ Index the rows and bins of each cluster for fast lookups.
+
+        Uses:
+        self.onehot
+        self.clusters
+
+        Modifies:
+        self._cluster_positions -- A dictionary of cluster labels to their
+            position in sorted order.
+        self._cluster_order -- The rows in self.onehot, grouped by cluster
+            in sorted order, and in row order within clusters.
+        self._cluster_starts -- Where each cluster's rows start in
+            _cluster_order, followed by the number of rows.
+        self._bin_frequencies -- See bin_frequencies. Its rows also give the
+            bins present in each cluster.
+        self._figure_cache -- Emptied, as the figures are for old clusters.
+        """
+
+        order = np.argsort(self.clusters, kind="stable")
+        labels, starts = np.unique(self.clusters[order], return_index=True)
+        starts = np.append(starts, len(order))
+
+        self._cluster_positions = {
+            label: position
+            for position, label
+            in enumerate(labels.tolist())
+        }
+        self._cluster_order = order
+        self._cluster_starts = starts
+
+        # Rows of the indicator matrix select the samples in each cluster.
+        indicator = csr_matrix(
+            (np.ones(len(order), dtype=np.int64), order, starts),
+            shape=(len(labels), len(order))
+        )
+
+        counts = indicator @ self.onehot.astype(np.int64)
+        counts.sort_indices()
+
+        # Divide each row by its cluster size.
+        frequencies = counts.astype(np.float64)
+        frequencies.data /= np.repeat(
+            np.diff(starts),
+            np.diff(frequencies.indptr)
+        )
+        self._bin_frequencies = frequencies
+
+        for fig, _ in self._figure_cache.values():
+            plt.close(fig)
+        self._figure_cache = OrderedDict()
+        return
+
+    def _fcluster(self, tree, cutoff):
+        """ Cut a linkage array into flat clusters at a distance cutoff. """
+
+        if len(tree) == 0:
+            # A single sample, or all samples identical.
+            return np.ones(tree.shape[0] + 1, dtype=np.int32)
+
+        if self.low_memory:
+            # Tree heights are float32, so merges exactly at the cutoff
+            # (e.g. a jaccard distance of 3/5) must be compared at the same
+            # precision to be kept together.
+            cutoff = float(np.float32(cutoff))
+
+        return fcluster(tree, cutoff, criterion='distance')
+
+    def sweep(self, cutoffs=None, thresholds=None, methods=None,
+              linkage_methods=None):
+        """ Summarise the clusters formed by combinations of parameters.
+
+        The fitted data is re-binned once per threshold and re-clustered once
+        per threshold and method. These are memoised, so repeated sweeps
+        only re-cut the trees. The fitted tree and clusters are unchanged.
+        The "minhash" engine builds its trees for the largest cutoff.
+
+        Keyword arguments:
+        cutoffs -- A list of cutoffs to cut the trees at. See __init__.
+            If None, uses self.cutoff.
+        thresholds -- A list of thresholds to bin mz values with.
+            See __init__. If None, uses self.threshold.
+        methods -- A list of distance metrics to cluster with, i.e.
+            "jaccard" and/or "braycurtis". If None, uses
+            self.clustering_method.
+        linkage_methods -- A list of linkage methods to cluster with.
+            See __init__. If None, uses self.linkage_method.
+
+        Uses:
+        self._mz, self._sample_codes, self._samples -- The sorted mz values
+            and their samples, set by fit. See _binned.
+        self.engine, self.engine_options, self.n_jobs, self.low_memory,
+            self.temp_dir -- How the trees are built. See _linked.
+
+        Modifies:
+        self._onehot_cache, self._tree_cache -- The memoised binnings and
+            trees.
+
+        Returns:
+        A pandas dataframe with a row per combination of parameters, with
+        columns threshold, clustering_method, linkage_method, cutoff, n_bins,
+        n_clusters, n_singletons, largest_cluster and mean_cluster_size.
+        """
+
+        cutoffs = self._as_list(cutoffs, self.cutoff)
+        thresholds = self._as_list(thresholds, self.threshold)
+        methods = self._as_list(methods, self.clustering_method)
+        linkage_methods = self._as_list(linkage_methods, self.linkage_method)
+
+        rows = []
+        for threshold in thresholds:
+            n_bins = self._binned(threshold)[0].shape[1]
+
+            for method in methods:
+                for linkage_method in linkage_methods:
+                    tree, _ = self._linked(
+                        threshold,
+                        method,
+                        linkage_method=linkage_method,
+                        cutoff=max(cutoffs)
+                    )
+
+                    for cutoff in cutoffs:
+                        clusters = self._fcluster(tree, cutoff)
+                        sizes = np.bincount(clusters)[1:]
+                        sizes = sizes[sizes > 0]
+
+                        rows.append((
+                            threshold,
+                            method,
+                            linkage_method,
+                            cutoff,
+                            n_bins,
+                            len(sizes),
+                            int(np.sum(sizes == 1)),
+                            int(sizes.max()),
+                            sizes.mean(),
+                        ))
+
+        return pd.DataFrame(rows, columns=[
+            "threshold",
+            "clustering_method",
+            "linkage_method",
+            "cutoff",
+            "n_bins",
+            "n_clusters",
+            "n_singletons",
+            "largest_cluster",
+            "mean_cluster_size",
+        ])
+
+    def compare_exact(self, cutoffs=None):
+        """ Compare the fitted engine's clusters with the exact engine's.
+
+        This computes the full distance matrix, so is only intended for
+        checking the "minhash" engine on small inputs. The approximate tree
+        is built for the largest cutoff, as in sweep.
+
+        Keyword arguments:
+        cutoffs -- A list of cutoffs to compare the clusters at.
+            If None, uses self.cutoff.
+
+        Returns:
+        A pandas dataframe with a row per cutoff, with columns cutoff,
+        n_clusters, n_clusters_exact, adjusted_rand_index, pair_precision
+        and pair_recall. Pair precision is the fraction of pairs of samples
+        clustered together that are also together in the exact clusters,
+        and pair recall the reverse.
+        """
+
+        cutoffs = self._as_list(cutoffs, self.cutoff)
+        threshold = self._binned_threshold
+        method = self.clustering_method
+
+        tree, _ = self._linked(threshold, method, cutoff=max(cutoffs))
+        exact, _ = self._linked(threshold, method, engine="exact")
+
+        rows = []
+        for cutoff in cutoffs:
+            row = {"cutoff": cutoff}
+            row.update(compare_clusters(
+                self._fcluster(tree, cutoff),
+                self._fcluster(exact, cutoff)
+            ))
+            rows.append(row)
+
+        return pd.DataFrame(rows, columns=[
+            "cutoff",
+            "n_clusters",
+            "n_clusters_exact",
+            "adjusted_rand_index",
+            "pair_precision",
+            "pair_recall",
+        ])
+
     @staticmethod
-    def _plot_bin_freqs(df, height=4.5, width_base=1, width_multiplier=0.2):
+    def _as_list(values, default):
+        """ Wrap single parameter values in a list, using default if None. """
+
+        if values is None:
+            return [default]
+        elif isinstance(values, str) or np.isscalar(values):
+            return [values]
+        return list(values)
+
+    @classmethod
+    def _plot_bin_freqs(
+        cls,
+        df,
+        height=4.5,
+        width_base=1,
+        width_multiplier=0.2
+    ):
         """ Plots barchart frequencies of mz bins in a cluster.
 
         Keyword arguments:
@@ -274,15 +1056,39 @@ class Tree(object):
         ax -- A matplotlib axis object, containing the barchart.
         """
 
-        frequencies = df.apply(lambda x: np.mean(x), axis=0)
+        return cls._plot_frequencies(
+            df.mean(axis=0),
+            height,
+            width_base,
+            width_multiplier
+        )
+
+    @staticmethod
+    def _plot_frequencies(
+        frequencies,
+        height=4.5,
+        width_base=1,
+        width_multiplier=0.2
+    ):
+        """ Plots a barchart of precomputed mz bin frequencies.
+
+        Keyword arguments:
+        frequencies -- A pandas series of frequencies indexed by bin name,
+            e.g. from _cluster_frequencies.
+        height, width_base, width_multiplier -- See _plot_bin_freqs.
 
-        width = width_base + width_multiplier * df.shape[1]
+        Returns:
+        fig -- A matplotlib figure object.
+        ax -- A matplotlib axis object, containing the barchart.
+        """
+
+        width = width_base + width_multiplier * frequencies.shape[0]
         fig, ax = plt.subplots(figsize=(width, height))
 
         xticks = np.arange(frequencies.shape[0])
-        xticklabels = df.columns.values
+        xticklabels = frequencies.index.values
 
-        ax.bar(xticks, frequencies)
+        ax.bar(xticks, frequencies.values)
         ax.set_xticks(xticks)
         ax.set_xticklabels(xticklabels, rotation=90)
         ax.set_ylabel("Frequency")
@@ -299,53 +1105,258 @@ class Tree(object):
         # any(axis=0) at least on sample has True value for each column.
         return table.loc[:, table.any(axis=0)]
 
-    def write_summaries(self, path="results"):
+    def write_summaries(
+        self,
+        path="results",
+        n_jobs=None,
+        progress=None,
+        file_format="xlsx",
+        wide_table=None,
+        sparse_matrix=None
+    ):
         """ Write summary tables and plots to a directory.
 
+        Each cluster gets a table and a bar chart of its bin frequencies,
+        named "cluster_{cluster}_{members}" so that the filenames don't
+        depend on the order they are written in.
+
         Keyword arguments:
         path -- The directory to write the output to. This directory must
         exist.
+        n_jobs -- The number of processes to write the cluster summaries
+            with. -1 uses all available cpus. If None, uses self.n_jobs.
+        progress -- An optional function called as progress(done, total)
+            after each cluster summary is written.
+        file_format -- The format to write tables in, one of "xlsx", "csv",
+            "parquet" or "feather". See BioDendro.output.
+        wide_table -- If True, write every sample and bin to a wide
+            "clusters" table, which is mostly False for large datasets.
+            Otherwise write the bins present in each sample to a long-form
+            "memberships" table, see write_memberships. If None, the wide
+            table is only written for "xlsx".
+        sparse_matrix -- Optionally also write the one-hot matrix as a
+            sparse matrix, either "mtx" or "npz". See write_sparse_matrix.
         """
 
-        df = self.onehot_df.copy()
-        clusters = self.clusters
+        check_format(file_format)
+        if sparse_matrix is not None:
+            check_sparse_format(sparse_matrix)
+
+        if n_jobs is None:
+            n_jobs = self.n_jobs
 
-        for cluster, subtab in df.groupby(clusters):
-            nmembers = subtab.shape[0]
+        if wide_table is None:
+            wide_table = file_format == "xlsx"
 
-            # Filter out columns that are all false for ease of visualisation.
-            subtab = self._exclude_false_columns(subtab)
+        clusters = self.clusters
+        labels = np.unique(clusters)
+        n_jobs = min(n_workers(n_jobs), len(labels))
 
-            csv_filename = pjoin(
+        # Columns that are all false are left out for ease of
+        # visualisation.
+        tasks = (
+            (
                 path,
-                "cluster_{}_{}.xlsx".format(cluster, nmembers)
+                label,
+                self._subtable(
+                    self._cluster_rows(label),
+                    self._cluster_columns(label)
+                ),
+                file_format,
+                self._cluster_frequencies(label)
             )
-            subtab.to_excel(csv_filename)
+            for label in labels
+        )
 
-            fig, ax = self._plot_bin_freqs(subtab)
-            fig.suptitle("Cluster {} with {} members".format(
-                cluster,
-                subtab.shape[0])
+        if n_jobs > 1:
+            self._write_summaries_parallel(
+                tasks,
+                len(labels),
+                n_jobs,
+                progress
             )
-            plt_filename = pjoin(
-                path,
-                "cluster_{}_{}.png".format(cluster, nmembers)
-            )
-            fig.savefig(plt_filename)
+        else:
+            for done, task in enumerate(tasks, 1):
+                _write_cluster_summary(*task)
+                if progress is not None:
+                    progress(done, len(labels))
+
+        if sparse_matrix is not None:
+            self.write_sparse_matrix(path, sparse_matrix, file_format)
+
+        if not wide_table:
+            self.write_memberships(path, file_format)
+            return
+
+        # Build a new table rather than copying onehot_df, which would
+        # otherwise be kept alongside it.
+        df = self._onehot_frame(
+            self.onehot,
+            self.onehot_index,
+            self.bin_labels(self.onehot_columns),
+            self.sample_col
+        )
+        df.insert(0, "cluster", clusters)
+        write_table(
+            df,
+            table_filename(path, "clusters", file_format),
+            file_format
+        )
+        return
 
-            # Prevents plotting these plots in interactive mode.
-            plt.close()
+    def membership_table(self):
+        """ A long-form table of the bins present in each sample.
 
-        filename = pjoin(path, "clusters.xlsx")
-        df["cluster"] = clusters
-        df = df[["cluster"] + [c for c in df.columns if c != "cluster"]]
-        df.to_excel(filename)
+        There is a row for each bin in each sample, so the table grows with
+        the number of ions rather than with samples times bins.
+
+        Returns:
+        pd.DataFrame with columns for the sample, "cluster", "bin",
+        "mz_mean", "mz_min" and "mz_max". The bins are categorical, with
+        categories in m/z order.
+        """
+
+        matrix = self.onehot
+        rows = np.repeat(
+            np.arange(matrix.shape[0]),
+            np.diff(matrix.indptr)
+        )
+
+        codes, names = pd.factorize(self.bin_labels(self.onehot_columns))
+        stats = self.bin_stats.iloc[self.onehot_columns[matrix.indices]]
+
+        table = pd.DataFrame({
+            self.sample_col: self.onehot_index[rows],
+            "cluster": self.clusters[rows],
+            "bin": pd.Categorical.from_codes(codes[matrix.indices], names),
+        })
+
+        for column in ("mz_mean", "mz_min", "mz_max"):
+            table[column] = stats[column].values
+        return table
+
+    def write_memberships(self, path="results", file_format="csv"):
+        """ Write the long-form membership table to a directory.
+
+        Keyword arguments:
+        path -- The directory to write "memberships.<file_format>" to.
+        file_format -- See BioDendro.output.write_table.
+
+        Uses:
+        membership_table
+        """
+
+        write_table(
+            self.membership_table(),
+            table_filename(path, "memberships", file_format),
+            file_format,
+            index=False
+        )
+        return
+
+    def write_sparse_matrix(
+        self,
+        path="results",
+        sparse_format="npz",
+        file_format="csv"
+    ):
+        """ Write the one-hot matrix of samples vs bins as a sparse matrix.
+
+        Writes three files to path:
+        onehot.<sparse_format> -- The presence-absence matrix.
+        onehot_samples.<file_format> -- The sample and cluster of each row.
+        onehot_bins.<file_format> -- The name, mean, min and max mz of each
+            column.
+
+        Keyword arguments:
+        path -- The directory to write the output to.
+        sparse_format -- Either "mtx" for Matrix Market, or "npz".
+            See BioDendro.output.write_sparse_matrix.
+        file_format -- The format to write the row and column tables in.
+        """
+
+        check_sparse_format(sparse_format)
+
+        write_sparse_matrix(
+            self.onehot,
+            pjoin(path, "onehot.{}".format(sparse_format)),
+            sparse_format
+        )
+
+        samples = pd.DataFrame({
+            self.sample_col: self.onehot_index,
+            "cluster": self.clusters,
+        })
+        write_table(
+            samples,
+            table_filename(path, "onehot_samples", file_format),
+            file_format,
+            index=False
+        )
+
+        bins = self.bin_stats.iloc[self.onehot_columns].reset_index(drop=True)
+        bins.insert(0, "bin", self.bin_labels(self.onehot_columns))
+        write_table(
+            bins,
+            table_filename(path, "onehot_bins", file_format),
+            file_format,
+            index=False
+        )
+        return
+
+    @staticmethod
+    def _write_summaries_parallel(tasks, total, n_jobs, progress=None):
+        """ Write cluster summaries in a process pool.
+
+        Only a few tables per worker are queued at a time, so the tables
+        for every cluster are never held in memory together.
+
+        Keyword arguments:
+        tasks -- An iterable of (path, cluster, table) tuples.
+        total -- The number of tasks.
+        n_jobs -- The number of processes to use.
+        progress -- See write_summaries.
+        """
+
+        tasks = iter(tasks)
+        max_pending = n_jobs * _SUMMARIES_PER_WORKER
+        done = 0
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            pending = set()
+            for task in tasks:
+                pending.add(executor.submit(_write_cluster_summary, *task))
+                if len(pending) < max_pending:
+                    continue
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # Raises any errors from the worker.
+                    future.result()
+                    done += 1
+                    if progress is not None:
+                        progress(done, total)
+
+            for future in wait(pending).done:
+                future.result()
+                done += 1
+                if progress is not None:
+                    progress(done, total)
         return
 
     def cluster_table(self, cluster=None, sample=None):
         """ Return a table of presence-absence metabolites for a given cluster.
         """
 
+        cluster = self._cluster_label(cluster, sample)
+        return self._subtable(
+            self._cluster_rows(cluster),
+            self._cluster_columns(cluster)
+        )
+
+    def _cluster_label(self, cluster=None, sample=None):
+        """ Get the cluster label from either a cluster or a sample name. """
+
         if cluster is None and sample is None:
             raise ValueError("Either cluster or sample must be set.")
         elif cluster is not None and sample is not None:
@@ -356,8 +1367,95 @@ class Tree(object):
             except KeyError:
                 raise KeyError("The sample you provided isn't in the dataset.")
 
-        subtab = self.onehot_df.loc[self.clusters == cluster]
-        return self._exclude_false_columns(subtab)
+        return cluster
+
+    def bin_frequencies(self):
+        """ The fraction of samples in each cluster that have each bin.
+
+        Computed for all clusters at once when the tree is cut, as a sparse
+        product of a cluster indicator matrix and the one-hot matrix.
+
+        Returns:
+        A scipy CSR matrix of float64 frequencies, with a row for each
+        cluster in sorted order, i.e. np.unique(self.clusters), and a column
+        for each bin in self.onehot_columns. Only bins present in a cluster
+        are stored.
+        """
+
+        return self._bin_frequencies
+
+    def _cluster_position(self, cluster):
+        """ The position of a cluster in sorted order. """
+
+        try:
+            return self._cluster_positions[cluster]
+        except KeyError:
+            raise KeyError("The cluster {} isn't in the dataset.".format(
+                cluster
+            ))
+
+    def _cluster_rows(self, cluster):
+        """ The rows in self.onehot of the samples in a cluster. """
+
+        position = self._cluster_position(cluster)
+        start, stop = self._cluster_starts[position:position + 2]
+        return self._cluster_order[start:stop]
+
+    def _cluster_bins(self, cluster):
+        """ A slice of the bins present in a cluster in bin_frequencies. """
+
+        position = self._cluster_position(cluster)
+        start, stop = self._bin_frequencies.indptr[position:position + 2]
+        return slice(start, stop)
+
+    def _cluster_columns(self, cluster):
+        """ The sorted one-hot columns of the bins present in a cluster. """
+        return self._bin_frequencies.indices[self._cluster_bins(cluster)]
+
+    def _cluster_frequencies(self, cluster):
+        """ The frequencies of the bins present in a cluster.
+
+        Returns:
+        pd.Series indexed by bin name, in m/z order.
+        """
+
+        bins = self._cluster_bins(cluster)
+        columns = self._bin_frequencies.indices[bins]
+
+        return pd.Series(
+            self._bin_frequencies.data[bins],
+            index=pd.Index(
+                self.bin_labels(self.onehot_columns[columns]),
+                name="bins"
+            )
+        )
+
+    def _subtable(self, rows, columns=None):
+        """ Dense presence-absence table for a subset of the one-hot rows.
+
+        Only bins present in at least one of the rows are kept, so only
+        those bins need names.
+
+        Keyword arguments:
+        rows -- An array of integer row positions in self.onehot.
+        columns -- The sorted column positions in self.onehot of the bins
+            present in these rows, e.g. from _cluster_columns. If None,
+            found from the rows.
+
+        Returns:
+        pd.DataFrame of booleans with samples as rows and bins as columns.
+        """
+
+        submatrix = self.onehot[rows]
+        if columns is None:
+            columns = np.unique(submatrix.indices)
+
+        return self._onehot_frame(
+            submatrix[:, columns],
+            self.onehot_index[rows],
+            self.bin_labels(self.onehot_columns[columns]),
+            self.sample_col
+        )
 
     def cluster_hist(
         self,
@@ -367,11 +1465,32 @@ class Tree(object):
         width_base=1,
         width_multiplier=0.15
     ):
-        """ Plot a histogram of metabolite frequencies in the data. """
+        """ Plot a histogram of metabolite frequencies in the data.
 
-        subtab = self.cluster_table(cluster, sample)
-        return self._plot_bin_freqs(subtab, height,
-                                    width_base, width_multiplier)
+        The most recently used figures are kept until the tree is cut again,
+        so the same figure is returned for repeated calls.
+        """
+
+        cluster = self._cluster_label(cluster, sample)
+        key = (cluster, height, width_base, width_multiplier)
+
+        if key in self._figure_cache:
+            self._figure_cache.move_to_end(key)
+            return self._figure_cache[key]
+
+        figure = self._plot_frequencies(
+            self._cluster_frequencies(cluster),
+            height,
+            width_base,
+            width_multiplier
+        )
+        self._figure_cache[key] = figure
+
+        if len(self._figure_cache) > _FIGURE_CACHE_SIZE:
+            fig, _ = self._figure_cache.popitem(last=False)[1]
+            plt.close(fig)
+
+        return figure
 
     def plot(
         self,
@@ -402,9 +1521,11 @@ class Tree(object):
         """
 
         title = (
-            "Component clusters. method = {}, cutoff = {}, threshold = {}"
+            "Component clusters. method = {}, linkage = {}, cutoff = {}, "
+            "threshold = {}"
         ).format(
             self.clustering_method,
+            self.linkage_method,
             self.cutoff,
             self.threshold,
         )
@@ -426,3 +1547,42 @@ class Tree(object):
             )
 
         return dendro
+
+
+def _write_cluster_summary(
+    path,
+    cluster,
+    subtab,
+    file_format="xlsx",
+    frequencies=None
+):
+    """ Write the table and bar chart for a single cluster.
+
+    Module level so that it can be run in a process pool.
+
+    Keyword arguments:
+    path -- The directory to write the output to.
+    cluster -- The cluster label.
+    subtab -- The presence-absence table of the cluster's members, as from
+        Tree.cluster_table.
+    file_format -- The format to write the table in.
+        See BioDendro.output.write_table.
+    frequencies -- The frequencies of the bins in subtab, as from
+        Tree._cluster_frequencies. If None, computed from subtab.
+    """
+
+    nmembers = subtab.shape[0]
+    name = "cluster_{}_{}".format(cluster, nmembers)
+
+    write_table(subtab, table_filename(path, name, file_format), file_format)
+
+    if frequencies is None:
+        fig, ax = Tree._plot_bin_freqs(subtab)
+    else:
+        fig, ax = Tree._plot_frequencies(frequencies)
+    fig.suptitle("Cluster {} with {} members".format(cluster, nmembers))
+    fig.savefig(pjoin(path, name + ".png"))
+
+    # Prevents plotting these plots in interactive mode.
+    plt.close(fig)
+    return
@@ -0,0 +1,424 @@
+"""
+Module distance computes pairwise distances between the rows of sparse
+presence-absence matrices, as used to cluster the binned mass spec data.
+
+Rows are treated as sets of bins, so distances only depend on the number of
+bins each row has and the number of bins they share. These counts come from
+sparse matrix products, so the work scales with the number of non-zero
+elements rather than with the number of components times the number of bins.
+"""
+
+import mmap
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from BioDendro.parallel import n_workers
+
+METRICS = ("jaccard", "braycurtis")
+
+# Roughly how many dense elements of intersection counts to hold at a time.
+_BLOCK_ELEMENTS = 2 ** 22
+
+# How many row blocks to give each worker, so that they finish together.
+_BLOCKS_PER_WORKER = 4
+
+# How many finished blocks per worker may wait to be copied into the output.
+_PENDING_PER_WORKER = 2
+
+# The state of a worker process, set by _init_worker.
+_WORKER = {}
+
+
+def _check_metric(metric):
+    """ Raise a ValueError if the distance metric isn't supported. """
+
+    if metric not in METRICS:
+        raise ValueError(
+            "Unsupported distance metric {}. Must be one of {}."
+            .format(repr(metric), ", ".join(METRICS))
+        )
+    return
+
+
+def condensed_size(n):
+    """ The length of a condensed distance vector for n observations. """
+    return n * (n - 1) // 2
+
+
+def _condensed_offset(i, n):
+    """ Position of the pair (i, i + 1) in a condensed distance vector. """
+    return i * n - i * (i + 1) // 2
+
+
+def _block_size(n, block_size=None):
+    """ Choose the number of rows to compute at a time. """
+
+    if block_size is None:
+        block_size = _BLOCK_ELEMENTS // max(n, 1)
+
+    return max(1, int(block_size))
+
+
+def _as_counts(matrix):
+    """ Convert a presence-absence matrix to a CSR matrix of int32 ones. """
+
+    matrix = csr_matrix(matrix, copy=True)
+    matrix.eliminate_zeros()
+    matrix.data = np.ones(len(matrix.data), dtype=np.int32)
+    return matrix
+
+
+def _from_counts(intersection, total, metric):
+    """ Compute distances from intersection counts and total set sizes.
+
+    Keyword arguments:
+    intersection -- An array of shared bin counts, |A and B|.
+    total -- An array of summed bin counts, |A| + |B|. Must broadcast
+        with intersection.
+    metric -- Either "jaccard" or "braycurtis".
+
+    Returns:
+    A float64 array. Pairs of empty rows have a distance of 0.
+    """
+
+    intersection = np.asarray(intersection, dtype=np.float64)
+    total = np.array(total, dtype=np.float64)
+
+    # Numerator is |A xor B|.
+    numerator = total - 2 * intersection
+
+    if metric == "jaccard":
+        # Divide by |A or B|.
+        total = total - intersection
+
+    # For Bray-Curtis, divide by |A| + |B|.
+    np.divide(numerator, total, out=numerator, where=total > 0)
+    numerator[total == 0] = 0
+    return numerator
+
+
+def _distances(intersection, sums_a, sums_b, metric):
+    """ Compute distances from intersection counts and row sums.
+
+    Keyword arguments:
+    intersection -- A dense 2D array of shared bin counts.
+    sums_a -- The number of bins in each row of the block.
+    sums_b -- The number of bins in each column of the block.
+    metric -- Either "jaccard" or "braycurtis".
+
+    Returns:
+    A 2D float64 array with the same shape as intersection.
+    Pairs of empty rows have a distance of 0.
+    """
+
+    total = (
+        sums_a[:, np.newaxis].astype(np.float64)
+        + sums_b[np.newaxis, :].astype(np.float64)
+    )
+    return _from_counts(intersection, total, metric)
+
+
+def _rows_distances(matrix, sums, start, stop, metric):
+    """ Compute the condensed distances of rows start to stop.
+
+    Only pairs (i, j) with start <= i < stop and j > i are computed. These
+    are contiguous in the condensed distance vector.
+
+    Keyword arguments:
+    matrix -- A CSR matrix of int32 ones, as from _as_counts.
+    sums -- The number of non-zero elements in each row of matrix.
+    start, stop -- The range of rows to compute.
+    metric -- Either "jaccard" or "braycurtis".
+
+    Returns:
+    A float64 array of the distances, in condensed order.
+    """
+
+    # Only the upper triangle is needed, so columns before start are skipped.
+    intersection = (matrix[start:stop] @ matrix[start:].T).toarray()
+    block = _distances(intersection, sums[start:stop], sums[start:], metric)
+
+    upper = (
+        np.arange(block.shape[1])[np.newaxis, :]
+        > np.arange(block.shape[0])[:, np.newaxis]
+    )
+    return block[upper]
+
+
+def _fill_rows(matrix, sums, start, stop, metric, out):
+    """ Write the condensed distances of rows start to stop into out.
+
+    Keyword arguments:
+    matrix, sums, start, stop, metric -- See _rows_distances.
+    out -- The full condensed distance vector to write into.
+
+    Modifies:
+    out
+    """
+
+    n = matrix.shape[0]
+    offset = _condensed_offset(start, n)
+    out[offset:_condensed_offset(stop, n)] = _rows_distances(
+        matrix,
+        sums,
+        start,
+        stop,
+        metric
+    )
+    return
+
+
+def _row_blocks(n, block_size, n_blocks=1):
+    """ Split n rows into ranges with similar numbers of pairs to compute.
+
+    Row i is paired with the n - i - 1 rows after it, so early blocks have
+    fewer rows than later ones.
+
+    Keyword arguments:
+    n -- The number of rows.
+    block_size -- The maximum number of rows in a block.
+    n_blocks -- The number of blocks to balance the pairs over. Blocks larger
+        than block_size are split further.
+
+    Returns:
+    A list of (start, stop) tuples.
+    """
+
+    if n == 0:
+        return []
+
+    # The number of pairs computed up to and including each row.
+    pairs = np.cumsum(np.arange(n - 1, -1, -1, dtype=np.int64))
+    targets = pairs[-1] * np.arange(1, n_blocks) / n_blocks
+    bounds = np.unique(np.concatenate([
+        [0],
+        np.searchsorted(pairs, targets, side="right"),
+        [n],
+    ]))
+
+    blocks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        for substart in range(start, stop, block_size):
+            substop = min(substart + block_size, stop)
+            blocks.append((int(substart), int(substop)))
+
+    return blocks
+
+
+def _init_worker(matrix, sums, metric, buffer=None):
+    """ Set up the state of a worker process.
+
+    Keyword arguments:
+    matrix, sums, metric -- See _rows_distances.
+    buffer -- Either None to send distances back to the main process, or
+        (filename, dtype, size, offset) to write them to a numpy.memmap.
+    """
+
+    if buffer is None:
+        out = None
+    else:
+        filename, dtype, size, offset = buffer
+        out = np.memmap(
+            filename,
+            dtype=dtype,
+            mode="r+",
+            shape=(size, ),
+            offset=offset
+        )
+
+    _WORKER["matrix"] = matrix
+    _WORKER["sums"] = sums
+    _WORKER["metric"] = metric
+    _WORKER["out"] = out
+    return
+
+
+def _fill_rows_worker(block):
+    """ Compute a block of rows in a worker process.
+
+    Returns:
+    None if the distances were written to the worker's memmap, otherwise
+    (start, stop, distances).
+    """
+
+    start, stop = block
+    if _WORKER["out"] is not None:
+        _fill_rows(
+            _WORKER["matrix"],
+            _WORKER["sums"],
+            start,
+            stop,
+            _WORKER["metric"],
+            _WORKER["out"]
+        )
+        return None
+
+    distances = _rows_distances(
+        _WORKER["matrix"],
+        _WORKER["sums"],
+        start,
+        stop,
+        _WORKER["metric"]
+    )
+    return start, stop, distances
+
+
+def _is_file_backed(out):
+    """ Check if an array is a whole numpy.memmap that workers can reopen.
+
+    Slices of a memmap keep the filename but not the correct offset,
+    so they are filled by the main process instead.
+    """
+
+    return (
+        isinstance(out, np.memmap)
+        and out.filename is not None
+        and isinstance(out.base, mmap.mmap)
+    )
+
+
+def _fill_parallel(matrix, sums, metric, blocks, n_jobs, out):
+    """ Compute row blocks in a process pool and write them into out.
+
+    If out is a numpy.memmap, the workers write to the file directly.
+    Otherwise they send each block back to be copied into out. Only a few
+    blocks per worker are kept waiting, so no second copy of the distances
+    is ever held in memory.
+
+    Modifies:
+    out
+    """
+
+    n = matrix.shape[0]
+
+    if _is_file_backed(out):
+        out.flush()
+        buffer = (out.filename, out.dtype, len(out), out.offset)
+    else:
+        buffer = None
+
+    def copy(futures):
+        for future in futures:
+            result = future.result()
+            if result is not None:
+                start, stop, distances = result
+                offset = _condensed_offset(start, n)
+                out[offset:_condensed_offset(stop, n)] = distances
+        return
+
+    max_pending = n_jobs * _PENDING_PER_WORKER
+
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_worker,
+        initargs=(matrix, sums, metric, buffer)
+    ) as executor:
+        pending = set()
+        for block in blocks:
+            pending.add(executor.submit(_fill_rows_worker, block))
+            if len(pending) >= max_pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                copy(finished)
+
+        copy(wait(pending).done)
+    return
+
+
+def pdist(matrix, metric="jaccard", block_size=None, out=None, n_jobs=1):
+    """ Pairwise distances between the rows of a presence-absence matrix.
+
+    Equivalent to scipy.spatial.distance.pdist on the dense boolean matrix,
+    except that pairs of empty rows have a distance of 0.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix or array. Non-zero elements are
+        treated as present.
+    metric -- The distance metric to use, either "jaccard" or "braycurtis".
+    block_size -- The number of rows to compute at a time. Larger blocks
+        use more memory. If None, chosen from the number of rows.
+    out -- An optional array to write the condensed distances into.
+        May be a numpy.memmap with a smaller float type, e.g. to keep very
+        large distance matrices on disk.
+    n_jobs -- The number of processes to compute blocks of rows with.
+        -1 uses all available cpus.
+
+    Returns:
+    A condensed distance vector, suitable for
+    scipy.cluster.hierarchy.linkage.
+    """
+
+    _check_metric(metric)
+
+    matrix = _as_counts(matrix)
+    n = matrix.shape[0]
+    sums = np.diff(matrix.indptr).astype(np.int64)
+
+    if out is None:
+        out = np.empty(condensed_size(n), dtype=np.float64)
+    elif len(out) != condensed_size(n):
+        raise ValueError(
+            "The output array must have length {}, but has length {}."
+            .format(condensed_size(n), len(out))
+        )
+
+    block_size = _block_size(n, block_size)
+    n_jobs = n_workers(n_jobs)
+
+    if n_jobs > 1:
+        blocks = _row_blocks(n, block_size, n_jobs * _BLOCKS_PER_WORKER)
+    else:
+        blocks = _row_blocks(n, block_size)
+
+    if n_jobs > 1 and len(blocks) > 1:
+        _fill_parallel(matrix, sums, metric, blocks, n_jobs, out)
+    else:
+        for start, stop in blocks:
+            _fill_rows(matrix, sums, start, stop, metric, out)
+
+    return out
+
+
+def paired_distances(matrix, rows, columns, metric="jaccard", chunk_size=None):
+    """ Distances between selected pairs of rows of a presence-absence matrix.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix or array. Non-zero elements are
+        treated as present.
+    rows, columns -- Arrays of row indices. Distances are computed between
+        rows[k] and columns[k] for each k.
+    metric -- The distance metric to use, either "jaccard" or "braycurtis".
+    chunk_size -- The number of pairs to compute at a time. If None, chosen
+        from the number of bins per row.
+
+    Returns:
+    A float64 array with a distance for each pair.
+    """
+
+    _check_metric(metric)
+
+    matrix = _as_counts(matrix)
+    sums = np.diff(matrix.indptr).astype(np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+
+    if chunk_size is None:
+        mean_bins = max(matrix.nnz / max(matrix.shape[0], 1), 1)
+        chunk_size = _BLOCK_ELEMENTS // int(np.ceil(mean_bins))
+
+    chunk_size = max(1, int(chunk_size))
+
+    out = np.empty(len(rows), dtype=np.float64)
+    for start in range(0, len(rows), chunk_size):
+        stop = min(start + chunk_size, len(rows))
+        left = matrix[rows[start:stop]]
+        right = matrix[columns[start:stop]]
+
+        intersection = np.asarray(left.multiply(right).sum(axis=1)).ravel()
+        total = sums[rows[start:stop]] + sums[columns[start:stop]]
+        out[start:stop] = _from_counts(intersection, total, metric)
+
+    return out
@@ -0,0 +1,477 @@
+"""
+Module linkage contains a hierarchical clustering implementation that
+works in place on a condensed distance vector.
+
+scipy.cluster.hierarchy.linkage always copies the distances to a new float64
+array. This implementation accepts any array with the condensed layout,
+including a float32 numpy.memmap on disk, so that very large component lists
+can be clustered without holding the distances in memory twice.
+
+The algorithm is the nearest-neighbour chain algorithm used by scipy, and it
+resolves ties in the same way, so the linkage matrices are the same as
+scipy's for the same distances.
+
+It also contains a linkage for sparse graphs of distances, where pairs
+without an edge are taken to be at the maximum distance, with the same
+tie-breaking, and a single linkage that computes distances from the
+features as it needs them.
+"""
+
+import numpy as np
+
+from BioDendro.distance import _as_counts
+from BioDendro.distance import _check_metric
+from BioDendro.distance import _from_counts
+
+METHODS = ("single", "complete", "average", "weighted")
+
+
+def _check_method(method):
+    """ Raise a ValueError if the linkage method isn't supported. """
+
+    if method not in METHODS:
+        raise ValueError(
+            "Unsupported linkage method {}. Must be one of {}."
+            .format(repr(method), ", ".join(METHODS))
+        )
+    return
+
+
+def num_observations(distances):
+    """ Get the number of observations from a condensed distance vector. """
+
+    m = len(distances)
+    n = int(np.ceil(np.sqrt(m * 2)))
+
+    if n * (n - 1) // 2 != m:
+        raise ValueError(
+            "The distance vector has length {}, which isn't a valid "
+            "condensed distance matrix.".format(m)
+        )
+    return n
+
+
+def _condensed_indices(n, x, others):
+    """ Positions of the distances between x and others in a condensed vector.
+
+    Keyword arguments:
+    n -- The number of observations.
+    x -- An observation index.
+    others -- An array of observation indices, not including x.
+
+    Returns:
+    np.array of int64.
+    """
+
+    others = np.asarray(others, dtype=np.int64)
+    i = np.minimum(others, x)
+    j = np.maximum(others, x)
+    return n * i - (i * (i + 1)) // 2 + (j - i - 1)
+
+
+def _update(method, d_x, d_y, size_x, size_y):
+    """ Lance-Williams update for the distances to a newly merged cluster.
+
+    Keyword arguments:
+    method -- The linkage method.
+    d_x -- Distances from the other clusters to cluster x.
+    d_y -- Distances from the other clusters to cluster y.
+    size_x, size_y -- The number of observations in clusters x and y.
+
+    Returns:
+    np.array of the distances from the other clusters to x merged with y.
+    """
+
+    if method == "single":
+        return np.minimum(d_x, d_y)
+    elif method == "complete":
+        return np.maximum(d_x, d_y)
+    elif method == "average":
+        return (size_x * d_x + size_y * d_y) / (size_x + size_y)
+    else:
+        # Weighted
+        return 0.5 * (d_x + d_y)
+
+
+def _update_scalar(method, d_x, d_y, size_x, size_y):
+    """ Lance-Williams update for single distances. See _update.
+
+    Uses python floats, which are much faster than numpy for scalars.
+    """
+
+    if method == "single":
+        return min(d_x, d_y)
+    elif method == "complete":
+        return max(d_x, d_y)
+    elif method == "average":
+        return (size_x * d_x + size_y * d_y) / (size_x + size_y)
+    else:
+        # Weighted
+        return 0.5 * (d_x + d_y)
+
+
+def _find(parent, x):
+    """ Find the root of x in a union-find forest, compressing the path. """
+
+    root = x
+    while parent[root] != root:
+        root = parent[root]
+
+    while parent[x] != root:
+        parent[x], x = root, parent[x]
+
+    return root
+
+
+def _initial_sizes(n, counts=None):
+    """ The starting size of each cluster, one per sample by default. """
+
+    if counts is None:
+        return np.ones(n, dtype=np.int64)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.shape != (n, ):
+        raise ValueError(
+            "Expected {} counts, but got {}.".format(n, len(counts))
+        )
+    return counts.copy()
+
+
+def _label(merges, n, sizes=None):
+    """ Relabel sorted merges with scipy's cluster numbering.
+
+    Merges refer to clusters by the index of one of their observations.
+    Linkage matrices name the cluster formed at step i as n + i instead.
+
+    Keyword arguments:
+    merges -- An (n - 1) x 4 array of merges, sorted by distance.
+    n -- The number of observations.
+    sizes -- The starting size of each observation. If None, all 1.
+
+    Modifies:
+    merges
+    """
+
+    parent = list(range(2 * n - 1))
+    sizes = _initial_sizes(n, sizes).tolist() + [0] * (n - 1)
+
+    for i in range(n - 1):
+        x = _find(parent, int(merges[i, 0]))
+        y = _find(parent, int(merges[i, 1]))
+
+        merges[i, 0] = min(x, y)
+        merges[i, 1] = max(x, y)
+
+        new = n + i
+        parent[x] = new
+        parent[y] = new
+        sizes[new] = sizes[x] + sizes[y]
+        merges[i, 3] = sizes[new]
+    return
+
+
+def nn_chain(distances, method="complete", counts=None):
+    """ Hierarchically cluster observations from their condensed distances.
+
+    The distances are overwritten while clustering, as clusters are merged.
+    Pass a copy if you need to keep them.
+
+    Keyword arguments:
+    distances -- A condensed distance vector, e.g. from
+        BioDendro.distance.pdist. May be any floating point numpy array,
+        including a numpy.memmap.
+    method -- The linkage method. One of "single", "complete", "average"
+        or "weighted".
+    counts -- The number of samples each observation stands for, e.g. when
+        identical samples are clustered once. Only affects "average"
+        linkage. If None, each observation is one sample.
+
+    Returns:
+    A linkage matrix in the same format as scipy.cluster.hierarchy.linkage.
+    """
+
+    _check_method(method)
+    n = num_observations(distances)
+
+    if n < 2:
+        raise ValueError("At least two observations are needed to cluster.")
+
+    merges = np.zeros((n - 1, 4), dtype=np.float64)
+    sizes = _initial_sizes(n, counts)
+
+    chain = []
+    for k in range(n - 1):
+        if len(chain) == 0:
+            chain.append(int(np.flatnonzero(sizes)[0]))
+
+        # Follow nearest neighbours until two clusters are each other's
+        # nearest neighbour.
+        while True:
+            x = chain[-1]
+            active = np.flatnonzero(sizes)
+            active = active[active != x]
+
+            row = distances[_condensed_indices(n, x, active)]
+            nearest = int(np.argmin(row))
+            current_min = row[nearest]
+            y = int(active[nearest])
+
+            # Prefer the previous element of the chain on ties, so that the
+            # chain always terminates.
+            if len(chain) > 1:
+                previous = chain[-2]
+                previous_dist = distances[
+                    _condensed_indices(n, x, [previous])[0]
+                ]
+
+                if previous_dist <= current_min:
+                    current_min = previous_dist
+                    y = previous
+                    break
+
+            chain.append(y)
+
+        del chain[-2:]
+
+        if x > y:
+            x, y = y, x
+
+        size_x = sizes[x]
+        size_y = sizes[y]
+        merges[k] = (x, y, current_min, size_x + size_y)
+
+        # The merged cluster takes the place of y.
+        sizes[x] = 0
+        sizes[y] = size_x + size_y
+
+        others = np.flatnonzero(sizes)
+        others = others[others != y]
+        if len(others) == 0:
+            continue
+
+        to_x = _condensed_indices(n, x, others)
+        to_y = _condensed_indices(n, y, others)
+        distances[to_y] = _update(
+            method,
+            distances[to_x],
+            distances[to_y],
+            size_x,
+            size_y
+        )
+
+    # The chain finds merges out of order, so sort them by distance.
+    # Mergesort is stable, which keeps ties in the order they were found.
+    order = np.argsort(merges[:, 2], kind="mergesort")
+    merges = merges[order]
+    _label(merges, n, sizes=_initial_sizes(n, counts))
+    return merges
+
+
+def sparse_linkage(n, rows, columns, distances, method="complete",
+                   max_distance=1.0, counts=None):
+    """ Hierarchically cluster observations from a sparse graph of distances.
+
+    Pairs of observations without an edge are taken to be max_distance
+    apart, and edges at or above max_distance are ignored. This uses the
+    same nearest-neighbour chain as nn_chain, following the edges of each
+    cluster rather than a row of the distance matrix. If the graph contains
+    every pair closer than max_distance, the result is the same as nn_chain
+    and scipy give for the full distance matrix, ties included.
+
+    Keyword arguments:
+    n -- The number of observations.
+    rows, columns -- Arrays of observation indices for each edge.
+    distances -- An array of distances for each edge.
+    method -- The linkage method. One of "single", "complete", "average"
+        or "weighted".
+    max_distance -- The distance of pairs without an edge. Must be at least
+        as large as every other distance.
+    counts -- The number of samples each observation stands for.
+        See nn_chain.
+
+    Returns:
+    A linkage matrix in the same format as scipy.cluster.hierarchy.linkage.
+    """
+
+    _check_method(method)
+    if n < 2:
+        raise ValueError("At least two observations are needed to cluster.")
+
+    # The distances to the neighbours closer than max_distance of each
+    # cluster. As in nn_chain, a merged cluster takes the place of the
+    # observation with the larger index.
+    neighbours = [dict() for _ in range(n)]
+    for i, j, distance in zip(np.asarray(rows).tolist(),
+                              np.asarray(columns).tolist(),
+                              np.asarray(distances).tolist()):
+        if i == j or distance >= max_distance:
+            continue
+
+        # Keep the smallest distance if an edge is repeated.
+        if distance < neighbours[i].get(j, max_distance):
+            neighbours[i][j] = distance
+            neighbours[j][i] = distance
+
+    sizes = _initial_sizes(n, counts).tolist()
+    merges = np.zeros((n - 1, 4), dtype=np.float64)
+
+    # A linked list of the active clusters in index order, so that the
+    # first cluster at max_distance can be found quickly.
+    following = list(range(1, n + 1))
+    preceding = list(range(-1, n - 1))
+    first = 0
+
+    chain = []
+    for k in range(n - 1):
+        if len(chain) == 0:
+            chain.append(first)
+
+        # Follow nearest neighbours until two clusters are each other's
+        # nearest neighbour. Ties go to the smallest index, as in nn_chain.
+        while True:
+            x = chain[-1]
+            edges = neighbours[x]
+
+            if len(edges) > 0:
+                current_min = min(edges.values())
+                y = min(i for i, d in edges.items() if d == current_min)
+            else:
+                current_min = max_distance
+
+            if current_min >= max_distance:
+                # Every other cluster is max_distance away.
+                current_min = max_distance
+                y = first if first != x else following[first]
+
+            # Prefer the previous element of the chain on ties, so that the
+            # chain always terminates.
+            if len(chain) > 1:
+                previous = chain[-2]
+                previous_dist = edges.get(previous, max_distance)
+
+                if previous_dist <= current_min:
+                    current_min = previous_dist
+                    y = previous
+                    break
+
+            chain.append(y)
+
+        del chain[-2:]
+
+        if x > y:
+            x, y = y, x
+
+        size_x = sizes[x]
+        size_y = sizes[y]
+        merges[k] = (x, y, current_min, size_x + size_y)
+
+        # The merged cluster takes the place of y.
+        sizes[x] = 0
+        sizes[y] = size_x + size_y
+
+        if preceding[x] < 0:
+            first = following[x]
+        else:
+            following[preceding[x]] = following[x]
+        if following[x] < n:
+            preceding[following[x]] = preceding[x]
+
+        to_x = neighbours[x]
+        to_y = neighbours[y]
+        to_x.pop(y, None)
+        to_y.pop(x, None)
+
+        for other in set(to_x).union(to_y):
+            neighbours[other].pop(x, None)
+
+            updated = _update_scalar(
+                method,
+                to_x.get(other, max_distance),
+                to_y.get(other, max_distance),
+                size_x,
+                size_y
+            )
+
+            if updated < max_distance:
+                to_y[other] = updated
+                neighbours[other][y] = updated
+            else:
+                to_y.pop(other, None)
+                neighbours[other].pop(y, None)
+
+        neighbours[x] = {}
+
+    # The chain finds merges out of order, so sort them by distance.
+    # Mergesort is stable, which keeps ties in the order they were found.
+    order = np.argsort(merges[:, 2], kind="mergesort")
+    merges = merges[order]
+    _label(merges, n, sizes=_initial_sizes(n, counts))
+    return merges
+
+
+def mst_single_linkage(matrix, metric="jaccard"):
+    """ Single linkage clustering of the rows of a presence-absence matrix.
+
+    Uses Prim's algorithm to find the minimum spanning tree, computing the
+    distances from one row to the others at each step. So memory use is
+    linear in the number of rows, and no distance matrix is stored.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix. Non-zero elements are treated as
+        present.
+    metric -- The distance metric to use, either "jaccard" or "braycurtis".
+
+    Returns:
+    A linkage matrix in the same format as scipy.cluster.hierarchy.linkage.
+    """
+
+    _check_metric(metric)
+
+    rows = _as_counts(matrix)
+    n = rows.shape[0]
+    if n < 2:
+        raise ValueError("At least two observations are needed to cluster.")
+
+    # The rows containing each column, to count shared columns quickly.
+    columns = rows.tocsc()
+    sums = np.diff(rows.indptr).astype(np.float64)
+
+    in_tree = np.zeros(n, dtype=bool)
+    nearest = np.full(n, np.inf)
+    parents = np.zeros(n, dtype=np.int64)
+    merges = np.zeros((n - 1, 4), dtype=np.float64)
+
+    current = 0
+    in_tree[current] = True
+    nearest[current] = np.inf
+
+    for step in range(n - 1):
+        # Count the columns shared by the current row and each other row.
+        start, stop = rows.indptr[current], rows.indptr[current + 1]
+        row_columns = rows.indices[start:stop]
+        members = [
+            columns.indices[columns.indptr[c]:columns.indptr[c + 1]]
+            for c in row_columns
+        ]
+
+        if len(members) > 0:
+            intersection = np.bincount(np.concatenate(members), minlength=n)
+        else:
+            intersection = np.zeros(n, dtype=np.int64)
+
+        distances = _from_counts(intersection, sums[current] + sums, metric)
+
+        closer = (distances < nearest) & ~in_tree
+        nearest[closer] = distances[closer]
+        parents[closer] = current
+
+        current = int(np.argmin(nearest))
+        merges[step] = (parents[current], current, nearest[current], 0)
+
+        in_tree[current] = True
+        nearest[current] = np.inf
+
+    order = np.argsort(merges[:, 2], kind="mergesort")
+    merges = merges[order]
+    _label(merges, n)
+    return merges
@@ -0,0 +1,119 @@
+"""
+Module output writes tables of results in one of several file formats.
+
+Excel files are easy to browse, but are slow to write and are limited to
+16384 columns and about a million rows. CSV files have no such limits, and
+Parquet and Feather are compressed columnar formats that pandas, R and
+arrow based tools can read very quickly. Parquet and Feather need the
+optional pyarrow package, e.g. `pip install BioDendro[arrow]`.
+
+Presence-absence matrices can also be written as sparse matrices, so that
+their size depends only on the number of bins present.
+"""
+
+from os.path import join as pjoin
+
+import numpy as np
+from scipy.io import mmwrite
+from scipy.sparse import coo_matrix
+from scipy.sparse import csr_matrix
+from scipy.sparse import save_npz
+
+FORMATS = ("xlsx", "csv", "parquet", "feather")
+
+SPARSE_FORMATS = ("mtx", "npz")
+
+# Formats that are written with pyarrow.
+_ARROW_FORMATS = ("parquet", "feather")
+
+
+def check_format(file_format):
+    """ Raise an error if a table format isn't supported or available.
+
+    Raises a ValueError for unknown formats, and an ImportError if the
+    format needs pyarrow and it isn't installed.
+    """
+
+    if file_format not in FORMATS:
+        raise ValueError(
+            "Unsupported file format {}. Must be one of {}."
+            .format(repr(file_format), ", ".join(FORMATS))
+        )
+
+    if file_format in _ARROW_FORMATS:
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            raise ImportError(
+                "Writing {} files requires pyarrow. Install it with "
+                "`pip install pyarrow` or `pip install BioDendro[arrow]`."
+                .format(file_format)
+            )
+    return
+
+
+def table_filename(path, name, file_format):
+    """ The path to a table called name, with the extension of the format.
+    """
+    return pjoin(path, "{}.{}".format(name, file_format))
+
+
+def write_table(table, filename, file_format="xlsx", index=True):
+    """ Write a dataframe to a file.
+
+    Keyword arguments:
+    table -- A pandas dataframe. Column names must be strings for parquet
+        and feather.
+    filename -- The path to write to.
+    file_format -- One of "xlsx", "csv", "parquet" or "feather".
+    index -- Write the dataframe's index as well as its columns. Feather
+        files can't store an index, so it is written as the first column.
+    """
+
+    check_format(file_format)
+
+    if file_format == "xlsx":
+        table.to_excel(filename, index=index)
+    elif file_format == "csv":
+        table.to_csv(filename, index=index)
+    elif file_format == "parquet":
+        table.to_parquet(filename, index=index)
+    else:
+        if index:
+            table = table.reset_index()
+        else:
+            table = table.reset_index(drop=True)
+        table.to_feather(filename)
+    return
+
+
+def check_sparse_format(sparse_format):
+    """ Raise a ValueError if a sparse matrix format isn't supported. """
+
+    if sparse_format not in SPARSE_FORMATS:
+        raise ValueError(
+            "Unsupported sparse matrix format {}. Must be one of {}."
+            .format(repr(sparse_format), ", ".join(SPARSE_FORMATS))
+        )
+    return
+
+
+def write_sparse_matrix(matrix, filename, sparse_format="npz"):
+    """ Write a scipy sparse matrix to a file.
+
+    Keyword arguments:
+    matrix -- A scipy sparse matrix.
+    filename -- The path to write to.
+    sparse_format -- Either "npz", read with scipy.sparse.load_npz, or "mtx"
+        for Matrix Market, read with scipy.io.mmread, R's Matrix::readMM and
+        most other sparse matrix tools.
+    """
+
+    check_sparse_format(sparse_format)
+
+    if sparse_format == "npz":
+        save_npz(filename, csr_matrix(matrix))
+    else:
+        # Matrix Market has no boolean type, so store presence as integers.
+        mmwrite(filename, coo_matrix(matrix, dtype=np.int8), field="integer")
+    return
@@ -0,0 +1,30 @@
+"""
+Module parallel contains helpers shared by the modules that use several
+processes or threads.
+"""
+
+import os
+
+
+def n_workers(n_jobs):
+    """ Get the number of workers to use, where -1 means all cpus.
+
+    Keyword arguments:
+    n_jobs -- -1 or a positive integer. None is the same as 1.
+
+    Returns:
+    The number of workers as a positive integer.
+
+    Raises a ValueError for 0 and for negative values other than -1.
+    """
+
+    if n_jobs is None:
+        return 1
+    elif n_jobs == -1:
+        return os.cpu_count() or 1
+    elif n_jobs < 1:
+        raise ValueError(
+            "Unsupported number of jobs {}. Must be -1 or a positive integer."
+            .format(n_jobs)
+        )
+    return n_jobs
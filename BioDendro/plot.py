@@ -41,7 +41,7 @@ def dendrogram(
 
     (dd_traces, xvals, yvals, ordered_labels, leaves) = _get_traces(
         hierarchy=tree.tree,
-        labels=list(tree.onehot_df.index),
+        labels=tree.onehot_index.tolist(),
         threshold=tree.cutoff,
         orientation=orientation,
         sign=sign,
@@ -97,7 +97,7 @@ def dendrogram(
         layout["margin"] = {ori: int(margin_scalar) * (longest_label + 1)}
 
     if hovertext is None:
-        cluster_map = dict(zip(tree.onehot_df.index, tree.clusters))
+        cluster_map = dict(zip(tree.onehot_index.tolist(), tree.clusters))
         data = _format_cluster_hovertexts(dd_traces, layout, cluster_map)
     else:
         data = dd_traces
@@ -2,50 +2,630 @@
 Preprocess contains methods for parsing and manipulating mass spec files.
 """
 
+import hashlib
+import locale
+import mmap
 import os
 import re
-from bisect import bisect_left
+import warnings
+import zipfile
+from array import array
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+from BioDendro.parallel import n_workers
+
 
 # Named tuple to represent ions and pepmass in MGF
 Ion = namedtuple("Ion", ["mz", "intensity"])
 
 
 class MGF(object):
-    """ """
+    """ A columnar, numpy backed store of MGF spectra.
+
+    Records are held sorted by precursor m/z. Rather than keeping an
+    `MGFRecord` per spectrum and an `Ion` per peak, the peaks of every
+    record are concatenated into the flat `ion_mzs` and `ion_intensities`
+    arrays, and the ions belonging to record `i` occupy the slice
+    `offsets[i]:offsets[i + 1]`. Missing intensities and retention times
+    are stored as NaN.
+
+    `MGFRecord` objects are only created on demand, when the object is
+    indexed or iterated over.
+    """
+
+    def __init__(
+        self,
+        titles,
+        retentions,
+        pepmasses,
+        offsets,
+        ion_mzs,
+        ion_intensities,
+        pepmass_intensities=None,
+        charges=None,
+    ):
+        """ Construct an MGF object from columns that are already sorted.
 
-    def __init__(self, records):
-        self.records = records
-        self.mzs = [r.pepmass.mz for r in records]
+        Keyword arguments:
+        titles -- An array of record titles.
+        retentions -- An array of record retention times in seconds.
+        pepmasses -- An array of precursor m/z values, in sorted order.
+        offsets -- An integer array of length n_records + 1, marking the
+            start and end of each record's ions in the ion arrays.
+        ion_mzs -- A flat array of the ion m/z values of all records.
+        ion_intensities -- A flat array of the ion intensities of all records.
+        pepmass_intensities -- An array of precursor intensities. Optional.
+        charges -- An array of record charge strings. Optional.
+        """
+
+        n_records = len(pepmasses)
+
+        self.titles = np.asarray(titles, dtype=object)
+        self.retentions = np.asarray(retentions, dtype=np.float64)
+        self.pepmasses = np.asarray(pepmasses, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ion_mzs = np.asarray(ion_mzs, dtype=np.float64)
+        self.ion_intensities = np.asarray(ion_intensities, dtype=np.float64)
+
+        if pepmass_intensities is None:
+            pepmass_intensities = np.full(n_records, np.nan)
+        self.pepmass_intensities = np.asarray(
+            pepmass_intensities,
+            dtype=np.float64
+        )
+
+        if charges is None:
+            charges = np.full(n_records, None, dtype=object)
+        self.charges = np.asarray(charges, dtype=object)
+
+        assert len(self.offsets) == n_records + 1
+        assert len(self.ion_mzs) == len(self.ion_intensities)
         return
 
     def __str__(self):
         cls = self.__class__.__name__
         template = "{}(records=[\n{}\n{}])"
         n_to_display = 5
-        trailing = "...\n" if n_to_display < len(self.records) else ""
+        trailing = "...\n" if n_to_display < len(self) else ""
         return template.format(
             cls,
-            ",\n".join(map(str, self.records[:n_to_display])),
+            ",\n".join(
+                str(self[i])
+                for i
+                in range(min(n_to_display, len(self)))
+            ),
             trailing
         )
 
     def __repr__(self):
         return str(self)
 
+    def __len__(self):
+        return len(self.pepmasses)
+
+    def __getitem__(self, i):
+        """ Materialise the record at index i as an MGFRecord. """
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError("MGF record index out of range.")
+
+        ions = _to_ions(*self.ions(i))
+
+        pepmass = Ion(
+            float(self.pepmasses[i]),
+            _nan_to_none(float(self.pepmass_intensities[i]))
+        )
+
+        return MGFRecord(
+            title=self.titles[i],
+            retention=_nan_to_none(float(self.retentions[i])),
+            pepmass=pepmass,
+            charge=self.charges[i],
+            ions=ions,
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def records(self):
+        """ A list of all records as MGFRecord objects.
+
+        This materialises every record, so avoid it for large files.
+        """
+        return list(self)
+
+    def ions(self, i):
+        """ Get views of the ion m/z values and intensities of record i. """
+        ion_range = slice(self.offsets[i], self.offsets[i + 1])
+        return self.ion_mzs[ion_range], self.ion_intensities[ion_range]
+
+    def take(self, indices):
+        """ Select records by index, returning a new MGF object.
+
+        The indices should keep the records sorted by precursor m/z.
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        ion_indices, lengths = self._ion_indices(indices)
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        return self.__class__(
+            titles=self.titles[indices],
+            retentions=self.retentions[indices],
+            pepmasses=self.pepmasses[indices],
+            offsets=offsets,
+            ion_mzs=self.ion_mzs[ion_indices],
+            ion_intensities=self.ion_intensities[ion_indices],
+            pepmass_intensities=self.pepmass_intensities[indices],
+            charges=self.charges[indices],
+        )
+
+    def _ion_indices(self, indices):
+        """ Get the positions in the ion arrays of the ions of some records.
+
+        Returns:
+        ion_indices -- The positions of the ions of each record, concatenated
+            in the order of indices.
+        lengths -- The number of ions of each record.
+        """
+
+        lengths = np.diff(self.offsets)[indices]
+        starts = np.zeros(len(indices), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+
+        # For each output ion, the shift from its position in the output to
+        # its position in the ion arrays.
+        ion_indices = (
+            np.repeat(self.offsets[indices] - starts, lengths)
+            + np.arange(lengths.sum(), dtype=np.int64)
+        )
+        return ion_indices, lengths
+
     @classmethod
-    def parse(cls, handle, scaling=False, filtering=False, eps=0.0):
-        records = MGFRecord.parse(
-            handle,
+    def from_records(cls, records):
+        """ Construct an MGF object from an iterable of MGFRecord objects. """
+
+        builder = _MGFBuilder()
+        for record in records:
+            builder.append_record(record)
+
+        return builder.build(cls)
+
+    @classmethod
+    def parse(
+        cls,
+        handle,
+        scaling=False,
+        filtering=False,
+        eps=0.0,
+        n_jobs=1,
+    ):
+        """ Parses an MGF file into a columnar MGF object.
+
+        Records are read one at a time and their columns appended to
+        compact buffers, so the whole file is never held as python objects.
+
+        Keyword arguments:
+        handle -- a file like object or list of strings representing the mgf,
+            or a path to an mgf file.
+        n_jobs -- The number of processes to parse the file with. If greater
+            than 1, the file is split into byte ranges at `BEGIN` lines which
+            are parsed in parallel. This requires handle to be a path or a
+            file opened from a path. -1 uses all available cpus.
+        """
+
+        n_jobs = n_workers(n_jobs)
+
+        if n_jobs > 1:
+            return cls._parse_parallel(
+                _handle_path(handle),
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps,
+                n_jobs=n_jobs
+            )
+
+        elif isinstance(handle, (str, os.PathLike)):
+            mgf = _parse_mapped(
+                handle,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps,
+                cls=cls
+            )
+
+            # A stable sort keeps records with equal masses in file order.
+            order = np.argsort(mgf.pepmasses, kind="stable")
+            return mgf.take(order)
+
+        builder = _MGFBuilder()
+        for block in _iter_blocks(handle):
+            columns = MGFRecord._read_columns(
+                block,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps
+            )
+            builder.append(*columns)
+
+        return builder.build(cls)
+
+    @classmethod
+    def _parse_parallel(
+        cls,
+        path,
+        scaling=False,
+        filtering=False,
+        eps=0.0,
+        n_jobs=2,
+        chunk_size=2 ** 26,
+    ):
+        """ Parse byte ranges of an MGF file in a process pool.
+
+        The ranges are parsed into unsorted MGF objects, which are joined in
+        file order and stable sorted, so the output is identical to the
+        serial parser.
+
+        Keyword arguments:
+        path -- The path to the mgf file.
+        n_jobs -- The number of processes to use.
+        chunk_size -- The approximate maximum size of each range in bytes.
+            Keeps the memory used by each worker bounded.
+        """
+
+        file_size = os.path.getsize(path)
+        n_chunks = max(n_jobs, -(-file_size // chunk_size))
+        boundaries = _block_boundaries(path, n_chunks)
+
+        ranges = [
+            (path, start, end, scaling, filtering, eps)
+            for start, end
+            in zip(boundaries[:-1], boundaries[1:])
+        ]
+
+        if len(ranges) == 0:
+            return _MGFBuilder().build(cls)
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(_parse_range, ranges))
+
+        mgf = cls._concatenate(parts)
+
+        # A stable sort keeps records with equal masses in file order.
+        order = np.argsort(mgf.pepmasses, kind="stable")
+        return mgf.take(order)
+
+    @classmethod
+    def _concatenate(cls, parts):
+        """ Join MGF objects end to end, without sorting. """
+
+        lengths = [len(p.ion_mzs) for p in parts]
+        ion_starts = np.cumsum([0] + lengths[:-1])
+
+        offsets = np.concatenate(
+            [np.zeros(1, dtype=np.int64)]
+            + [p.offsets[1:] + start for p, start in zip(parts, ion_starts)]
+        )
+
+        return cls(
+            titles=np.concatenate([p.titles for p in parts]),
+            retentions=np.concatenate([p.retentions for p in parts]),
+            pepmasses=np.concatenate([p.pepmasses for p in parts]),
+            offsets=offsets,
+            ion_mzs=np.concatenate([p.ion_mzs for p in parts]),
+            ion_intensities=np.concatenate(
+                [p.ion_intensities for p in parts]
+            ),
+            pepmass_intensities=np.concatenate(
+                [p.pepmass_intensities for p in parts]
+            ),
+            charges=np.concatenate([p.charges for p in parts]),
+        )
+
+    @classmethod
+    def parse_cached(
+        cls,
+        path,
+        scaling=False,
+        filtering=False,
+        eps=0.0,
+        n_jobs=1,
+        cache_dir=None,
+    ):
+        """ Parse an MGF file, reusing a binary cache of earlier results.
+
+        The parsed and sorted arrays are saved to an `.npz` file named after
+        the mgf and the parsing parameters. The cache also stores a hash of the
+        mgf contents. If the file has changed since the cache was written,
+        the mgf is parsed again and the cache is replaced.
+
+        Keyword arguments:
+        path -- The path to the mgf file.
+        n_jobs -- See `parse`.
+        cache_dir -- The directory to store cache files in. By default the
+            cache is written next to the mgf file.
+        """
+
+        content_hash = _file_hash(path)
+        cache_path = _cache_path(path, cache_dir, scaling, filtering, eps)
+
+        if os.path.isfile(cache_path):
+            try:
+                mgf, metadata = cls._load(cache_path)
+                if metadata.get("content_hash") == content_hash:
+                    return mgf
+
+            except (
+                OSError,
+                EOFError,
+                KeyError,
+                ValueError,
+                zipfile.BadZipFile,
+            ):
+                # A broken cache, e.g. truncated by a full disk or an
+                # interrupted copy, is replaced below.
+                pass
+
+        mgf = cls.parse(
+            path,
             scaling=scaling,
             filtering=filtering,
-            eps=eps
+            eps=eps,
+            n_jobs=n_jobs
         )
-        records.sort(key=lambda x: x.pepmass.mz)
-        return cls(records)
+
+        try:
+            mgf.save(cache_path, content_hash=content_hash)
+        except OSError as e:
+            warnings.warn(
+                "Could not write MGF cache file {}: {}".format(cache_path, e)
+            )
+
+        return mgf
+
+    def save(self, path, **metadata):
+        """ Save the arrays to an uncompressed numpy `.npz` file.
+
+        Keyword arguments:
+        path -- The file to write to. Written atomically, so an interrupted
+            save never leaves a truncated file.
+        metadata -- Extra string values to store alongside the arrays.
+        """
+
+        titles, has_titles = _to_str_array(self.titles)
+        charges, has_charges = _to_str_array(self.charges)
+
+        arrays = {
+            "version": np.array(_CACHE_VERSION),
+            "titles": titles,
+            "has_titles": has_titles,
+            "charges": charges,
+            "has_charges": has_charges,
+            "retentions": self.retentions,
+            "pepmasses": self.pepmasses,
+            "pepmass_intensities": self.pepmass_intensities,
+            "offsets": self.offsets,
+            "ion_mzs": self.ion_mzs,
+            "ion_intensities": self.ion_intensities,
+        }
+
+        for key, value in metadata.items():
+            arrays["metadata_" + key] = np.array(str(value))
+
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as handle:
+                np.savez(handle, **arrays)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """ Load an MGF object from a file written by `save`. """
+        mgf, _ = cls._load(path)
+        return mgf
+
+    @classmethod
+    def _load(cls, path):
+        """ Load an MGF object and any metadata written by `save`. """
+
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != _CACHE_VERSION:
+                raise ValueError(
+                    "The MGF cache was written by another version."
+                )
+
+            mgf = cls(
+                titles=_from_str_array(data["titles"], data["has_titles"]),
+                retentions=data["retentions"],
+                pepmasses=data["pepmasses"],
+                offsets=data["offsets"],
+                ion_mzs=data["ion_mzs"],
+                ion_intensities=data["ion_intensities"],
+                pepmass_intensities=data["pepmass_intensities"],
+                charges=_from_str_array(data["charges"], data["has_charges"]),
+            )
+
+            metadata = {
+                key[len("metadata_"):]: str(data[key])
+                for key
+                in data.files
+                if key.startswith("metadata_")
+            }
+
+        return mgf, metadata
+
+    @staticmethod
+    def iter_records(handle, scaling=False, filtering=False, eps=0.0):
+        """ Yield MGFRecord objects one at a time as they are read.
+
+        Unlike `parse`, records are not sorted or kept, so memory use does not
+        depend on the size of the file.
+
+        Keyword arguments:
+        handle -- a file like object or list of strings representing the mgf.
+        """
+
+        for block in _iter_blocks(handle):
+            yield MGFRecord._read(
+                block,
+                scaling=scaling,
+                filtering=filtering,
+                eps=eps
+            )
+
+        return
+
+    def closest_many(
+        self,
+        mzs,
+        retentions,
+        mz_tol,
+        retention_tol,
+        index="auto",
+        max_candidates=2 ** 22,
+    ):
+        """ Find the closest trigger matches for many mz and retention values.
+
+        All queries are resolved together. The mz windows are found with a
+        binary search over the sorted precursor masses, and the closest
+        retention time within each window is selected with grouped array
+        operations rather than a python loop.
+
+        When the mz windows are wide they can contain many records outside
+        of the retention time window. In that case a 2-D grid index, which
+        buckets records by mz and sorts them by retention time within each
+        bucket, is used so that only records near both values are compared.
+
+        Keyword arguments:
+        mzs -- An array of mz values to match.
+        retentions -- An array of retention times, the same length as mzs.
+        mz_tol -- The mz tolerance.
+        retention_tol -- The retention time tolerance.
+        index -- Which lookup to use. "sorted" scans the mz windows, "grid"
+            uses the 2-D index, and "auto" uses the grid index when the mz
+            windows contain more than a few records on average.
+        max_candidates -- The maximum number of candidate records to compare
+            at once. Queries are processed in batches to bound memory use.
+
+        Uses:
+        self.pepmasses
+        self.retentions
+
+        Returns:
+        An integer array of record indices, the same length as mzs.
+        Queries without a match within the tolerances are -1.
+        """
+
+        if index not in ("auto", "sorted", "grid"):
+            raise ValueError("index must be 'auto', 'sorted' or 'grid'.")
+
+        mzs = np.asarray(mzs, dtype=np.float64)
+        retentions = np.asarray(retentions, dtype=np.float64)
+
+        # Use a binary search to find the records within the mz windows.
+        starts = np.searchsorted(self.pepmasses, mzs - mz_tol, side="left")
+        ends = np.searchsorted(self.pepmasses, mzs + mz_tol, side="left")
+        counts = np.maximum(ends - starts, 0)
+
+        if index == "auto" and len(mzs) > 0:
+            index = "grid" if counts.mean() > _GRID_MIN_WINDOW else "sorted"
+
+        # The grid needs a positive bucket width.
+        if index == "grid" and mz_tol > 0:
+            grid = self._grid_index(2 * mz_tol)
+            return grid.closest_many(
+                mzs,
+                retentions,
+                mz_tol,
+                retention_tol,
+                max_candidates=max_candidates
+            )
+
+        lower_retentions = retentions - retention_tol
+        upper_retentions = retentions + retention_tol
+
+        closest = np.full(len(mzs), -1, dtype=np.int64)
+        cumulative = np.cumsum(counts)
+
+        batch_start = 0
+        while batch_start < len(mzs):
+            offset = cumulative[batch_start - 1] if batch_start > 0 else 0
+            batch_end = np.searchsorted(cumulative, offset + max_candidates,
+                                        side="right")
+            batch_end = max(batch_end, batch_start + 1)
+
+            queries = np.arange(batch_start, batch_end)
+            queries = queries[counts[queries] > 0]
+            batch_start = batch_end
+
+            if len(queries) == 0:
+                continue
+
+            # Flatten the windows of all queries in the batch.
+            query_counts = counts[queries]
+            group_starts = np.zeros(len(queries), dtype=np.int64)
+            np.cumsum(query_counts[:-1], out=group_starts[1:])
+
+            n_candidates = group_starts[-1] + query_counts[-1]
+            groups = np.repeat(np.arange(len(queries)), query_counts)
+            candidates = (
+                np.repeat(starts[queries] - group_starts, query_counts)
+                + np.arange(n_candidates)
+            )
+
+            query_of_candidate = queries[groups]
+            window = self.retentions[candidates]
+            passing = (
+                (window > lower_retentions[query_of_candidate])
+                & (window < upper_retentions[query_of_candidate])
+            )
+
+            dists = np.where(
+                passing,
+                np.abs(retentions[query_of_candidate] - window),
+                np.inf
+            )
+
+            # Take the first of any ties, which matches the behaviour of a
+            # strict less-than when scanning in mz order.
+            min_dists = np.minimum.reduceat(dists, group_starts)
+            is_min = (dists == min_dists[groups]) & passing
+
+            hits = np.flatnonzero(is_min)
+            first = np.ones(len(hits), dtype=bool)
+            first[1:] = groups[hits[1:]] != groups[hits[:-1]]
+            hits = hits[first]
+
+            closest[query_of_candidate[hits]] = candidates[hits]
+
+        return closest
+
+    def _grid_index(self, width):
+        """ Get a cached 2-D grid index with mz buckets of the given width.
+        """
+
+        grid = getattr(self, "_grid", None)
+        if grid is None or grid.width != width:
+            grid = _GridIndex(self.pepmasses, self.retentions, width)
+            self._grid = grid
+
+        return grid
 
     def closest(self, mz, retention, mz_tol, retention_tol):
         """ Find the closest trigger match to a mz and retention value.
@@ -56,50 +636,620 @@ class MGF(object):
         mz_tol --
         retention_tol --
 
-        Uses:
-        self.records
-        self.mzs
+        Returns:
+        An MGFRecord view of the closest trigger, or None if no records
+        fall within the tolerances.
+        """
+
+        index = self.closest_many([mz], [retention], mz_tol, retention_tol)[0]
+        if index < 0:
+            return None
+
+        return self[index]
+
 
-        NB self.records must be sorted by mzs, and mzs must correspond to the
-        records.
+# The mean number of records in the mz windows above which closest_many
+# uses the grid index.
+_GRID_MIN_WINDOW = 32
+
+
+class _GridIndex(object):
+    """ A 2-D index of records bucketed by mz and sorted by retention time.
+
+    Not intended for public use, see MGF.closest_many.
+    """
+
+    def __init__(self, pepmasses, retentions, width):
+        """ Build the index.
+
+        Keyword arguments:
+        pepmasses -- The sorted precursor mz values of the records.
+        retentions -- The retention times of the records.
+        width -- The mz width of each bucket. With a width of twice the mz
+            tolerance, each query only needs to search two buckets.
         """
 
-        closest = None
+        self.width = width
+        self.pepmasses = pepmasses
+
+        # Records with missing values can never match, so leave them out.
+        valid = np.flatnonzero(np.isfinite(pepmasses) & ~np.isnan(retentions))
+        buckets = np.floor(pepmasses[valid] / width).astype(np.int64)
+
+        # Sort by bucket, then by retention time within the bucket.
+        # Ties keep mz order.
+        order = np.lexsort((retentions[valid], buckets))
+        self.order = valid[order]
+        self.retentions = retentions[self.order]
+
+        buckets = buckets[order]
+        self.buckets, bucket_starts = np.unique(buckets, return_index=True)
+        self.bucket_bounds = np.append(bucket_starts, len(buckets))
+        return
 
-        lower_mz = mz - mz_tol
-        upper_mz = mz + mz_tol
+    def _segments(self, bucket_ids):
+        """ Get the start and end positions of the buckets in self.order.
 
-        lower_retention = retention - retention_tol
-        upper_retention = retention + retention_tol
+        Buckets that aren't in the index get empty segments.
+        """
 
-        # Initialise the minimum mass distance
-        # Unrealistic number to guarantee match
-        # min_dist_mz = float("inf")
-        # Initialise minimum retention distance
-        min_dist_retention = float("inf")
+        positions = np.searchsorted(self.buckets, bucket_ids)
+        positions = np.minimum(positions, len(self.buckets) - 1)
+        present = self.buckets[positions] == bucket_ids
+
+        starts = np.where(present, self.bucket_bounds[positions], 0)
+        ends = np.where(present, self.bucket_bounds[positions + 1], 0)
+        return starts, ends
+
+    def closest_many(
+        self,
+        mzs,
+        retentions,
+        mz_tol,
+        retention_tol,
+        max_candidates=2 ** 22,
+    ):
+        """ Find the closest matches, see MGF.closest_many. """
+
+        closest = np.full(len(mzs), -1, dtype=np.int64)
+        if len(self.buckets) == 0:
+            return closest
+
+        lower_mzs = mzs - mz_tol
+        upper_mzs = mzs + mz_tol
+        lower_retentions = retentions - retention_tol
+        upper_retentions = retentions + retention_tol
+
+        searchable = np.flatnonzero(
+            np.isfinite(lower_mzs) & np.isfinite(upper_mzs)
+        )
+        first_buckets = np.floor(lower_mzs[searchable] / self.width)
+        last_buckets = np.floor(upper_mzs[searchable] / self.width)
+        first_buckets = first_buckets.astype(np.int64)
+        last_buckets = last_buckets.astype(np.int64)
+        n_buckets = last_buckets - first_buckets + 1
+
+        # Pair every query with each of the buckets its mz window overlaps.
+        pair_queries = np.repeat(searchable, n_buckets)
+        pair_buckets = (
+            np.repeat(first_buckets - np.cumsum(n_buckets) + n_buckets,
+                      n_buckets)
+            + np.arange(n_buckets.sum())
+        )
 
-        # Use a binary search to find the first passing mz value
-        # Start the loop from there.
-        min_bound = bisect_left(self.mzs, lower_mz)
+        # Find the retention time window within each bucket.
+        segment_starts, segment_ends = self._segments(pair_buckets)
+        starts = _segment_searchsorted(
+            self.retentions,
+            segment_starts,
+            segment_ends,
+            lower_retentions[pair_queries],
+            side="right"
+        )
+        ends = _segment_searchsorted(
+            self.retentions,
+            starts,
+            segment_ends,
+            upper_retentions[pair_queries],
+            side="left"
+        )
 
-        for record in self.records[min_bound:]:
-            if record.pepmass.mz >= upper_mz:
-                break
-            elif (record.retention <= lower_retention
-                    or record.retention >= upper_retention):
+        counts = ends - starts
+        keep = counts > 0
+        pair_queries = pair_queries[keep]
+        starts = starts[keep]
+        counts = counts[keep]
+        if len(counts) == 0:
+            return closest
+
+        cumulative = np.cumsum(counts)
+        batch_start = 0
+        while batch_start < len(counts):
+            offset = cumulative[batch_start - 1] if batch_start > 0 else 0
+            batch_end = np.searchsorted(cumulative, offset + max_candidates,
+                                        side="right")
+            batch_end = max(batch_end, batch_start + 1)
+
+            # Don't split the buckets of a query across batches.
+            while (batch_end < len(counts)
+                   and pair_queries[batch_end] == pair_queries[batch_end - 1]):
+                batch_end += 1
+
+            batch = slice(batch_start, batch_end)
+            batch_start = batch_end
+
+            batch_counts = counts[batch]
+            pair_starts = np.zeros(len(batch_counts), dtype=np.int64)
+            np.cumsum(batch_counts[:-1], out=pair_starts[1:])
+
+            positions = (
+                np.repeat(starts[batch] - pair_starts, batch_counts)
+                + np.arange(batch_counts.sum())
+            )
+            candidates = self.order[positions]
+            queries = np.repeat(pair_queries[batch], batch_counts)
+
+            # Check the exact mz window.
+            candidate_mzs = self.pepmasses[candidates]
+            passing = (
+                (candidate_mzs >= lower_mzs[queries])
+                & (candidate_mzs < upper_mzs[queries])
+            )
+            candidates = candidates[passing]
+            queries = queries[passing]
+            if len(queries) == 0:
                 continue
 
-            dist_retention = abs(retention - record.retention)
+            dists = np.abs(retentions[queries] - self.retentions[
+                positions[passing]
+            ])
 
-            # find the closest trigger to the sample
-            if dist_retention < min_dist_retention:
-                min_dist_retention = dist_retention
-                # set best trigger match
-                closest = record
+            # Pairs are ordered by query, so candidates of the same query are
+            # contiguous.
+            query_starts = np.flatnonzero(
+                np.append(True, queries[1:] != queries[:-1])
+            )
+            groups = np.repeat(
+                np.arange(len(query_starts)),
+                np.diff(np.append(query_starts, len(queries)))
+            )
+
+            # Of the closest, take the first in mz order to match the
+            # sorted scan.
+            min_dists = np.minimum.reduceat(dists, query_starts)
+            is_min = dists == min_dists[groups]
+            best = np.minimum.reduceat(
+                np.where(is_min, candidates, np.iinfo(np.int64).max),
+                query_starts
+            )
+            closest[queries[query_starts]] = best
 
         return closest
 
 
+def _segment_searchsorted(values, starts, ends, targets, side="left"):
+    """ Binary search for many targets, each within its own sorted segment.
+
+    Keyword arguments:
+    values -- The array to search.
+    starts -- The start of the segment to search for each target.
+    ends -- The end of the segment to search for each target.
+    targets -- The values to search for.
+    side -- As for numpy.searchsorted.
+
+    Returns:
+    An array of the insertion positions of targets within the segments.
+    """
+
+    lower = np.array(starts, dtype=np.int64)
+    upper = np.array(ends, dtype=np.int64)
+    last = max(len(values) - 1, 0)
+
+    while True:
+        active = lower < upper
+        if not active.any():
+            break
+
+        middle = (lower + upper) // 2
+        middle_values = values[np.minimum(middle, last)]
+
+        if side == "left":
+            go_right = middle_values < targets
+        else:
+            go_right = middle_values <= targets
+
+        lower = np.where(active & go_right, middle + 1, lower)
+        upper = np.where(active & ~go_right, middle, upper)
+
+    return lower
+
+
+class _MGFBuilder(object):
+    """ Accumulates MGF columns in compact buffers. Not for public use. """
+
+    def __init__(self):
+        self.titles = []
+        self.retentions = array("d")
+        self.pepmasses = array("d")
+        self.pepmass_intensities = array("d")
+        self.charges = []
+        self.lengths = array("q")
+        self.ion_mzs = []
+        self.ion_intensities = []
+        return
+
+    def append(self, title, retention, pepmass, charge, mzs, intensities):
+        """ Add the columns of a single record.
+
+        mzs and intensities should be numpy float arrays, with missing
+        intensities as NaN.
+        """
+
+        self.titles.append(title)
+        self.retentions.append(_none_to_nan(retention))
+
+        if pepmass is None:
+            pepmass = Ion(None, None)
+
+        self.pepmasses.append(_none_to_nan(pepmass.mz))
+        self.pepmass_intensities.append(_none_to_nan(pepmass.intensity))
+        self.charges.append(charge)
+
+        self.lengths.append(len(mzs))
+        self.ion_mzs.append(mzs)
+        self.ion_intensities.append(intensities)
+        return
+
+    def append_record(self, record):
+        """ Add the columns of an MGFRecord object. """
+
+        self.append(
+            record.title,
+            record.retention,
+            record.pepmass,
+            record.charge,
+            np.array([i.mz for i in record.ions], dtype=np.float64),
+            np.array([_none_to_nan(i.intensity) for i in record.ions],
+                     dtype=np.float64),
+        )
+        return
+
+    def build(self, cls=None, sort=True):
+        """ Convert the buffers to an MGF object sorted by precursor m/z.
+
+        If sort is False, records are kept in the order they were added.
+        """
+
+        if cls is None:
+            cls = MGF
+
+        n_records = len(self.pepmasses)
+        offsets = np.zeros(n_records + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.lengths, dtype=np.int64),
+                  out=offsets[1:])
+
+        titles = np.empty(n_records, dtype=object)
+        titles[:] = self.titles
+        charges = np.empty(n_records, dtype=object)
+        charges[:] = self.charges
+
+        mgf = cls(
+            titles=titles,
+            retentions=np.frombuffer(self.retentions, dtype=np.float64),
+            pepmasses=np.frombuffer(self.pepmasses, dtype=np.float64),
+            offsets=offsets,
+            ion_mzs=_concatenate(self.ion_mzs),
+            ion_intensities=_concatenate(self.ion_intensities),
+            pepmass_intensities=np.frombuffer(self.pepmass_intensities,
+                                              dtype=np.float64),
+            charges=charges,
+        )
+
+        if not sort:
+            return mgf
+
+        # A stable sort keeps records with equal masses in file order.
+        order = np.argsort(mgf.pepmasses, kind="stable")
+        return mgf.take(order)
+
+
+# Increment when the layout of files written by MGF.save changes.
+_CACHE_VERSION = 1
+
+
+def _file_hash(path, block_size=2 ** 20):
+    """ Compute the sha256 hex digest of a file's contents. """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _cache_path(path, cache_dir, scaling, filtering, eps):
+    """ Get the cache file name for an mgf file and parsing parameters. """
+
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(path))
+
+    # The full path is included so that mgfs with the same name in different
+    # directories don't share a cache file in cache_dir.
+    settings = "{}|{}|{}|{}|{!r}".format(
+        _CACHE_VERSION,
+        os.path.abspath(path),
+        bool(scaling),
+        bool(filtering),
+        float(eps),
+    )
+    key = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+    filename = "{}.{}.biodendro.npz".format(os.path.basename(path), key)
+    return os.path.join(cache_dir, filename)
+
+
+def _to_str_array(values):
+    """ Convert an array of strings or None to a unicode array and mask. """
+
+    present = np.array([v is not None for v in values], dtype=bool)
+    strings = np.array(["" if v is None else v for v in values], dtype=str)
+    return strings, present
+
+
+def _from_str_array(strings, present):
+    """ Reverse _to_str_array, giving an object array. """
+
+    values = np.empty(len(strings), dtype=object)
+    values[:] = strings.tolist()
+    values[~present] = None
+    return values
+
+
+def _handle_path(handle):
+    """ Get the path of a file from a path or a file opened from a path. """
+
+    if isinstance(handle, (str, os.PathLike)):
+        return handle
+
+    name = getattr(handle, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name
+
+    raise ValueError(
+        "Parallel parsing requires a path or a file opened from a path."
+    )
+
+
+def _block_boundaries(path, n_chunks):
+    """ Split a file into byte ranges that start at BEGIN lines.
+
+    Returns:
+    A sorted list of byte offsets, starting with 0 and ending with the file
+    size. Consecutive offsets mark the start and end of each range.
+    """
+
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+
+    with open(path, "rb") as handle:
+        for i in range(1, n_chunks):
+            target = max(file_size * i // n_chunks, boundaries[-1])
+            handle.seek(target)
+
+            # Skip the rest of the line we landed in, unless we landed at the
+            # start of a line.
+            if target > 0:
+                handle.seek(target - 1)
+                handle.readline()
+
+            while True:
+                position = handle.tell()
+                line = handle.readline()
+                if not line or line.startswith(b"BEGIN"):
+                    break
+
+            if position > boundaries[-1]:
+                boundaries.append(position)
+
+    if boundaries[-1] < file_size:
+        boundaries.append(file_size)
+
+    return boundaries
+
+
+def _parse_range(args):
+    """ Parse the records in a byte range of an MGF file.
+
+    Intended to be run in a worker process. Not intended for public use.
+
+    Keyword arguments:
+    args -- A tuple of path, start, end, scaling, filtering and eps.
+
+    Returns:
+    An unsorted MGF object.
+    """
+
+    path, start, end, scaling, filtering, eps = args
+    return _parse_mapped(path, start, end, scaling, filtering, eps)
+
+
+# Matches lines with exactly two whitespace separated fields.
+_PEAK_LINES = re.compile(rb"(?:[ \t]*\S+[ \t]+\S+[ \t\r]*\n)*"
+                         rb"[ \t]*\S+[ \t]+\S+\s*")
+
+
+def _parse_mapped(
+    path,
+    start=0,
+    end=None,
+    scaling=False,
+    filtering=False,
+    eps=0.0,
+    cls=None,
+):
+    """ Parse the records in a byte range of a memory mapped MGF file.
+
+    Rather than reading the file line by line, the BEGIN and END markers are
+    found by searching the mapped bytes, and each block of peak lines is
+    converted to floats in a single call. Blocks that the bulk conversion
+    can't handle (e.g. missing intensities, or headers after the peaks) fall
+    back to the line by line parser, so the output is the same as
+    `MGF.parse` given an open file.
+
+    Keyword arguments:
+    path -- The path to the mgf file.
+    start -- The byte offset to start searching for records at.
+    end -- The byte offset to stop searching for records at. Records that
+        begin before this offset are read to completion. Default is the end
+        of the file.
+
+    Returns:
+    An unsorted MGF object.
+    """
+
+    builder = _MGFBuilder()
+    encoding = locale.getpreferredencoding(False)
+
+    with open(path, "rb") as handle:
+        # Empty files can't be mapped.
+        if os.fstat(handle.fileno()).st_size == 0:
+            return builder.build(cls, sort=False)
+
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if end is None:
+                end = len(mm)
+
+            for block_start, block_end in _mapped_blocks(mm, start, end):
+                columns = _read_mapped_block(
+                    mm[block_start:block_end],
+                    encoding,
+                    scaling=scaling,
+                    filtering=filtering,
+                    eps=eps
+                )
+                builder.append(*columns)
+
+    return builder.build(cls, sort=False)
+
+
+def _mapped_blocks(mm, start, end):
+    """ Yield the byte ranges of the lines between BEGIN and END lines. """
+
+    position = start
+    while True:
+        begin = _find_line_start(mm, b"BEGIN", position, end)
+        if begin < 0:
+            break
+
+        block_start = mm.find(b"\n", begin) + 1
+        if block_start == 0:
+            break
+
+        # Search from the newline ending the BEGIN line, so that empty
+        # blocks are found.
+        block_end = mm.find(b"\nEND", block_start - 1)
+        if block_end < 0:
+            break
+
+        yield block_start, max(block_start, block_end)
+        position = block_end + 1
+
+    return
+
+
+def _find_line_start(mm, marker, start, end):
+    """ Find the first line starting with marker between start and end. """
+
+    position = mm.find(marker, start, end)
+    while position > 0 and mm[position - 1] not in b"\r\n":
+        position = mm.find(marker, position + 1, end)
+
+    return position
+
+
+def _read_mapped_block(block, encoding, scaling=False, filtering=False,
+                       eps=0.0):
+    """ Read the bytes between BEGIN and END lines into record columns. """
+
+    # Header lines come first, and are identified the same way as in
+    # MGFRecord._read_columns.
+    headers = []
+    position = 0
+    while position < len(block):
+        line_end = block.find(b"\n", position)
+        if line_end < 0:
+            line_end = len(block)
+
+        line = block[position:line_end]
+        if b"=" not in line:
+            break
+
+        headers.append(line.decode(encoding).strip())
+        position = line_end + 1
+
+    peaks = block[position:]
+    n_lines = peaks.count(b"\n") + 1 if peaks else 0
+
+    with warnings.catch_warnings():
+        # fromstring warns when it stops at something that isn't a number.
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(peaks, dtype=np.float64, sep=" ")
+
+    # Every peak line must have exactly an mz and an intensity,
+    # otherwise use the line by line parser.
+    if (b"=" in peaks
+            or len(values) != 2 * n_lines
+            or _PEAK_LINES.fullmatch(peaks) is None):
+        lines = [line.strip() for line in block.decode(encoding).split("\n")]
+        return MGFRecord._read_columns(
+            lines,
+            scaling=scaling,
+            filtering=filtering,
+            eps=eps
+        )
+
+    title, retention, pepmass, charge, _, _ = MGFRecord._read_columns(headers)
+
+    values = values.reshape((n_lines, 2))
+    mzs = values[:, 0].copy()
+    intensities, keep = MGFRecord._alter_intensities(
+        values[:, 1].copy(),
+        scaling=scaling,
+        filtering=filtering,
+        eps=eps
+    )
+
+    if keep is not None:
+        mzs = mzs[keep]
+        intensities = intensities[keep]
+
+    return title, retention, pepmass, charge, mzs, intensities
+
+
+def _concatenate(arrays):
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.float64)
+    return np.concatenate(arrays)
+
+
+def _none_to_nan(value):
+    return np.nan if value is None else value
+
+
+def _nan_to_none(value):
+    return None if value != value else value
+
+
+def _to_ions(mzs, intensities):
+    """ Convert arrays of m/z values and intensities to a list of Ions. """
+    return [
+        Ion(mz, _nan_to_none(intensity))
+        for mz, intensity
+        in zip(mzs.tolist(), intensities.tolist())
+    ]
+
+
 class MGFRecord(object):
     """ Represents single MGF records intended to be used in a list. """
 
@@ -175,66 +1325,87 @@ class MGFRecord(object):
         return Ion(mz, intensity)
 
     @staticmethod
-    def _get_altered_ions(ions, scaling, filtering, eps=0.0):
-        if not scaling and not filtering:
-            return ions  # Nothing is done
+    def _alter_intensities(intensities, scaling, filtering, eps=0.0):
+        """ Scale and filter the intensities of a whole block at once.
 
-        # extract the flattened mz and intensities as lists
-        mzs = []
-        intensities = []
-
-        all_none = True
-        max_inten = float("-inf")
-        for i in ions:
-            mzs.append(i.mz)
-            intensities.append(i.intensity)
+        Keyword arguments:
+        intensities -- A numpy array of ion intensities, with missing values
+            as NaN.
+        scaling -- Divide the intensities by the maximum intensity.
+        filtering -- Flag ions with intensity below eps for removal.
+        eps -- The minimum intensity to keep when filtering.
+
+        Returns:
+        intensities -- The (possibly scaled) intensities.
+        keep -- A boolean mask of ions to retain, or None if all ions are
+            retained.
+        """
 
-            if i.intensity is not None:
-                all_none = False
+        if not scaling and not filtering:
+            return intensities, None  # Nothing is done
 
-            if i.intensity > max_inten:
-                max_inten = i.intensity
+        present = ~np.isnan(intensities)
 
         # Can't do anything without intensities.
-        if all_none:
-            return ions
+        if not present.any():
+            return intensities, None
 
         if scaling:
+            max_inten = intensities[present].max()
             if max_inten > 0.0:
-                # Divide by max if values aren't none.
-                # Keep none values around though.
-                intensities = list(map(
-                    lambda i: i / max_inten if i is not None else None,
-                    intensities
-                ))
-            else:
-                intensities = intensities
-
-        # Precompute filter mask.
-        # Still get cost if not filtering, but makes code simpler.
-        # When this is true, the value will be retained
-        filter_mask = map(
-            lambda i: i >= eps if i is not None else True,
-            intensities
+                # NaN values stay NaN.
+                intensities = intensities / max_inten
+
+        if not filtering:
+            return intensities, None
+
+        # Missing intensities are always retained.
+        with np.errstate(invalid="ignore"):
+            keep = ~present | (intensities >= eps)
+
+        return intensities, keep
+
+    @classmethod
+    def _get_altered_ions(cls, ions, scaling, filtering, eps=0.0):
+        """ Scale and filter a list of Ion objects. """
+
+        mzs = np.array([i.mz for i in ions], dtype=np.float64)
+        intensities = np.array(
+            [_none_to_nan(i.intensity) for i in ions],
+            dtype=np.float64
         )
 
-        ret_ions = [
-            Ion(mz, inten)
-            for mz, inten, mask
-            in zip(mzs, intensities, filter_mask)
-            if (filtering and mask) or (not filtering)
-        ]
+        intensities, keep = cls._alter_intensities(
+            intensities,
+            scaling=scaling,
+            filtering=filtering,
+            eps=eps
+        )
 
-        return ret_ions
+        if keep is not None:
+            mzs = mzs[keep]
+            intensities = intensities[keep]
+
+        return _to_ions(mzs, intensities)
 
     @classmethod
-    def _read(cls, lines, scaling=False, filtering=False, eps=0.0):
+    def _read_columns(cls, lines, scaling=False, filtering=False, eps=0.0):
+        """ Read a block of lines into the columns of a single record.
+
+        Peak lines are collected first, and any scaling or filtering is
+        applied once to the whole block.
+
+        Returns:
+        A tuple of title, retention, pepmass, charge, and numpy arrays of ion
+        m/z values and intensities.
+        """
+
         title = None
         retention = None
         pepmass = None
         charge = None
-        ions = []
-        ret_ions = []
+        mzs = []
+        intensities = []
         for line in lines:
             if line.startswith("TITLE"):
                 title = cls._get_title(line)
@@ -255,16 +1426,38 @@ class MGFRecord(object):
             else:
                 # Eventually need to wrap this in try... except
                 ion = cls._get_ion(line)
-                ions.append(ion)
+                mzs.append(ion.mz)
+                intensities.append(_none_to_nan(ion.intensity))
+
+        mzs = np.array(mzs, dtype=np.float64)
+        intensities = np.array(intensities, dtype=np.float64)
+
+        intensities, keep = cls._alter_intensities(
+            intensities,
+            scaling=scaling,
+            filtering=filtering,
+            eps=eps
+        )
 
-            ret_ions = MGFRecord._get_altered_ions(
-                ions,
+        if keep is not None:
+            mzs = mzs[keep]
+            intensities = intensities[keep]
+
+        return title, retention, pepmass, charge, mzs, intensities
+
+    @classmethod
+    def _read(cls, lines, scaling=False, filtering=False, eps=0.0):
+        title, retention, pepmass, charge, mzs, intensities = (
+            cls._read_columns(
+                lines,
                 scaling=scaling,
                 filtering=filtering,
                 eps=eps
             )
+        )
 
-        return cls(title, retention, pepmass, charge, ret_ions)
+        return cls(title, retention, pepmass, charge,
+                   _to_ions(mzs, intensities))
 
     @classmethod
     def parse(cls, handle, scaling=False, filtering=False, eps=0.0):
@@ -275,30 +1468,38 @@ class MGFRecord(object):
         """
 
         output = []
-
-        in_block = False
-        block = []
-        for line in handle:
-            if line.startswith("END"):
-                output.append(
-                    cls._read(
-                        block,
-                        scaling=scaling,
-                        filtering=filtering,
-                        eps=eps
-                    )
+        for block in _iter_blocks(handle):
+            output.append(
+                cls._read(
+                    block,
+                    scaling=scaling,
+                    filtering=filtering,
+                    eps=eps
                 )
-                block = []
-                in_block = False
+            )
 
-            elif line.startswith("BEGIN"):
-                assert len(block) == 0
-                in_block = True
+        return output
 
-            elif in_block:
-                block.append(line.strip())
 
-        return output
+def _iter_blocks(handle):
+    """ Yield the stripped lines between each BEGIN and END line. """
+
+    in_block = False
+    block = []
+    for line in handle:
+        if line.startswith("END"):
+            yield block
+            block = []
+            in_block = False
+
+        elif line.startswith("BEGIN"):
+            assert len(block) == 0
+            in_block = True
+
+        elif in_block:
+            block.append(line.strip())
+
+    return
 
 
 def split_msms_title(line):
@@ -360,41 +1561,209 @@ class SampleRecord(object):
 
 
 def remove_redundancy(samples, mgf, mz_tol=0.002, retention_tol=5,
-                      neutral=False):
+                      neutral=False, n_jobs=1):
     """ Selects the closest trigger mass to the real sample mass
     Prints the best trigger id and ion list
+
+    Keyword arguments:
+    n_jobs -- The number of threads to match samples with. The samples are
+        split into chunks which are matched against the shared MGF object,
+        and the results are joined in the original order, so the table is
+        identical to the serial output. -1 uses all available cpus.
+
+    Returns:
+    A table with a row per ion, sorted by mz. The component and sample
+    columns are categorical.
     """
 
-    output = []
+    n_jobs = n_workers(n_jobs)
+
+    mzs = np.array([sample.mz for sample in samples], dtype=np.float64)
+    retentions = np.array([sample.retention for sample in samples],
+                          dtype=np.float64)
+
+    if n_jobs > 1 and len(samples) > 1:
+        n_chunks = min(len(samples), 4 * n_jobs)
+        bounds = np.linspace(0, len(samples), n_chunks + 1).astype(int)
+        chunks = [
+            slice(start, end)
+            for start, end
+            in zip(bounds[:-1], bounds[1:])
+        ]
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(
+                lambda chunk: mgf.closest_many(mzs[chunk], retentions[chunk],
+                                               mz_tol, retention_tol),
+                chunks
+            ))
+
+        indices = np.concatenate(parts)
+
+    else:
+        # Find the closest triggers in the MGF for all samples at once.
+        indices = mgf.closest_many(mzs, retentions, mz_tol, retention_tol)
+
+    matched = np.flatnonzero(indices >= 0)
+    indices = indices[matched]
+
+    # The sample names are only formatted once per trigger.
+    names = [
+        _sample_name(title, pepmass, retention)
+        for title, pepmass, retention
+        in zip(mgf.titles[indices],
+               mgf.pepmasses[indices].tolist(),
+               mgf.retentions[indices].tolist())
+    ]
+
+    ion_indices, lengths = mgf._ion_indices(indices)
+    return _ion_table(
+        [samples[i].original for i in matched.tolist()],
+        names,
+        mgf.pepmasses[indices],
+        lengths,
+        mgf.ion_mzs[ion_indices],
+        neutral=neutral
+    )
+
+
+def remove_redundancy_stream(samples, records, mz_tol=0.002, retention_tol=5,
+                             neutral=False):
+    """ Selects the closest trigger for each sample from a stream of records.
+
+    Gives the same table as `remove_redundancy`, but instead of indexing the
+    MGF, the samples are indexed by mz and each record is matched against
+    them as it is read. Only the best trigger seen so far is kept for each
+    sample, so memory is bounded by the number of samples rather than the
+    size of the MGF.
+
+    Keyword arguments:
+    samples -- A list of SampleRecord objects.
+    records -- An iterable of MGFRecord objects, e.g. from MGF.iter_records.
+    """
+
+    sample_mzs = np.array([s.mz for s in samples], dtype=np.float64)
+    sample_retentions = np.array([s.retention for s in samples],
+                                 dtype=np.float64)
+
+    # The mz windows are computed the same way as in MGF.closest.
+    # Both bounds stay sorted when the samples are sorted by mz.
+    order = np.argsort(sample_mzs, kind="stable")
+    lower_mzs = (sample_mzs - mz_tol)[order]
+    upper_mzs = (sample_mzs + mz_tol)[order]
+
+    lower_retentions = sample_retentions - retention_tol
+    upper_retentions = sample_retentions + retention_tol
 
-    # Looping through real samples.
-    for sample in samples:
-        # Find all close triggers in the MGF.
-        trigger = mgf.closest(sample.mz, sample.retention, mz_tol,
-                              retention_tol)
+    best_keys = [None] * len(samples)
+    best_matches = [None] * len(samples)
 
-        if trigger is None:
+    for position, record in enumerate(records):
+        mz = record.pepmass.mz
+        retention = record.retention
+
+        # Samples with lower_mz <= mz < upper_mz.
+        start = np.searchsorted(upper_mzs, mz, side="right")
+        end = np.searchsorted(lower_mzs, mz, side="right")
+        if start >= end:
             continue
 
-        # Add all of the ion masses
-        for ion in trigger.ions:
-            if neutral:
-                # get neutral loss
-                ion_mz = round(ion.mz - trigger.pepmass.mz, 5)
-            else:
-                ion_mz = ion.mz
-
-            record = (
-                sample.original,
-                "{}_{}_{}".format(trigger.title,
-                                  trigger.pepmass.mz,
-                                  trigger.retention),
-                ion_mz
-                )
-            output.append(record)
+        candidates = order[start:end]
+        candidates = candidates[
+            (retention > lower_retentions[candidates])
+            & (retention < upper_retentions[candidates])
+        ]
+
+        match = None
+        for i in candidates.tolist():
+            # Ties are broken the same way as scanning a sorted MGF.
+            key = (abs(sample_retentions[i] - retention), mz, position)
+
+            if best_keys[i] is None or key < best_keys[i]:
+                if match is None:
+                    match = (
+                        _sample_name(record.title, mz, retention),
+                        mz,
+                        np.array([ion.mz for ion in record.ions],
+                                 dtype=np.float64),
+                    )
+
+                best_keys[i] = key
+                best_matches[i] = match
+
+    matched = [
+        (sample.original, ) + match
+        for sample, match
+        in zip(samples, best_matches)
+        if match is not None
+    ]
+
+    if len(matched) == 0:
+        return _ion_table([], [], [], [], [], neutral=neutral)
+
+    components, names, pepmasses, ion_mzs = zip(*matched)
+    return _ion_table(
+        components,
+        names,
+        pepmasses,
+        [len(m) for m in ion_mzs],
+        np.concatenate(ion_mzs),
+        neutral=neutral
+    )
+
+
+def _sample_name(title, pepmass, retention):
+    """ Format the name of a trigger spectrum. """
+    return "{}_{}_{}".format(title, float(pepmass), float(retention))
+
+
+def _ion_table(components, names, pepmasses, lengths, ion_mzs,
+               neutral=False):
+    """ Build the long-form table of component, sample and ion mz.
+
+    The columns are assembled as arrays, and the component and sample
+    columns are stored as categoricals so that each string is only held
+    once.
+
+    Keyword arguments:
+    components -- The component name of each matched sample.
+    names -- The name of the trigger matched to each sample.
+    pepmasses -- The pepmass mz of the trigger matched to each sample.
+    lengths -- The number of ions of the trigger matched to each sample.
+    ion_mzs -- The ion mzs of all triggers, concatenated in the same order.
+    neutral -- Convert the ion masses to neutral losses.
+    """
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    mzs = np.array(ion_mzs, dtype=np.float64)
+
+    if neutral:
+        # get neutral loss
+        mzs -= np.repeat(np.asarray(pepmasses, dtype=np.float64), lengths)
+        mzs = np.round(mzs, 5)
+
+    component_codes, component_categories = pd.factorize(
+        np.asarray(components, dtype=object),
+        sort=True
+    )
+    name_codes, name_categories = pd.factorize(
+        np.asarray(names, dtype=object),
+        sort=True
+    )
 
     # Return the table, sorted by mz
-    table = pd.DataFrame(output, columns=['component', 'sample', 'mz'])
-    table.sort_values(by='mz', inplace=True)
-    table.reset_index(drop=True, inplace=True)
+    order = np.argsort(mzs, kind="stable")
+    row_matches = np.repeat(np.arange(len(lengths)), lengths)[order]
+
+    table = pd.DataFrame({
+        "component": pd.Categorical.from_codes(
+            component_codes[row_matches],
+            categories=component_categories
+        ),
+        "sample": pd.Categorical.from_codes(
+            name_codes[row_matches],
+            categories=name_categories
+        ),
+        "mz": mzs[order],
+    })
     return table
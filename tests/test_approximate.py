@@ -0,0 +1,150 @@
+"""
+"""
+
+import pytest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.cluster.hierarchy import linkage
+from scipy.cluster.hierarchy import fcluster
+from scipy.cluster.hierarchy import is_valid_linkage
+from scipy.spatial.distance import pdist
+
+from BioDendro.approximate import minhash
+from BioDendro.approximate import rows_per_band
+from BioDendro.approximate import similarity_threshold
+from BioDendro.approximate import candidate_pairs
+from BioDendro.approximate import approximate_linkage
+from BioDendro.approximate import adjusted_rand_index
+from BioDendro.approximate import compare_clusters
+
+
+def grouped_onehot(n_groups=20, per_group=10, n_bins=2000, seed=0):
+    """ Samples drawn from well separated groups of bins. """
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(n_groups):
+        template = rng.choice(n_bins, 20, replace=False)
+        for _ in range(per_group):
+            row = np.zeros(n_bins, dtype=bool)
+            row[template[rng.random(20) < 0.85]] = True
+            row[rng.choice(n_bins, 2)] = True
+            rows.append(row)
+
+    return np.array(rows)
+
+
+def test_minhash():
+    dense = grouped_onehot(n_groups=2, per_group=5)
+    signatures = minhash(csr_matrix(dense), n_hashes=512, seed=1)
+
+    assert signatures.shape == (10, 512)
+    assert signatures.dtype == np.uint32
+
+    # The fraction of equal hashes estimates the Jaccard similarity.
+    similarity = 1 - pdist(dense, "jaccard")
+    estimate = pdist(signatures, lambda u, v: np.mean(u == v))
+    assert np.abs(similarity - estimate).max() < 0.15
+    return
+
+
+def test_minhash_empty_rows():
+    matrix = csr_matrix(np.array([
+        [False, False, False],
+        [True, False, True],
+        [False, False, False],
+    ]))
+
+    signatures = minhash(matrix, n_hashes=8)
+    assert (signatures[[0, 2]] == np.iinfo(np.uint32).max).all()
+    assert (signatures[1] < np.iinfo(np.uint32).max).all()
+    return
+
+
+@pytest.mark.parametrize("cutoff,metric,expected", [
+    (0.6, "jaccard", 0.4),
+    (0.0, "jaccard", 1.0),
+    (0.5, "braycurtis", 1 / 3),
+    ])
+def test_similarity_threshold(cutoff, metric, expected):
+    assert similarity_threshold(cutoff, metric) == pytest.approx(expected)
+    return
+
+
+@pytest.mark.parametrize("similarity", [0.2, 0.4, 0.8])
+def test_rows_per_band(similarity):
+    rows = rows_per_band(128, similarity, recall=0.99)
+    bands = 128 // rows
+
+    assert 1 - (1 - similarity ** rows) ** bands >= 0.99
+
+    # One more row per band wouldn't reach the recall.
+    more = 128 // (rows + 1)
+    assert 1 - (1 - similarity ** (rows + 1)) ** more < 0.99
+    return
+
+
+def test_candidate_pairs():
+    signatures = np.array([
+        [1, 2, 3, 4],
+        [1, 2, 5, 6],
+        [7, 8, 5, 6],
+        [9, 9, 9, 9],
+        [1, 2, 3, 4],
+    ], dtype=np.uint32)
+
+    i, j = candidate_pairs(signatures, rows=2)
+    assert list(zip(i.tolist(), j.tolist())) == [
+        (0, 1), (0, 4), (1, 2), (1, 4)
+    ]
+    return
+
+
+def test_candidate_pairs_max_bucket():
+    signatures = np.zeros((10, 4), dtype=np.uint32)
+
+    i, j = candidate_pairs(signatures, rows=2, max_bucket=2)
+    assert len(i) == 9 + 8
+    assert (j - i <= 2).all()
+    return
+
+
+@pytest.mark.parametrize("metric", ["jaccard", "braycurtis"])
+def test_approximate_linkage(metric):
+    dense = grouped_onehot()
+
+    tree = approximate_linkage(csr_matrix(dense), metric=metric, cutoff=0.6)
+    exact = linkage(pdist(dense, metric), method="complete")
+
+    assert is_valid_linkage(tree)
+    assert tree[:, 2].max() <= 1.0
+
+    actual = fcluster(tree, 0.6, "distance")
+    expected = fcluster(exact, 0.6, "distance")
+    assert adjusted_rand_index(actual, expected) == 1.0
+    return
+
+
+@pytest.mark.parametrize("a,b,expected", [
+    ([0, 0, 1, 1], [0, 0, 1, 1], 1.0),
+    ([0, 0, 1, 1], [1, 1, 0, 0], 1.0),
+    ([0, 0, 1, 1], [0, 0, 1, 2], 4 / 7),
+    ([0, 0, 0, 0], [0, 1, 2, 3], 0.0),
+    ([0, 1, 2], [0, 1, 2], 1.0),
+    ])
+def test_adjusted_rand_index(a, b, expected):
+    assert adjusted_rand_index(np.array(a), np.array(b)) == pytest.approx(
+        expected
+    )
+    return
+
+
+def test_compare_clusters():
+    actual = compare_clusters(np.array([0, 0, 1, 2]), np.array([0, 0, 1, 1]))
+
+    assert actual["n_clusters"] == 3
+    assert actual["n_clusters_exact"] == 2
+    assert actual["pair_precision"] == 1.0
+    assert actual["pair_recall"] == 0.5
+    return
@@ -1,11 +1,31 @@
 """
 """
 
+import tracemalloc
+from os.path import dirname
+from os.path import exists
+from os.path import join as pjoin
+
 import pytest
 
+import numpy as np
 import pandas as pd
+from scipy.io import mmread
+from scipy.sparse import csr_matrix
+from scipy.sparse import load_npz
+from scipy.cluster.hierarchy import linkage
+from scipy.cluster.hierarchy import fcluster
+from scipy.cluster.hierarchy import is_valid_linkage
+from scipy.cluster.hierarchy import is_monotonic
+from scipy.spatial.distance import pdist
 
 from BioDendro.cluster import Tree
+from BioDendro.preprocess import MGF
+from BioDendro.preprocess import SampleRecord
+from BioDendro.preprocess import remove_redundancy
+from BioDendro.preprocess import split_msms_title
+
+EXAMPLE_DIR = pjoin(dirname(__file__), "..")
 
 
 # Test Tree methods
@@ -73,6 +93,77 @@ def test_Tree__bin_names(sample, starts, expected):
     return
 
 
+@pytest.mark.parametrize("n,starts,expected", [
+    (3, [0, 1, 2], [0, 1, 2]),
+    (4, [0, 1, 3], [0, 1, 1, 2]),
+    (4, [0, 2], [0, 0, 1, 1]),
+    (0, [], []),
+    ])
+def test_Tree__bin_ids(n, starts, expected):
+    actual = Tree._bin_ids(n, starts)
+    assert actual.tolist() == expected
+    return
+
+
+def test_Tree__bin_stats():
+    actual = Tree._bin_stats([1, 3, 4, 7], [0, 1, 3])
+
+    assert actual["mz_mean"].tolist() == [1.0, 3.5, 7.0]
+    assert actual["mz_min"].tolist() == [1.0, 3.0, 7.0]
+    assert actual["mz_max"].tolist() == [1.0, 4.0, 7.0]
+    return
+
+
+@pytest.mark.parametrize("neutral", [False, True])
+def test_Tree__bin_stats_example_names(neutral):
+    """ Bin names must match naming each bin with _bin_name, as users join
+    processed and summary outputs on them.
+    """
+
+    mgf_path = pjoin(EXAMPLE_DIR, "Fireflies_MSMS.mgf")
+    components_path = pjoin(EXAMPLE_DIR, "Fireflies_feature_list.txt")
+    if not (exists(mgf_path) and exists(components_path)):
+        pytest.skip("The Fireflies example data isn't available.")
+
+    with open(components_path, "r") as handle:
+        components = SampleRecord.parse(handle)
+
+    mgf = MGF.parse(mgf_path)
+    mgf.titles[:] = [split_msms_title(title) for title in mgf.titles]
+    table = remove_redundancy(components, mgf, neutral=neutral)
+
+    column = np.sort(table["mz"].values, kind="stable")
+    starts = Tree._bin_starts(column, 8e-4)
+    ends = np.append(starts[1:], len(column))
+
+    expected = [Tree._bin_name(column[s:e]) for s, e in zip(starts, ends)]
+    actual = Tree._format_bin_names(Tree._bin_stats(column, starts))
+
+    assert actual.tolist() == expected
+    return
+
+
+def test_Tree_bin_labels():
+    df = pd.DataFrame({
+        "component": ["a", "b", "a", "c"],
+        "mz": [1.0, 1.0002, 3.0, 5.0],
+    })
+
+    tree = Tree(threshold=0.01)
+    tree.fit(df)
+
+    assert tree.onehot_columns.tolist() == [0, 1, 2]
+    assert list(tree.bin_labels([2, 0])) == [
+        "5.0000_5.0000_5.0000",
+        "1.0001_1.0000_1.0002",
+    ]
+    assert list(tree.onehot_df.columns) == list(tree.bin_labels())
+
+    table = tree.cluster_table(sample="c")
+    assert list(table.columns) == ["5.0000_5.0000_5.0000"]
+    return
+
+
 @pytest.mark.parametrize("sample,bins,expected", [
     (
         {"sample": [1, 2, 3, 4]},
@@ -106,6 +197,342 @@ def test_Tree__pivot(sample, bins, expected):
     return
 
 
+def test_Tree__sparse_onehot():
+    samples = ["b", "a", "b", "c", "a"]
+    bins = ["y", "x", "y", "z", "z"]
+
+    matrix, index, columns = Tree._sparse_onehot(samples, bins)
+
+    assert list(index) == ["a", "b", "c"]
+    assert list(columns) == ["x", "y", "z"]
+    assert matrix.dtype == bool
+    assert matrix.toarray().tolist() == [
+        [True, False, True],
+        [False, True, False],
+        [False, False, True],
+    ]
+    return
+
+
+def test_Tree_onehot_df():
+    df = pd.DataFrame({
+        "component": ["a", "b", "a", "c"],
+        "mz": [1.0, 1.0002, 3.0, 5.0],
+    })
+
+    tree = Tree(threshold=0.01)
+    tree.fit(df)
+
+    assert tree.onehot.shape == (3, 3)
+    assert tree.onehot_df.index.name == "component"
+    assert list(tree.onehot_df.index) == ["a", "b", "c"]
+    assert tree.onehot_df.values.tolist() == tree.onehot.toarray().tolist()
+    return
+
+
+@pytest.mark.parametrize("clustering_method", ["jaccard", "braycurtis"])
+def test_Tree_low_memory(tmpdir, clustering_method):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "component": rng.integers(0, 30, 200).astype(str),
+        "mz": np.sort(rng.integers(0, 40, 200) + rng.random(200) * 1e-4),
+    })
+
+    expected = Tree(threshold=0.01, clustering_method=clustering_method)
+    expected.fit(df)
+
+    actual = Tree(
+        threshold=0.01,
+        clustering_method=clustering_method,
+        low_memory=True,
+        temp_dir=str(tmpdir)
+    )
+    actual.fit(df)
+
+    assert np.array_equal(actual.tree[:, [0, 1, 3]],
+                          expected.tree[:, [0, 1, 3]])
+    assert np.allclose(actual.tree[:, 2], expected.tree[:, 2])
+    assert np.array_equal(actual.clusters, expected.clusters)
+
+    # The temporary distance file should be cleaned up.
+    assert tmpdir.listdir() == []
+    return
+
+
+def test_Tree__unique_rows():
+    matrix = csr_matrix(np.array([
+        [True, False, True],
+        [False, True, False],
+        [True, False, True],
+        [False, False, False],
+        [False, True, False],
+        [False, False, False],
+    ]))
+
+    codes, representatives = Tree._unique_rows(matrix)
+    assert codes.tolist() == [0, 1, 0, 2, 1, 2]
+    assert representatives.tolist() == [0, 1, 3]
+    return
+
+
+def test_Tree__expand_linkage():
+    rng = np.random.default_rng(0)
+    profiles = rng.random((6, 4)) < 0.5
+    codes = np.array([0, 1, 2, 0, 3, 4, 5, 0, 2, 5])
+
+    unique_tree = linkage(pdist(profiles, "jaccard"), method="complete")
+    full_tree = linkage(pdist(profiles[codes], "jaccard"), method="complete")
+
+    actual = Tree._expand_linkage(unique_tree, codes)
+
+    assert actual.shape == (len(codes) - 1, 4)
+    assert is_valid_linkage(actual)
+    assert is_monotonic(actual)
+    assert (actual[:4, 2] == 0).all()
+    assert actual[-1, 3] == len(codes)
+
+    for cutoff in [0.0, 0.3, 0.6, 0.9]:
+        expected_clusters = fcluster(full_tree, cutoff, "distance")
+        actual_clusters = fcluster(actual, cutoff, "distance")
+
+        # The same partition, though clusters may be numbered differently.
+        pairs = set(zip(expected_clusters, actual_clusters))
+        assert len(pairs) == len(set(expected_clusters))
+        assert len(pairs) == len(set(actual_clusters))
+    return
+
+
+def test_Tree_fit_identical_samples():
+    df = pd.DataFrame({
+        "component": ["a", "b", "c", "a", "b", "c", "d"],
+        "mz": [1.0, 1.0, 1.0, 2.0, 2.0, 3.0, 4.0],
+    })
+
+    tree = Tree(threshold=0.01)
+    tree.fit(df)
+
+    assert tree.profiles.tolist() == [0, 0, 1, 2]
+    assert is_valid_linkage(tree.tree)
+    assert tree.tree.shape == (3, 4)
+    assert tree.cluster_map["a"] == tree.cluster_map["b"]
+    assert tree.cluster_map["a"] != tree.cluster_map["d"]
+    return
+
+
+def test_Tree_fit_all_identical_samples():
+    df = pd.DataFrame({
+        "component": ["a", "b", "c"],
+        "mz": [1.0, 1.0, 1.0],
+    })
+
+    tree = Tree(threshold=0.01)
+    tree.fit(df)
+
+    assert tree.tree[:, 2].tolist() == [0.0, 0.0]
+    assert len(set(tree.clusters)) == 1
+    return
+
+
+def test_Tree_fit_peak_memory():
+    """ Fitting shouldn't copy the ion table. """
+
+    rng = np.random.default_rng(4)
+    n = 200000
+    df = pd.DataFrame({
+        "component": pd.Categorical(rng.integers(0, 100, n).astype(str)),
+        "mz": np.sort(rng.integers(0, 2000, n) + rng.random(n) * 1e-4),
+    })
+    table_bytes = df.memory_usage(deep=True).sum()
+
+    tree = Tree()
+    tracemalloc.start()
+    try:
+        tree.fit(df)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # The mz column is used without copying it.
+    assert np.shares_memory(tree._mz, df["mz"].to_numpy())
+
+    # Each copy of the table would add ~1x. Binning needs ~3.5x for
+    # diffs, codes and the sparse matrix construction.
+    assert peak < 5 * table_bytes
+    return
+
+
+def sweep_data():
+    rng = np.random.default_rng(3)
+    return pd.DataFrame({
+        "component": rng.integers(0, 25, 150).astype(str),
+        "mz": np.sort(rng.integers(0, 30, 150) + rng.random(150) * 1e-3),
+    })
+
+
+def test_Tree_sweep():
+    df = sweep_data()
+
+    tree = Tree(threshold=0.01)
+    tree.fit(df)
+    fitted_clusters = tree.clusters.copy()
+
+    actual = tree.sweep(
+        cutoffs=[0.3, 0.6],
+        thresholds=[0.01, 0.0005],
+        methods=["jaccard", "braycurtis"]
+    )
+
+    assert len(actual) == 8
+    assert np.array_equal(tree.clusters, fitted_clusters)
+
+    for row in actual.itertuples():
+        expected = Tree(
+            threshold=row.threshold,
+            clustering_method=row.clustering_method,
+            cutoff=row.cutoff
+        )
+        expected.fit(df)
+        sizes = np.unique(expected.clusters, return_counts=True)[1]
+
+        assert row.n_bins == expected.onehot.shape[1]
+        assert row.n_clusters == len(sizes)
+        assert row.n_singletons == np.sum(sizes == 1)
+        assert row.largest_cluster == sizes.max()
+        assert row.mean_cluster_size == pytest.approx(sizes.mean())
+    return
+
+
+def test_Tree_sweep_memoised(monkeypatch):
+    tree = Tree(threshold=0.01)
+    tree.fit(sweep_data())
+
+    calls = []
+    linkage_ = Tree._linkage
+
+    def counted(self, onehot, clustering_method, *args):
+        calls.append(clustering_method)
+        return linkage_(self, onehot, clustering_method, *args)
+
+    monkeypatch.setattr(Tree, "_linkage", counted)
+
+    # The fitted threshold and method are already clustered.
+    tree.sweep(cutoffs=[0.2, 0.4, 0.6, 0.8])
+    assert calls == []
+
+    tree.sweep(cutoffs=0.5, methods=["jaccard", "braycurtis"])
+    tree.sweep(cutoffs=[0.1, 0.9], methods="braycurtis")
+    assert calls == ["braycurtis"]
+    return
+
+
+def test_Tree_minhash_engine():
+    rng = np.random.default_rng(5)
+    components = []
+    mzs = []
+    for group in range(10):
+        template = rng.choice(500, 12, replace=False)
+        for member in range(8):
+            bins = template[rng.random(12) < 0.9]
+            components.extend(["{}_{}".format(group, member)] * len(bins))
+            mzs.extend(bins + 100.0)
+
+    df = pd.DataFrame({"component": components, "mz": mzs})
+    df = df.sort_values("mz", kind="stable").reset_index(drop=True)
+
+    tree = Tree(threshold=0.01, engine="minhash")
+    tree.fit(df)
+
+    assert is_valid_linkage(tree.tree)
+    assert len(tree.cluster_map) == 80
+
+    report = tree.compare_exact(cutoffs=[0.4, 0.6])
+    assert report["cutoff"].tolist() == [0.4, 0.6]
+
+    # Ties are broken as in the exact engine, so the only differences
+    # would come from similar pairs that MinHash misses.
+    assert (report["adjusted_rand_index"] == 1.0).all()
+    return
+
+
+@pytest.mark.parametrize("linkage_method", [
+    "single",
+    "complete",
+    "average",
+    "weighted",
+    ])
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_Tree_linkage_method(tmpdir, linkage_method, low_memory):
+    df = sweep_data()
+
+    tree = Tree(
+        threshold=0.01,
+        linkage_method=linkage_method,
+        low_memory=low_memory,
+        temp_dir=str(tmpdir)
+    )
+    tree.fit(df)
+
+    # Compare to clustering every sample, including identical ones.
+    dense = tree.onehot.toarray()
+    expected = linkage(pdist(dense, "jaccard"), method=linkage_method)
+
+    assert is_valid_linkage(tree.tree)
+    assert np.allclose(
+        np.sort(tree.tree[:, 2]),
+        np.sort(expected[:, 2]),
+        atol=1e-6
+    )
+    return
+
+
+def test_Tree_bad_linkage_method():
+    with pytest.raises(ValueError):
+        Tree(linkage_method="ward")
+    return
+
+
+def test_Tree_sweep_linkage_methods():
+    tree = Tree(threshold=0.01)
+    tree.fit(sweep_data())
+
+    actual = tree.sweep(cutoffs=0.6, linkage_methods=["single", "complete"])
+    assert actual["linkage_method"].tolist() == ["single", "complete"]
+
+    # Single linkage clusters are unions of complete linkage clusters.
+    assert actual["n_clusters"][0] <= actual["n_clusters"][1]
+    return
+
+
+def test_Tree_minhash_cutoff():
+    df = sweep_data()
+
+    tree = Tree(threshold=0.01, engine="minhash", cutoff=0.2)
+    tree.fit(df)
+
+    tuned = Tree(threshold=0.01, engine="minhash", cutoff=0.6)
+    tuned.fit(df)
+
+    # Sweeps build the tree for the largest cutoff.
+    cutoffs = [0.2, 0.6]
+    assert tree.sweep(cutoffs=cutoffs).equals(tuned.sweep(cutoffs=cutoffs))
+
+    # Cutting above the tuned cutoff rebuilds the tree, below reuses it.
+    tree.cut_tree(0.6)
+    assert np.array_equal(tree.tree, tuned.tree)
+    assert tree.clusters.tolist() == tuned.clusters.tolist()
+
+    rebuilt = tree.tree
+    tree.cut_tree(0.4)
+    assert tree.tree is rebuilt
+    return
+
+
+def test_Tree_bad_engine():
+    with pytest.raises(ValueError):
+        Tree(engine="fast")
+    return
+
+
 @pytest.mark.parametrize("columns,values,expected", [
     (
         ['a', 'b', 'c', 'd'],
@@ -141,3 +568,250 @@ def test_Tree__exclude_false_columns(columns, values, expected):
     for col in expected:
         assert col in actual.columns
     return
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_Tree_write_summaries(tmpdir, n_jobs):
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+
+    calls = []
+    tree.write_summaries(
+        path=str(tmpdir),
+        n_jobs=n_jobs,
+        progress=lambda done, total: calls.append((done, total))
+    )
+
+    labels, sizes = np.unique(tree.clusters, return_counts=True)
+    expected = {"clusters.xlsx"}
+    for label, size in zip(labels, sizes):
+        expected.add("cluster_{}_{}.xlsx".format(label, size))
+        expected.add("cluster_{}_{}.png".format(label, size))
+
+    assert set(f.basename for f in tmpdir.listdir()) == expected
+    assert calls == [(i, len(labels)) for i in range(1, len(labels) + 1)]
+
+    table = pd.read_excel(
+        str(tmpdir.join("cluster_{}_{}.xlsx".format(labels[0], sizes[0]))),
+        index_col=0
+    )
+    assert table.shape[0] == sizes[0]
+    return
+
+
+def test_Tree_membership_table():
+    tree = Tree(threshold=0.01)
+    tree.fit(sweep_data())
+
+    actual = tree.membership_table()
+    assert actual.columns.tolist() == [
+        "component",
+        "cluster",
+        "bin",
+        "mz_mean",
+        "mz_min",
+        "mz_max",
+    ]
+    assert len(actual) == tree.onehot.nnz
+
+    # The mz columns match the bin names.
+    names = actual["mz_mean"].map("{:.4f}".format)
+    assert (actual["bin"].astype(str).str.split("_").str[0] == names).all()
+    assert (actual["mz_min"] <= actual["mz_max"]).all()
+
+    # Pivoting back gives the one-hot table.
+    wide = pd.crosstab(actual["component"], actual["bin"]) > 0
+    expected = tree.onehot_df
+    assert wide.loc[expected.index, expected.columns].values.tolist() == (
+        expected.values.tolist()
+    )
+
+    clusters = actual.groupby("component")["cluster"].first()
+    assert clusters[tree.onehot_index].tolist() == tree.clusters.tolist()
+    return
+
+
+def test_Tree_write_summaries_csv(tmpdir):
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+    tree.write_summaries(path=str(tmpdir), file_format="csv")
+
+    files = set(f.basename for f in tmpdir.listdir())
+    assert "memberships.csv" in files
+    assert "clusters.xlsx" not in files
+    assert not any(f.endswith(".xlsx") for f in files)
+
+    actual = pd.read_csv(str(tmpdir.join("memberships.csv")))
+    assert len(actual) == tree.onehot.nnz
+    return
+
+
+@pytest.mark.parametrize("sparse_format", ["mtx", "npz"])
+def test_Tree_write_sparse_matrix(tmpdir, sparse_format):
+    tree = Tree(threshold=0.01)
+    tree.fit(sweep_data())
+    tree.write_summaries(
+        path=str(tmpdir),
+        file_format="csv",
+        wide_table=True,
+        sparse_matrix=sparse_format
+    )
+
+    files = set(f.basename for f in tmpdir.listdir())
+    assert "clusters.csv" in files
+    assert "memberships.csv" not in files
+
+    filename = str(tmpdir.join("onehot." + sparse_format))
+    if sparse_format == "npz":
+        matrix = load_npz(filename)
+    else:
+        matrix = mmread(filename)
+
+    samples = pd.read_csv(str(tmpdir.join("onehot_samples.csv")))
+    bins = pd.read_csv(str(tmpdir.join("onehot_bins.csv")))
+    actual = pd.DataFrame(
+        matrix.toarray() > 0,
+        index=samples["component"].astype(str),
+        columns=bins["bin"]
+    )
+
+    expected = tree.onehot_df
+    assert actual.values.tolist() == expected.values.tolist()
+    assert actual.index.tolist() == expected.index.tolist()
+    assert actual.columns.tolist() == expected.columns.tolist()
+    assert samples["cluster"].tolist() == tree.clusters.tolist()
+    assert bins.columns.tolist() == ["bin", "mz_mean", "mz_min", "mz_max"]
+    return
+
+
+def test_Tree_bin_frequencies():
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+
+    actual = tree.bin_frequencies()
+    expected = tree.onehot_df.groupby(tree.clusters).mean()
+
+    assert actual.shape == expected.shape
+    assert np.array_equal(actual.toarray(), expected.values)
+
+    # Kept until the tree is cut again.
+    assert tree.bin_frequencies() is actual
+    tree.cut_tree(0.6)
+    assert tree.bin_frequencies() is not actual
+    return
+
+
+def test_Tree_cluster_table():
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+
+    for cluster in np.unique(tree.clusters):
+        actual = tree.cluster_table(cluster)
+
+        expected = tree.onehot_df.loc[tree.clusters == cluster]
+        expected = expected.loc[:, expected.any(axis=0)]
+        assert actual.equals(expected)
+
+    sample = tree.onehot_index[0]
+    assert tree.cluster_table(sample=sample).equals(
+        tree.cluster_table(tree.clusters[0])
+    )
+    return
+
+
+def test_Tree_cluster_hist():
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+
+    cluster = tree.clusters[0]
+    fig, ax = tree.cluster_hist(cluster)
+
+    expected = tree.cluster_table(cluster).mean(axis=0)
+    heights = [patch.get_height() for patch in ax.patches]
+    labels = [label.get_text() for label in ax.get_xticklabels()]
+
+    assert np.allclose(heights, expected.values)
+    assert labels == expected.index.tolist()
+    return
+
+
+def test_Tree__index_clusters():
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+
+    for cluster in np.unique(tree.clusters):
+        rows = tree._cluster_rows(cluster)
+        expected = np.flatnonzero(tree.clusters == cluster)
+        assert rows.tolist() == expected.tolist()
+
+        columns = tree._cluster_columns(cluster)
+        expected = np.flatnonzero(tree.onehot[rows].toarray().any(axis=0))
+        assert columns.tolist() == expected.tolist()
+
+    with pytest.raises(KeyError):
+        tree.cluster_table(tree.clusters.max() + 1)
+    return
+
+
+def test_Tree_cluster_hist_cached(monkeypatch):
+    import BioDendro.cluster
+
+    monkeypatch.setattr(BioDendro.cluster, "_FIGURE_CACHE_SIZE", 2)
+
+    tree = Tree(threshold=0.01, cutoff=0.3)
+    tree.fit(sweep_data())
+    first, second, third = np.unique(tree.clusters)[:3]
+
+    figure = tree.cluster_hist(first)
+    assert tree.cluster_hist(first) is figure
+
+    small = tree.cluster_hist(first, height=3)
+    assert small is not figure
+
+    # The least recently used figure is dropped.
+    tree.cluster_hist(second)
+    assert len(tree._figure_cache) == 2
+    assert tree.cluster_hist(first, height=3) is small
+    assert tree.cluster_hist(first) is not figure
+
+    # Cutting the tree again forgets the figures.
+    tree.cluster_hist(third)
+    tree.cut_tree(0.6)
+    assert len(tree._figure_cache) == 0
+    return
+
+
+@pytest.mark.parametrize("duplicated", [False, True])
+def test_Tree_average_linkage_counts(monkeypatch, duplicated):
+    import BioDendro.cluster
+
+    calls = []
+    nn_chain = BioDendro.cluster.nn_chain
+
+    def counted(*args, **kwargs):
+        calls.append(kwargs.get("counts"))
+        return nn_chain(*args, **kwargs)
+
+    monkeypatch.setattr(BioDendro.cluster, "nn_chain", counted)
+
+    components = ["a", "a", "b", "c", "c", "d"]
+    mzs = [100.0, 200.0, 100.0, 200.0, 300.0, 300.0]
+    if duplicated:
+        components += ["e", "e"]
+        mzs += [100.0, 200.0]
+
+    df = pd.DataFrame({"component": components, "mz": mzs})
+    df = df.sort_values("mz", kind="stable").reset_index(drop=True)
+
+    tree = Tree(threshold=0.01, linkage_method="average")
+    tree.fit(df)
+
+    # The faster scipy linkage is used unless profiles need weighting.
+    assert len(calls) == int(duplicated)
+
+    expected = linkage(
+        pdist(tree.onehot.toarray(), "jaccard"),
+        method="average"
+    )
+    assert np.allclose(np.sort(tree.tree[:, 2]), np.sort(expected[:, 2]))
+    return
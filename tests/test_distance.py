@@ -0,0 +1,165 @@
+"""
+"""
+
+import pytest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import pdist as scipy_pdist
+
+from BioDendro.distance import pdist
+from BioDendro.distance import condensed_size
+from BioDendro.distance import paired_distances
+from BioDendro.distance import _row_blocks
+
+
+def random_onehot(nrows, ncols, density, seed=0):
+    rng = np.random.default_rng(seed)
+    dense = rng.random((nrows, ncols)) < density
+
+    # Make sure no rows are empty so that scipy's distances are defined.
+    dense[np.arange(nrows), rng.integers(0, ncols, nrows)] = True
+    return dense
+
+
+@pytest.mark.parametrize("metric", ["jaccard", "braycurtis"])
+@pytest.mark.parametrize("block_size", [None, 1, 3, 7, 100])
+def test_pdist(metric, block_size):
+    dense = random_onehot(23, 15, 0.2)
+
+    expected = scipy_pdist(dense, metric=metric)
+    actual = pdist(csr_matrix(dense), metric=metric, block_size=block_size)
+
+    assert actual.shape == (condensed_size(23), )
+    assert np.allclose(actual, expected)
+    return
+
+
+@pytest.mark.parametrize("metric", ["jaccard", "braycurtis"])
+@pytest.mark.parametrize("block_size", [None, 5])
+def test_pdist_parallel(metric, block_size):
+    dense = random_onehot(40, 25, 0.2, seed=1)
+
+    expected = pdist(csr_matrix(dense), metric=metric)
+    actual = pdist(
+        csr_matrix(dense),
+        metric=metric,
+        block_size=block_size,
+        n_jobs=2
+    )
+
+    assert np.array_equal(actual, expected)
+    return
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_pdist_memmap(tmpdir, n_jobs):
+    dense = random_onehot(30, 20, 0.2, seed=2)
+    out = np.memmap(
+        str(tmpdir.join("distances")),
+        dtype=np.float32,
+        mode="w+",
+        shape=(condensed_size(30), )
+    )
+
+    pdist(csr_matrix(dense), out=out, block_size=4, n_jobs=n_jobs)
+
+    expected = scipy_pdist(dense, metric="jaccard").astype(np.float32)
+    assert np.array_equal(np.asarray(out), expected)
+    return
+
+
+@pytest.mark.parametrize("n,block_size,n_blocks", [
+    (0, 10, 1),
+    (1, 10, 4),
+    (10, 3, 1),
+    (10, 100, 4),
+    (100, 7, 8),
+    ])
+def test__row_blocks(n, block_size, n_blocks):
+    blocks = _row_blocks(n, block_size, n_blocks)
+
+    # Blocks must cover all rows exactly once, in order.
+    rows = [i for start, stop in blocks for i in range(start, stop)]
+    assert rows == list(range(n))
+    assert all(0 < stop - start <= block_size for start, stop in blocks)
+    return
+
+
+def test__row_blocks_balanced():
+    n = 1000
+    blocks = _row_blocks(n, n, 4)
+    pairs = [
+        sum(n - i - 1 for i in range(start, stop))
+        for start, stop
+        in blocks
+    ]
+
+    assert len(blocks) == 4
+    assert sum(pairs) == n * (n - 1) // 2
+
+    # Each block should be within a row or two of a quarter of the pairs.
+    assert max(pairs) - min(pairs) < 2 * n
+    return
+
+
+def test_pdist_empty_rows():
+    dense = np.array([
+        [False, False],
+        [False, False],
+        [True, False],
+    ])
+
+    actual = pdist(csr_matrix(dense), metric="jaccard")
+    assert actual.tolist() == [0.0, 1.0, 1.0]
+    return
+
+
+@pytest.mark.parametrize("nrows", [0, 1])
+def test_pdist_too_few_rows(nrows):
+    actual = pdist(csr_matrix((nrows, 4), dtype=bool))
+    assert len(actual) == 0
+    return
+
+
+def test_pdist_out():
+    dense = random_onehot(10, 8, 0.3)
+    out = np.zeros(condensed_size(10))
+
+    actual = pdist(csr_matrix(dense), out=out)
+    assert actual is out
+    assert np.allclose(out, scipy_pdist(dense, metric="jaccard"))
+
+    with pytest.raises(ValueError):
+        pdist(csr_matrix(dense), out=np.zeros(3))
+    return
+
+
+@pytest.mark.parametrize("metric", ["jaccard", "braycurtis"])
+@pytest.mark.parametrize("chunk_size", [None, 0, 1, 4])
+def test_paired_distances(metric, chunk_size):
+    dense = random_onehot(12, 10, 0.3, seed=3)
+    rows = np.array([0, 3, 11, 5, 5])
+    columns = np.array([1, 3, 2, 7, 0])
+
+    expected = [
+        scipy_pdist(dense[[r, c]], metric=metric)[0] if r != c else 0.0
+        for r, c
+        in zip(rows, columns)
+    ]
+    actual = paired_distances(
+        csr_matrix(dense),
+        rows,
+        columns,
+        metric=metric,
+        chunk_size=chunk_size
+    )
+
+    assert np.allclose(actual, expected)
+    return
+
+
+def test_pdist_bad_metric():
+    with pytest.raises(ValueError):
+        pdist(csr_matrix((3, 3), dtype=bool), metric="euclidean")
+    return
@@ -0,0 +1,216 @@
+"""
+"""
+
+import pytest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.cluster.hierarchy import linkage
+from scipy.cluster.hierarchy import cophenet
+from scipy.spatial.distance import pdist
+
+from BioDendro.linkage import nn_chain
+from BioDendro.linkage import num_observations
+from BioDendro.linkage import sparse_linkage
+from BioDendro.linkage import mst_single_linkage
+
+
+@pytest.mark.parametrize("method", [
+    "single",
+    "complete",
+    "average",
+    "weighted",
+    ])
+def test_nn_chain(method):
+    rng = np.random.default_rng(0)
+    distances = pdist(rng.random((40, 3)))
+
+    expected = linkage(distances, method=method)
+    actual = nn_chain(distances.copy(), method=method)
+
+    assert np.array_equal(actual, expected)
+    return
+
+
+@pytest.mark.parametrize("method", ["complete", "average", "weighted"])
+def test_nn_chain_ties(method):
+    # Jaccard distances between small sets have many ties.
+    rng = np.random.default_rng(1)
+    distances = pdist(rng.random((50, 6)) < 0.3, metric="jaccard")
+
+    expected = linkage(distances, method=method)
+    actual = nn_chain(distances.copy(), method=method)
+
+    assert np.array_equal(actual, expected)
+    return
+
+
+def test_nn_chain_memmap(tmpdir):
+    rng = np.random.default_rng(2)
+    distances = pdist(rng.random((30, 3)))
+
+    mapped = np.memmap(
+        str(tmpdir.join("distances")),
+        dtype=np.float32,
+        mode="w+",
+        shape=distances.shape
+    )
+    mapped[:] = distances
+
+    expected = linkage(distances.astype(np.float32), method="complete")
+    actual = nn_chain(mapped, method="complete")
+
+    assert np.array_equal(actual[:, [0, 1, 3]], expected[:, [0, 1, 3]])
+    assert np.allclose(actual[:, 2], expected[:, 2])
+    return
+
+
+@pytest.mark.parametrize("method", ["average", "complete", "weighted"])
+def test_nn_chain_counts(method):
+    # Clustering unique points weighted by their counts should match
+    # clustering every point.
+    rng = np.random.default_rng(4)
+    points = rng.random((12, 3))
+    counts = rng.integers(1, 4, 12)
+    repeated = np.repeat(np.arange(12), counts)
+
+    unique_tree = nn_chain(pdist(points), method=method, counts=counts)
+    full_tree = linkage(pdist(points[repeated]), method=method)
+
+    assert unique_tree[:, 3].tolist() == full_tree[-11:, 3].tolist()
+    assert np.allclose(unique_tree[:, 2], full_tree[-11:, 2])
+
+    # Cophenetic distances between the unique points are the same. Scipy
+    # checks that cluster sizes are consistent, so count each point once.
+    unweighted = unique_tree.copy()
+    sizes = np.ones(23)
+    for k, (a, b) in enumerate(unweighted[:, :2].astype(int)):
+        sizes[12 + k] = sizes[a] + sizes[b]
+        unweighted[k, 3] = sizes[12 + k]
+
+    first = np.searchsorted(repeated, np.arange(12))
+    full = cophenet(full_tree)
+    n = len(repeated)
+    expected = [
+        full[n * i - i * (i + 1) // 2 + (j - i - 1)]
+        for a, i in enumerate(first)
+        for j in first[a + 1:]
+    ]
+    assert np.allclose(cophenet(unweighted), expected)
+    return
+
+
+@pytest.mark.parametrize("metric", ["jaccard", "braycurtis"])
+def test_mst_single_linkage(metric):
+    rng = np.random.default_rng(5)
+    dense = rng.random((60, 30)) < 0.15
+    dense[:, 0] |= ~dense.any(axis=1)
+
+    expected = linkage(pdist(dense, metric=metric), method="single")
+    actual = mst_single_linkage(csr_matrix(dense), metric=metric)
+
+    # Merge heights are unique for single linkage, though equal merges may
+    # be in a different order.
+    assert np.allclose(actual[:, 2], expected[:, 2])
+    assert np.allclose(cophenet(actual), cophenet(expected))
+    return
+
+
+def test_mst_single_linkage_too_few():
+    with pytest.raises(ValueError):
+        mst_single_linkage(csr_matrix(np.ones((1, 3), dtype=bool)))
+    return
+
+
+@pytest.mark.parametrize("n", [2, 3, 10])
+def test_num_observations(n):
+    assert num_observations(np.zeros(n * (n - 1) // 2)) == n
+    return
+
+
+def test_num_observations_invalid():
+    with pytest.raises(ValueError):
+        num_observations(np.zeros(4))
+    return
+
+
+def test_nn_chain_bad_method():
+    with pytest.raises(ValueError):
+        nn_chain(np.zeros(3), method="ward")
+    return
+
+
+@pytest.mark.parametrize("method", [
+    "single",
+    "complete",
+    "average",
+    "weighted",
+    ])
+def test_sparse_linkage_complete_graph(method):
+    rng = np.random.default_rng(3)
+    distances = pdist(rng.random((30, 3)))
+    distances /= distances.max() * 1.01
+    i, j = np.triu_indices(30, 1)
+
+    expected = linkage(distances, method=method)
+    actual = sparse_linkage(30, i, j, distances, method=method)
+
+    assert np.array_equal(actual, expected)
+    return
+
+
+@pytest.mark.parametrize("method", [
+    "single",
+    "complete",
+    "average",
+    "weighted",
+    ])
+@pytest.mark.parametrize("counts", [None, [1, 2, 3, 1, 1, 4] * 10])
+def test_sparse_linkage_ties(method, counts):
+    # Jaccard distances between small sets have many ties, which must be
+    # broken in the same way as nn_chain.
+    rng = np.random.default_rng(6)
+    dense = rng.random((60, 8)) < 0.3
+    dense[:, 0] |= ~dense.any(axis=1)
+
+    distances = pdist(dense, metric="jaccard")
+    i, j = np.triu_indices(60, 1)
+
+    expected = nn_chain(distances.copy(), method=method, counts=counts)
+    actual = sparse_linkage(60, i, j, distances, method=method,
+                            counts=counts)
+
+    assert np.array_equal(actual, expected)
+    return
+
+
+def test_sparse_linkage_missing_edges():
+    # Two groups that are only connected within themselves.
+    i = np.array([0, 0, 1, 3])
+    j = np.array([1, 2, 2, 4])
+    distances = np.array([0.1, 0.3, 0.2, 0.4])
+
+    actual = sparse_linkage(5, i, j, distances, method="complete")
+
+    assert actual.tolist() == [
+        [0, 1, 0.1, 2],
+        [2, 5, 0.3, 3],
+        [3, 4, 0.4, 2],
+        [6, 7, 1.0, 5],
+    ]
+    return
+
+
+def test_sparse_linkage_complete_needs_all_pairs():
+    # 2 is close to 0 but has no edge to 1, so under complete linkage it
+    # only joins {0, 1} at the maximum distance.
+    i = np.array([0, 0])
+    j = np.array([1, 2])
+    distances = np.array([0.1, 0.2])
+
+    actual = sparse_linkage(3, i, j, distances, method="complete")
+    assert actual[:, 2].tolist() == [0.1, 1.0]
+
+    actual = sparse_linkage(3, i, j, distances, method="single")
+    assert actual[:, 2].tolist() == [0.1, 0.2]
+    return
@@ -0,0 +1,100 @@
+"""
+"""
+
+import pytest
+
+import numpy as np
+import pandas as pd
+from scipy.io import mmread
+from scipy.sparse import csr_matrix
+from scipy.sparse import load_npz
+
+from BioDendro.output import write_table
+from BioDendro.output import write_sparse_matrix
+from BioDendro.output import table_filename
+from BioDendro.output import check_format
+
+
+def test_table_filename():
+    assert table_filename("results", "clusters", "csv").endswith(
+        "clusters.csv"
+    )
+    return
+
+
+@pytest.mark.parametrize("file_format", ["xlsx", "csv"])
+@pytest.mark.parametrize("index", [True, False])
+def test_write_table(tmpdir, file_format, index):
+    table = pd.DataFrame(
+        {"a": [True, False], "b": [False, True]},
+        index=pd.Index(["x", "y"], name="component"),
+    )
+    filename = str(tmpdir.join("table." + file_format))
+    write_table(table, filename, file_format, index=index)
+
+    if file_format == "xlsx":
+        actual = pd.read_excel(filename)
+    else:
+        actual = pd.read_csv(filename)
+
+    if index:
+        assert actual.columns.tolist() == ["component", "a", "b"]
+    else:
+        assert actual.columns.tolist() == ["a", "b"]
+
+    assert actual["a"].astype(bool).tolist() == [True, False]
+    return
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "feather"])
+def test_write_table_arrow(tmpdir, file_format):
+    pytest.importorskip("pyarrow")
+
+    table = pd.DataFrame(
+        {"a": [True, False], "b": np.arange(2)},
+        index=pd.Index(["x", "y"], name="component"),
+    )
+    filename = str(tmpdir.join("table." + file_format))
+    write_table(table, filename, file_format)
+
+    if file_format == "parquet":
+        actual = pd.read_parquet(filename)
+    else:
+        actual = pd.read_feather(filename).set_index("component")
+
+    assert actual.equals(table)
+    return
+
+
+def test_check_format_bad_format():
+    with pytest.raises(ValueError):
+        check_format("xls")
+    return
+
+
+@pytest.mark.parametrize("sparse_format", ["mtx", "npz"])
+def test_write_sparse_matrix(tmpdir, sparse_format):
+    matrix = csr_matrix(np.array([
+        [True, False, False],
+        [False, False, True],
+    ]))
+    filename = str(tmpdir.join("matrix." + sparse_format))
+    write_sparse_matrix(matrix, filename, sparse_format)
+
+    if sparse_format == "npz":
+        actual = load_npz(filename)
+    else:
+        actual = mmread(filename)
+
+    assert (actual.toarray() > 0).tolist() == matrix.toarray().tolist()
+    return
+
+
+def test_write_sparse_matrix_bad_format(tmpdir):
+    with pytest.raises(ValueError):
+        write_sparse_matrix(
+            csr_matrix((2, 2), dtype=bool),
+            str(tmpdir.join("matrix.h5")),
+            "h5"
+        )
+    return
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from BioDendro.parallel import n_workers
+
+
+@pytest.mark.parametrize("n_jobs,expected", [
+    (None, 1),
+    (1, 1),
+    (3, 3),
+    (-1, os.cpu_count() or 1),
+    ])
+def test_n_workers(n_jobs, expected):
+    assert n_workers(n_jobs) == expected
+    return
+
+
+@pytest.mark.parametrize("n_jobs", [0, -2, -5])
+def test_n_workers_invalid(n_jobs):
+    with pytest.raises(ValueError):
+        n_workers(n_jobs)
+    return
@@ -1,9 +1,16 @@
+import time
+
 import pytest
 
+import numpy as np
+
 from BioDendro.preprocess import split_msms_title
+from BioDendro.preprocess import MGF
 from BioDendro.preprocess import MGFRecord
 from BioDendro.preprocess import Ion
 from BioDendro.preprocess import SampleRecord
+from BioDendro.preprocess import remove_redundancy
+from BioDendro.preprocess import remove_redundancy_stream
 
 
 # Test MGFRecord methods
@@ -114,6 +121,47 @@ def test_MGFRecord__read(sample, expected):
     return
 
 
+@pytest.mark.parametrize("scaling,filtering,expected", [
+    (False, False, [Ion(1.0, 10.0), Ion(2.0, 40.0), Ion(3.0, None)]),
+    (True, False, [Ion(1.0, 0.25), Ion(2.0, 1.0), Ion(3.0, None)]),
+    (True, True, [Ion(2.0, 1.0), Ion(3.0, None)]),
+    (False, True, [Ion(1.0, 10.0), Ion(2.0, 40.0), Ion(3.0, None)]),
+    ])
+def test_MGFRecord__read_altered(scaling, filtering, expected):
+    sample = ["TITLE=a", "PEPMASS=5", "1.0 10", "2.0 40", "3.0"]
+    actual = MGFRecord._read(sample, scaling=scaling, filtering=filtering,
+                             eps=0.5)
+
+    assert actual.ions == expected
+    return
+
+
+def test_MGFRecord__read_columns_scales_linearly():
+    """ Parse time should grow linearly with the number of peaks. """
+
+    def time_parse(n_peaks, repeats=3):
+        lines = ["TITLE=a", "PEPMASS=500.0", "RTINSECONDS=1"]
+        lines.extend(
+            "{:.5f} {:.1f}".format(50 + i * 0.01, i % 97)
+            for i in range(n_peaks)
+        )
+
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            MGFRecord._read_columns(lines, scaling=True, filtering=True,
+                                    eps=0.1)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    small = time_parse(2000)
+    large = time_parse(16000)
+
+    # Linear growth gives a ratio of ~8, quadratic would be ~64.
+    assert large / small < 24
+    return
+
+
 @pytest.mark.parametrize("sample,expected", [
     (
         [
@@ -182,7 +230,297 @@ def test_MGFRecord_parse(sample, expected):
 
 # Test MGF methods
 
-def test_MGF_closest():
+MGF_LINES = [
+    'BEGIN IONS',
+    'TITLE=second',
+    'RTINSECONDS=20',
+    'PEPMASS=200.5 1000',
+    '50.1 10',
+    '60.2 20',
+    'END IONS',
+    'BEGIN IONS',
+    'TITLE=first',
+    'RTINSECONDS=10',
+    'PEPMASS=100.5',
+    '40.1 5',
+    'END IONS',
+    'BEGIN IONS',
+    'TITLE=third',
+    'RTINSECONDS=30',
+    'PEPMASS=200.501',
+    '70.3',
+    '80.4 7',
+    '90.5 8',
+    'END IONS',
+]
+
+
+def test_MGF_parse():
+    actual = MGF.parse(MGF_LINES)
+
+    assert len(actual) == 3
+    assert list(actual.titles) == ["first", "second", "third"]
+    assert list(actual.pepmasses) == [100.5, 200.5, 200.501]
+    assert list(actual.retentions) == [10.0, 20.0, 30.0]
+    assert list(actual.offsets) == [0, 1, 3, 6]
+    assert list(actual.ion_mzs) == [40.1, 50.1, 60.2, 70.3, 80.4, 90.5]
+
+    record = actual[2]
+    assert record.title == "third"
+    assert record.pepmass == Ion(200.501, None)
+    assert record.ions == [Ion(70.3, None), Ion(80.4, 7.0), Ion(90.5, 8.0)]
+    return
+
+
+@pytest.mark.parametrize("mz,retention,expected", [
+    (100.5, 10, "first"),
+    (200.5, 21, "second"),
+    (200.5, 28, "third"),
+    (200.5, 25, "second"),  # Ties go to the lowest mz.
+    (200.5, 40, None),  # Outside retention tolerance.
+    (300.5, 10, None),  # Outside mz tolerance.
+    ])
+def test_MGF_closest(mz, retention, expected):
+    mgf = MGF.parse(MGF_LINES)
+    actual = mgf.closest(mz, retention, mz_tol=0.002, retention_tol=6)
+
+    if expected is None:
+        assert actual is None
+    else:
+        assert actual.title == expected
+    return
+
+
+@pytest.mark.parametrize("index", ["sorted", "grid"])
+@pytest.mark.parametrize("mz_tol", [0.02, 0.3])
+@pytest.mark.parametrize("max_candidates", [1, 7, 2 ** 22])
+def test_MGF_closest_many(index, mz_tol, max_candidates):
+    rng = np.random.RandomState(42)
+
+    # Round so that there are ties in both mz and retention.
+    n_records = 200
+    pepmasses = np.sort(np.round(rng.uniform(100, 101, n_records), 2))
+    mgf = MGF(
+        titles=np.arange(n_records).astype(str).astype(object),
+        retentions=np.round(rng.uniform(0, 100, n_records)),
+        pepmasses=pepmasses,
+        offsets=np.zeros(n_records + 1, dtype=int),
+        ion_mzs=[],
+        ion_intensities=[],
+    )
+
+    mzs = np.round(rng.uniform(99.9, 101.1, 300), 2)
+    retentions = np.round(rng.uniform(-10, 110, 300))
+    actual = mgf.closest_many(mzs, retentions, mz_tol, 5, index=index,
+                              max_candidates=max_candidates)
+
+    # Scan in mz order, as the original loop did.
+    for mz, retention, act in zip(mzs, retentions, actual):
+        expected = -1
+        min_dist = float("inf")
+        for i in range(n_records):
+            if not (mz - mz_tol <= pepmasses[i] < mz + mz_tol):
+                continue
+            elif not (retention - 5 < mgf.retentions[i] < retention + 5):
+                continue
+
+            dist = abs(retention - mgf.retentions[i])
+            if dist < min_dist:
+                min_dist = dist
+                expected = i
+
+        assert act == expected
+    return
+
+
+@pytest.mark.parametrize("lines,newline", [
+    (MGF_LINES, "\n"),
+    (MGF_LINES, "\r\n"),
+    ([line for line in MGF_LINES if line != "70.3"], "\n"),
+    (["BEGIN IONS", "TITLE=empty", "PEPMASS=1", "END IONS"], "\n"),
+    ])
+def test_MGF_parse_mapped(tmp_path, lines, newline):
+    """ Parsing from a path should match parsing an open file. """
+    path = tmp_path / "test.mgf"
+    with open(path, "w", newline="") as handle:
+        handle.write(newline.join(lines) + newline)
+
+    with open(path) as handle:
+        expected = MGF.parse(handle, scaling=True, filtering=True, eps=0.5)
+
+    actual = MGF.parse(str(path), scaling=True, filtering=True, eps=0.5)
+
+    assert list(actual.titles) == list(expected.titles)
+    assert list(actual.pepmasses) == list(expected.pepmasses)
+    assert list(actual.offsets) == list(expected.offsets)
+    assert list(actual.ion_mzs) == list(expected.ion_mzs)
+    assert actual.records[-1].ions == expected.records[-1].ions
+    return
+
+
+@pytest.mark.parametrize("chunk_size", [1, 50, 2 ** 20])
+def test_MGF__parse_parallel(tmp_path, chunk_size):
+    path = tmp_path / "test.mgf"
+    path.write_text("\n".join(["MASS=Monoisotopic"] + MGF_LINES * 3) + "\n")
+
+    expected = MGF.parse(str(path))
+    actual = MGF._parse_parallel(str(path), n_jobs=2, chunk_size=chunk_size)
+
+    assert len(actual) == len(expected) == 9
+    assert list(actual.titles) == list(expected.titles)
+    assert list(actual.retentions) == list(expected.retentions)
+    assert list(actual.offsets) == list(expected.offsets)
+    assert list(actual.ion_mzs) == list(expected.ion_mzs)
+    return
+
+
+def test_MGF_save_load(tmp_path):
+    expected = MGF.parse(MGF_LINES)
+    path = str(tmp_path / "test.npz")
+
+    expected.save(path)
+    actual = MGF.load(path)
+
+    assert list(actual.titles) == list(expected.titles)
+    assert list(actual.charges) == list(expected.charges)
+    assert list(actual.offsets) == list(expected.offsets)
+    assert list(actual.ion_mzs) == list(expected.ion_mzs)
+    assert actual.records[1].ions == expected.records[1].ions
+    return
+
+
+def test_MGF_parse_cached(tmp_path, monkeypatch):
+    path = tmp_path / "test.mgf"
+    path.write_text("\n".join(MGF_LINES) + "\n")
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+
+    first = MGF.parse_cached(str(path), cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # The second run should read the cache rather than the mgf.
+    original_parse = MGF.parse
+    monkeypatch.setattr(MGF, "parse", None)
+    second = MGF.parse_cached(str(path), cache_dir=str(cache_dir))
+    assert list(second.titles) == list(first.titles)
+
+    # Changing the file invalidates the cache.
+    monkeypatch.setattr(MGF, "parse", original_parse)
+    path.write_text("\n".join(MGF_LINES[:7]) + "\n")
+    third = MGF.parse_cached(str(path), cache_dir=str(cache_dir))
+    assert list(third.titles) == ["second"]
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # Different parameters get their own cache file.
+    MGF.parse_cached(str(path), scaling=True, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 2
+    return
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: data[:len(data) // 2],
+    lambda data: data[:10],
+    lambda data: b"",
+    lambda data: b"not a zip file",
+    lambda data: data[:200] + b"\0" * (len(data) - 200),
+    ])
+def test_MGF_parse_cached_corrupt(tmp_path, corrupt):
+    path = tmp_path / "test.mgf"
+    path.write_text("\n".join(MGF_LINES) + "\n")
+
+    expected = MGF.parse_cached(str(path))
+    cache_path, = [p for p in tmp_path.iterdir() if p.suffix == ".npz"]
+    cache_path.write_bytes(corrupt(cache_path.read_bytes()))
+
+    # A broken cache is treated as missing and replaced.
+    actual = MGF.parse_cached(str(path))
+    assert list(actual.titles) == list(expected.titles)
+    assert list(actual.ion_mzs) == list(expected.ion_mzs)
+
+    replaced = MGF.parse_cached(str(path))
+    assert list(replaced.titles) == list(expected.titles)
+    return
+
+
+def test_MGF_iter_records():
+    actual = list(MGF.iter_records(MGF_LINES))
+
+    # Records are yielded in file order, not sorted.
+    assert [r.title for r in actual] == ["second", "first", "third"]
+    assert actual[0].ions == [Ion(50.1, 10.0), Ion(60.2, 20.0)]
+    return
+
+
+# Test standalone matching methods
+
+@pytest.mark.parametrize("neutral,expected_mzs", [
+    (False, [40.1, 50.1, 60.2]),
+    (True, [-150.4, -140.3, -60.4]),
+    ])
+def test_remove_redundancy(neutral, expected_mzs):
+    samples = [
+        SampleRecord(200.5, 21, "b"),
+        SampleRecord(100.5, 11, "a"),
+        SampleRecord(300.5, 10, "d"),
+    ]
+
+    actual = remove_redundancy(samples, MGF.parse(MGF_LINES),
+                               retention_tol=6, neutral=neutral)
+
+    assert list(actual["mz"]) == expected_mzs
+    assert list(actual["component"].cat.categories) == ["a", "b"]
+    assert list(actual["sample"].cat.categories) == [
+        "first_100.5_10.0",
+        "second_200.5_20.0"
+    ]
+    return
+
+
+def test_remove_redundancy_no_matches():
+    samples = [SampleRecord(300.5, 10, "d")]
+
+    actual = remove_redundancy(samples, MGF.parse(MGF_LINES))
+    expected = remove_redundancy_stream(samples, MGF.iter_records(MGF_LINES))
+
+    assert len(actual) == 0
+    assert list(actual.columns) == ["component", "sample", "mz"]
+    assert actual.equals(expected)
+    return
+
+
+@pytest.mark.parametrize("n_jobs", [2, 3, 8])
+def test_remove_redundancy_parallel(n_jobs):
+    mgf = MGF.parse(MGF_LINES)
+    samples = [
+        SampleRecord(mz, retention, "{}_{}".format(mz, retention))
+        for mz in [100.5, 200.5, 200.501, 300.5]
+        for retention in range(5, 35, 3)
+    ]
+
+    expected = remove_redundancy(samples, mgf, retention_tol=6)
+    actual = remove_redundancy(samples, mgf, retention_tol=6, n_jobs=n_jobs)
+
+    assert len(actual) > 0
+    assert actual.equals(expected)
+    return
+
+
+@pytest.mark.parametrize("neutral", [False, True])
+def test_remove_redundancy_stream(neutral):
+    samples = [
+        SampleRecord(100.5, 11, "a"),
+        SampleRecord(200.5, 25, "b"),
+        SampleRecord(200.501, 29, "c"),
+        SampleRecord(300.5, 10, "d"),
+    ]
+
+    expected = remove_redundancy(samples, MGF.parse(MGF_LINES),
+                                 retention_tol=6, neutral=neutral)
+    actual = remove_redundancy_stream(samples, MGF.iter_records(MGF_LINES),
+                                      retention_tol=6, neutral=neutral)
+
+    assert set(actual["component"]) == {"a", "b", "c"}
+    assert actual.equals(expected)
     return
 
 
@@ -237,4 +575,3 @@ def test_split_msms_title(sample, expected):
     assert actual == expected
     return
 
-